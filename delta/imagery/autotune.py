@@ -0,0 +1,129 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Find the `io.block_size_mb`, `io.tile_ratio` and `io.threads` that load training data fastest,
+by briefly measuring the input pipeline with each combination on a sample of the images.
+"""
+
+import itertools
+import os
+import random
+import time
+
+import tensorflow as tf
+import yaml
+
+from delta.config import config
+from delta.imagery import imagery_dataset
+from delta.imagery.imagery_config import ImageSet
+
+BLOCK_SIZES = [1, 2, 4, 8, 16]
+TILE_RATIOS = [1.0, 2.0, 5.0]
+
+def default_threads():
+    """Powers of two up to the number of CPUs."""
+    cpus = os.cpu_count() or 1
+    return [t for t in (2 ** i for i in range(cpus.bit_length())) if t <= cpus]
+
+def sample_images(image_set, count, seed=0):
+    """Returns the indices of `count` randomly chosen images in `image_set`, or of all of them."""
+    indices = list(range(len(image_set)))
+    if count >= len(indices):
+        return indices
+    return sorted(random.Random(seed).sample(indices, count))
+
+def subset(image_set, indices):
+    """Returns an `ImageSet` with only the images at `indices`."""
+    if image_set is None:
+        return None
+    return ImageSet([image_set[i] for i in indices], image_set.type(), image_set.preprocess(),
+                    image_set.nodata_value())
+
+def measure(dataset, batch_size, batches, warmup=2):
+    """
+    Returns the chunks per second loaded by `dataset.batches(batch_size)`, timing `batches`
+    batches after the first `warmup`, which include starting the pipeline. If the dataset ends
+    first, times what there is.
+    """
+    iterator = iter(dataset.batches(batch_size))
+    for _ in range(warmup):
+        next(iterator)
+    chunks = 0
+    start = time.perf_counter()
+    for (x, _) in itertools.islice(iterator, batches):
+        chunks += int(x.shape[0])
+    elapsed = time.perf_counter() - start
+    return chunks / elapsed if elapsed > 0 else 0.0
+
+def _set_io(settings):
+    config.load(yaml_str=yaml.safe_dump({'io' : settings}))
+
+def _io_settings(result):
+    """Returns the io settings of a result from `autotune`, without its measurements."""
+    return {k : v for (k, v) in result.items() if k not in ('chunks_per_second', 'failed')}
+
+def autotune(make_dataset, batch_size, block_sizes=None, tile_ratios=None, #pylint:disable=too-many-arguments
+             threads=None, batches=20, log=print):
+    """
+    Measures the chunks per second loaded by the dataset returned by `make_dataset()` with every
+    combination of `block_sizes` (`io.block_size_mb`), `tile_ratios` (`io.tile_ratio`) and `threads`
+    (`io.threads`). Each combination is measured for `batches` batches of `batch_size`.
+
+    Returns a list of dicts of the settings and their 'chunks_per_second', fastest first.
+    Settings that fail (e.g., with blocks too small for a chunk, or running out of memory)
+    come last, with the error in 'failed'. The config is left with the fastest settings.
+    """
+    block_sizes = BLOCK_SIZES if block_sizes is None else block_sizes
+    tile_ratios = TILE_RATIOS if tile_ratios is None else tile_ratios
+    threads = default_threads() if threads is None else threads
+    results = []
+    for (b, r, t) in itertools.product(block_sizes, tile_ratios, threads):
+        settings = {'block_size_mb' : b, 'tile_ratio' : float(r), 'threads' : t}
+        _set_io(settings)
+        try:
+            speed = measure(make_dataset(), batch_size, batches)
+        except (ValueError, StopIteration, RuntimeError, tf.errors.OpError) as e:
+            error = str(e) or 'not enough chunks'
+            log('block_size_mb=%-3d tile_ratio=%-5g threads=%-3d failed: %s' % (b, r, t, error))
+            results.append(dict(settings, chunks_per_second=0.0, failed=error))
+            continue
+        log('block_size_mb=%-3d tile_ratio=%-5g threads=%-3d %12.1f chunks/s' % (b, r, t, speed))
+        results.append(dict(settings, chunks_per_second=speed))
+    results.sort(key=lambda s: ('failed' not in s, s['chunks_per_second']), reverse=True)
+    if results and 'failed' not in results[0]:
+        _set_io(_io_settings(results[0]))
+    return results
+
+def write_config(filename, settings):
+    """
+    Writes the io `settings` to the yaml config file `filename`, keeping anything else already in it.
+    """
+    contents = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            contents = yaml.safe_load(f) or {}
+    contents.setdefault('io', {})
+    contents['io'].update(_io_settings(settings))
+    with open(filename, 'w') as f:
+        yaml.safe_dump(contents, f, default_flow_style=False, sort_keys=False)
+
+def training_dataset(images, labels, chunk_size, output_size, chunk_stride=1, autoencoder=False):
+    """Returns a function creating the dataset to tune, see `autotune`."""
+    if autoencoder:
+        return lambda: imagery_dataset.AutoencoderDataset(images, chunk_size, chunk_stride)
+    return lambda: imagery_dataset.ImageryDataset(images, labels, chunk_size, output_size, chunk_stride)
@@ -19,20 +19,69 @@
 Caches large images.
 """
 import os
+import shutil
+import socket
+import time
+
+from delta.imagery import utilities
+
+# Bookkeeping files stored in the cache folder itself.
+_INDEX_FILE = '.delta_cache.json'
+_LOCK_FILE = '.delta_cache.lock'
+
+def _disk_usage(path):
+    """Returns the number of bytes used by a file or folder."""
+    if not os.path.isdir(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError: # removed while we were counting
+                pass
+    return total
+
+def _delete(path):
+    """Deletes a file or an entire folder."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # exists, but belongs to someone else
+        return True
+    return True
 
 class DiskCache:
     """
     Caches folders and files on disk with limits on how much is kept.
     It is safe to mix different datasets in the cache folder, though all items in
     the folder will count towards the limit.
+
+    The cache may be shared by multiple processes. Access times and pins are stored in
+    an index file in the cache folder, protected by a file lock. Items are evicted in
+    least recently used order, and pinned items are never evicted. The size of each item is
+    measured once it is no longer pinned, and kept in the index.
     """
-    def __init__(self, top_folder, limit):
+    def __init__(self, top_folder, limit=None, size_limit=None, lock_timeout=300):
         """
-        The top level folder to store cached items in and the number to store
-        are specified.
+        The top level folder to store cached items in is specified, along with
+        the maximum number of items to store (`limit`) and the maximum number
+        of bytes to store (`size_limit`). Either limit may be None for no limit.
         """
-        if limit < 1:
+        if limit is not None and limit < 1:
             raise Exception('Illegal limit passed to Disk Cache: ' + str(limit))
+        if size_limit is not None and size_limit <= 0:
+            raise Exception('Illegal size limit passed to Disk Cache: ' + str(size_limit))
 
         if not os.path.exists(top_folder):
             try:
@@ -41,17 +90,30 @@ class DiskCache:
                 raise Exception('Could not create disk cache folder: ' + top_folder)
 
         self._limit  = limit
+        self._size_limit = size_limit
         self._folder = top_folder
+        self._index = utilities.LockedJSON(os.path.join(top_folder, _INDEX_FILE), 'items',
+                                           os.path.join(top_folder, _LOCK_FILE), lock_timeout)
+        self._owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+        # number of times each item is pinned by this process
+        self._pins = {}
 
-        self._item_list = []
-        self._update_items()
+        with self._index.lock():
+            self._index.save(self._load_index())
 
     def limit(self):
         """
-        The number of items to store in the cache.
+        The maximum number of items to store in the cache.
         """
         return self._limit
 
+    def size_limit(self):
+        """
+        The maximum number of bytes to store in the cache.
+        """
+        return self._size_limit
+
     def folder(self):
         """
         The directory to store cached items in.
@@ -62,46 +124,149 @@ class DiskCache:
         """
         The number of items currently cached.
         """
-        return len(self._item_list)
+        with self._index.lock():
+            return len(self._load_index())
 
-    def register_item(self, name):
+    def register_item(self, name, pin=False):
         """
         Register a new item with the cache manager and return the full path to it.
-        """
 
-        # If we already have the name just move it to the back of the list
-        try:
-            self._item_list.remove(name)
-            self._item_list.append(name)
-            return self._full_path(name)
-        except ValueError:
-            pass
-
-        # Record the new name and delete the oldest item if our list got too large
-        self._item_list.append(name)
-        if self.num_cached() > self._limit:
-            old_name = self._item_list.pop(0)
-            old_path = self._full_path(old_name)
-            os.system('rm -rf ' + old_path) # Delete the entire old folder/file
+        Marks the item as the most recently used, and evicts the least recently used
+        items if the cache is over its limits. If `pin` is true, the item is also
+        pinned (see `pin`) before any other process can evict it.
+        """
+        with self._index.lock():
+            items = self._load_index()
+            entry = items.setdefault(name, {'size' : 0, 'pins' : []})
+            entry['atime'] = time.time()
+            if pin:
+                self._add_pin(name, entry)
+            self._evict(items, keep=name)
+            self._index.save(items)
 
         # Return the full path to the new folder/file location
         return self._full_path(name)
 
+    def pin(self, name):
+        """
+        Prevent an item from being evicted, by this or any other process,
+        until `unpin` is called. Pins are counted, so each call must be paired
+        with a call to `unpin`.
+        """
+        with self._index.lock():
+            items = self._load_index()
+            entry = items.setdefault(name, {'size' : 0, 'pins' : [], 'atime' : time.time()})
+            self._add_pin(name, entry)
+            self._index.save(items)
+
+    def unpin(self, name):
+        """
+        Release a pin obtained with `pin` or `register_item`.
+        """
+        count = self._pins.get(name, 0)
+        if count == 0:
+            return
+        if count > 1:
+            self._pins[name] = count - 1
+            return
+        del self._pins[name]
+        with self._index.lock():
+            items = self._load_index()
+            entry = items.get(name)
+            if entry is not None:
+                if self._owner in entry['pins']:
+                    entry['pins'].remove(self._owner)
+                # we may have written the item while it was pinned
+                entry['size'] = _disk_usage(self._full_path(name))
+            self._evict(items)
+            self._index.save(items)
+
+    def is_pinned(self, name):
+        """
+        Returns true if any process has pinned the item.
+        """
+        with self._index.lock():
+            entry = self._load_index().get(name)
+        return entry is not None and len(entry['pins']) > 0
+
+    def total_size(self):
+        """
+        The number of bytes used by all cached items.
+        """
+        with self._index.lock():
+            items = self._load_index()
+            total = self._update_sizes(items)
+            self._index.save(items)
+        return total
+
+    def _add_pin(self, name, entry):
+        self._pins[name] = self._pins.get(name, 0) + 1
+        if self._owner not in entry['pins']:
+            entry['pins'].append(self._owner)
+
+    def _update_sizes(self, items, keep=None):
+        """
+        Measure the items whose size is not known yet, and return the total size of all items.
+        Pinned items and `keep` may still be being written, so they are measured once unpinned.
+        """
+        total = 0
+        for (name, entry) in items.items():
+            if not entry['size'] and name != keep and not entry['pins']:
+                entry['size'] = _disk_usage(self._full_path(name))
+            total += entry['size']
+        return total
+
+    def _evict(self, items, keep=None):
+        """
+        Delete the least recently used unpinned items until we are within our limits.
+        """
+        if self._limit is None and self._size_limit is None:
+            return
+        total = self._update_sizes(items, keep)
+
+        candidates = sorted((n for (n, e) in items.items() if n != keep and not e['pins']),
+                            key=lambda n: items[n]['atime'])
+        for name in candidates:
+            over_count = self._limit is not None and len(items) > self._limit
+            over_size = self._size_limit is not None and total > self._size_limit
+            if not over_count and not over_size:
+                break
+            _delete(self._full_path(name))
+            total -= items[name]['size']
+            del items[name]
+
     def _full_path(self, name):
         # Get the full path to one of the stored items by name
         return os.path.join(self._folder, name)
 
+    def _is_item(self, name): #pylint:disable=no-self-use
+        # Skip text files
+        # -> It is important that we don't delete the list file if the user puts it here!
+        if name in (_INDEX_FILE, _LOCK_FILE) or name.endswith('_working') or name.endswith('.tmp'):
+            return False
+        return os.path.splitext(name)[1] not in ['.csv', '.txt']
 
-    def _update_items(self):
+    def _load_index(self):
         """
-        Update the list of all files and folders contained in the folder.
-        Currently these items are not ordered.
+        Load the index of cached items, and update it with the contents of the folder.
+        Must be called with the lock held.
         """
-
-        self._item_list = []
-        for f in os.listdir(self._folder):
-            # Skip text files
-            # -> It is important that we don't delete the list file if the user puts it here!
-            ext = os.path.splitext(f)[1]
-            if ext not in ['.csv', 'txt']:
-                self._item_list.append(f)
+        items = self._index.load()
+        present = set(f for f in os.listdir(self._folder) if self._is_item(f))
+        host = socket.gethostname()
+        for name in list(items.keys()):
+            entry = items[name]
+            # drop pins held by processes on this machine that have exited
+            pins = []
+            for p in entry.get('pins', []):
+                (h, pid) = p.rsplit(':', 1)
+                if p == self._owner or h != host or _process_alive(int(pid)):
+                    pins.append(p)
+            entry['pins'] = pins
+            if name not in present and not pins:
+                del items[name]
+        # items we have no record of (created by an older version, or copied in by the user)
+        # are ordered by their modification time
+        for name in present - set(items.keys()):
+            items[name] = {'atime' : os.path.getmtime(self._full_path(name)), 'size' : 0, 'pins' : []}
+        return items
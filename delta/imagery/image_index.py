@@ -0,0 +1,187 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent index of image metadata, so datasets can be set up without opening every image.
+"""
+import hashlib
+import json
+
+import numpy as np
+
+from delta.imagery import rectangle, sampling, utilities
+from delta.imagery.sources import loader
+
+class ImageInfo:
+    """
+    Metadata about an image file: its size, number of bands, data type, block size and
+    nodata value. Tiles are computed the same way as by
+    `delta.imagery.sources.delta_image.DeltaImage.tiles`, without opening the image.
+    """
+    def __init__(self, size, num_bands, dtype=None, block_size=None, nodata_value=None):
+        self._size = tuple(size)
+        self._num_bands = num_bands
+        self._dtype = dtype
+        self._block_size = None if block_size is None else tuple(block_size)
+        self._nodata_value = nodata_value
+
+    @staticmethod
+    def from_image(image):
+        """Get the metadata of an open `delta.imagery.sources.delta_image.DeltaImage`."""
+        dtype = np.dtype(image.numpy_type()).name if hasattr(image, 'numpy_type') else None
+        block_size = image.block_info()[0] if hasattr(image, 'block_info') else None
+        nodata = image.nodata_value() if hasattr(image, 'nodata_value') else None
+        return ImageInfo(image.size(), image.num_bands(), dtype, block_size, nodata)
+
+    def size(self):
+        """Return the size of this image in pixels, as (width, height)."""
+        return self._size
+
+    def width(self):
+        """Return the number of columns."""
+        return self._size[0]
+
+    def height(self):
+        """Return the number of rows."""
+        return self._size[1]
+
+    def num_bands(self):
+        """Return the number of bands in the image."""
+        return self._num_bands
+
+    def dtype(self):
+        """Name of the numpy data type of the image, or None if unknown."""
+        return self._dtype
+
+    def block_size(self):
+        """The block size of the image, as returned by `block_info`, or None if not blocked."""
+        return self._block_size
+
+    def nodata_value(self):
+        """The nodata value stored in the image, or None."""
+        return self._nodata_value
+
+    def tiles(self, width, height, min_width=0, min_height=0, overlap=0):
+        """Returns the list of tiles of the image, as by `DeltaImage.tiles`."""
+        return rectangle.rectangles(self.tile_array(width, height, min_width, min_height, overlap))
+
+    def tile_array(self, width, height, min_width=0, min_height=0, overlap=0): #pylint:disable=too-many-arguments
+        """Returns the same tiles as `tiles`, as an (N, 4) array (see `delta.imagery.rectangle.to_array`)."""
+        input_bounds = rectangle.Rectangle(0, 0, width=self.width(), height=self.height())
+        return input_bounds.tile_array(width, height, min_width=min_width, min_height=min_height,
+                                       include_partials=True, overlap_amount=overlap)
+
+    def to_dict(self):
+        """Returns a dictionary that can be stored as JSON."""
+        return {'size' : self._size, 'num_bands' : self._num_bands, 'dtype' : self._dtype,
+                'block_size' : self._block_size, 'nodata_value' : self._nodata_value}
+
+    @staticmethod
+    def from_dict(d):
+        """Load metadata saved with `to_dict`."""
+        return ImageInfo(d['size'], d['num_bands'], d['dtype'], d['block_size'], d['nodata_value'])
+
+def _close(image):
+    """Closes an image opened to index it, so it doesn't stay pinned in the disk cache."""
+    if hasattr(image, 'close'):
+        image.close()
+
+class ImageIndex:
+    """
+    Stores `ImageInfo` for image files in a JSON index file. Images are only opened
+    if they are not in the index, or have been modified since they were indexed.
+
+    The index can be shared by multiple processes, and is protected by a lock file.
+    """
+    def __init__(self, path, lock_timeout=300):
+        """
+        Stores the index in the file `path`.
+        """
+        self._index = utilities.LockedJSON(path, 'images', lock_timeout=lock_timeout)
+        self._memo = {}
+
+    def path(self):
+        """The index file."""
+        return self._index.path()
+
+    def _key(self, image_set, i): #pylint:disable=no-self-use
+        paths = utilities.source_paths(image_set[i])
+        return (json.dumps([image_set.type()] + paths), utilities.modified_time(paths))
+
+    def tile_histograms(self, image_set, i, tiles, num_classes):
+        """
+        Returns an array with the number of pixels of each class in each of `tiles`
+        of image `i` in the label `delta.imagery.imagery_config.ImageSet`
+        (see `delta.imagery.sampling.tile_histograms`). The histograms are stored
+        in the index, so the labels only need to be read once for each set of tiles.
+        """
+        (key, mtime) = self._key(image_set, i)
+        tiles_key = hashlib.sha1(json.dumps([num_classes] + [t.get_bounds() for t in tiles]).encode()).hexdigest()
+        memo_key = (key, mtime, tiles_key)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        with self._index.lock():
+            entry = self._index.load().get(key)
+        if entry is not None and entry['mtime'] == mtime and tiles_key in entry.get('histograms', {}):
+            result = np.array(entry['histograms'][tiles_key], dtype=np.int64)
+        else:
+            img = loader.load(image_set[i], image_set.type())
+            result = sampling.tile_histograms(img, tiles, num_classes)
+            info = ImageInfo.from_image(img).to_dict()
+            _close(img)
+            with self._index.lock():
+                items = self._index.load()
+                entry = items.get(key)
+                if entry is None or entry['mtime'] != mtime:
+                    entry = {'mtime' : mtime, 'info' : info}
+                    items[key] = entry
+                # only keep histograms for the most recent tiling
+                entry['histograms'] = {tiles_key : result.tolist()}
+                self._index.save(items)
+        self._memo[memo_key] = result
+        return result
+
+    def info(self, image_set):
+        """
+        Returns a list of `ImageInfo` for each image in a
+        `delta.imagery.imagery_config.ImageSet`, opening only the images not already indexed.
+        """
+        keys = [self._key(image_set, i) for i in range(len(image_set))]
+        missing = [i for (i, k) in enumerate(keys) if k not in self._memo]
+        if not missing:
+            return [self._memo[k] for k in keys]
+
+        with self._index.lock():
+            items = self._index.load()
+        created = {}
+        for i in missing:
+            (key, mtime) = keys[i]
+            entry = items.get(key)
+            if entry is None or entry['mtime'] != mtime:
+                img = loader.load(image_set[i], image_set.type())
+                entry = {'mtime' : mtime, 'info' : ImageInfo.from_image(img).to_dict()}
+                _close(img)
+                created[key] = entry
+            self._memo[keys[i]] = ImageInfo.from_dict(entry['info'])
+        if created:
+            with self._index.lock():
+                # other processes may have added to the index, so only write the entries made here
+                latest = self._index.load()
+                latest.update(created)
+                self._index.save(latest)
+        return [self._memo[k] for k in keys]
@@ -20,12 +20,12 @@ Configuration options specific to imagery.
 """
 import os
 import os.path
-import numpy as np
 
 import appdirs
 
 from delta.config import config, DeltaConfigComponent, validate_path, validate_positive
-from . import disk_folder_cache
+from . import disk_folder_cache, image_index, statistics
+from .preprocess import Pipeline
 
 
 class ImageSet:
@@ -41,7 +41,8 @@ class ImageSet:
          * An iterable of image filenames `images`
          * The image type (i.e., tiff, worldview, landsat) `image_type`
          * An optional preprocessing function to apply to the image,
-           following the signature in `delta.imagery.sources.delta_image.DeltaImage.set_process`.
+           following the signature in `delta.imagery.sources.delta_image.DeltaImage.set_process`,
+           usually a `delta.imagery.preprocess.Pipeline`.
          * A `nodata_value` for pixels to disregard
         """
         self._images = images
@@ -112,7 +113,8 @@ def __find_images(conf, matching_images=None, matching_conf=None):
     elif conf['file_list']:
         with open(conf['file_list'], 'r') as f:
             for line in f:
-                images.append(line)
+                if line.strip():
+                    images.append(line.strip())
     elif conf['directory']:
         extension = __extension(conf)
         if not os.path.exists(conf['directory']):
@@ -122,12 +124,13 @@ def __find_images(conf, matching_images=None, matching_conf=None):
                 for filename in filenames:
                     if filename.endswith(extension):
                         images.append(os.path.join(root, filename))
-        else:
-            # find matching labels
-            for m in matching_images:
-                rel_path   = os.path.relpath(m, matching_conf['directory'])
-                label_path = os.path.join(conf['directory'], rel_path)
-                images.append(os.path.splitext(label_path)[0] + extension)
+            # found by walking the directory, so no need to check they exist
+            return sorted(images)
+        # find matching labels
+        for m in matching_images:
+            rel_path   = os.path.relpath(m, matching_conf['directory'])
+            label_path = os.path.join(conf['directory'], rel_path)
+            images.append(os.path.splitext(label_path)[0] + extension)
 
     for img in images:
         if not os.path.exists(img):
@@ -137,10 +140,13 @@ def __find_images(conf, matching_images=None, matching_conf=None):
 def __preprocess_function(image_comp):
     if not image_comp.preprocess.enabled():
         return None
-    f = __scale_factor(image_comp)
-    if f is None:
-        return None
-    return lambda data, _, dummy: data / np.float32(f)
+    stages = image_comp.preprocess.stages()
+    if stages is None:
+        f = __scale_factor(image_comp)
+        if f is None:
+            return None
+        stages = [{'scale' : f}]
+    return Pipeline(stages)
 
 def load_images_labels(images_comp, labels_comp):
     '''
@@ -179,6 +185,8 @@ class ImagePreprocessConfig(DeltaConfigComponent):
         super().__init__()
         self.register_field('enabled', bool, 'enabled', None, None, 'Turn on preprocessing.')
         self.register_field('scale_factor', (float, str), 'scale_factor', None, None, 'Image scale factor.')
+        self.register_field('stages', list, 'stages', None, None,
+                            'List of preprocessing stages, used instead of scale_factor if specified.')
 
 def _validate_paths(paths, base_dir):
     out = []
@@ -251,6 +259,8 @@ class CacheConfig(DeltaConfigComponent):
         super().__init__()
         self.register_field('dir', str, None, None, validate_path, 'Cache directory.')
         self.register_field('limit', int, None, None, validate_positive, 'Number of items to cache.')
+        self.register_field('size_limit_mb', int, None, None, validate_positive,
+                            'Maximum size of the cache in megabytes.')
 
         self._cache_manager = None
 
@@ -266,20 +276,84 @@ class CacheConfig(DeltaConfigComponent):
             cdir = self._config_dict['dir']
             if cdir == 'default':
                 cdir = appdirs.AppDirs('delta', 'nasa').user_cache_dir
-            self._cache_manager = disk_folder_cache.DiskCache(cdir, self._config_dict['limit'])
+            size_limit = self._config_dict['size_limit_mb']
+            if size_limit is not None:
+                size_limit *= 1024 * 1024
+            self._cache_manager = disk_folder_cache.DiskCache(cdir, self._config_dict['limit'], size_limit)
         return self._cache_manager
 
+class StatisticsConfig(DeltaConfigComponent):
+    def __init__(self):
+        super().__init__()
+        self.register_field('index', str, None, None, validate_path, 'File to store image statistics in.')
+        self.register_field('bins', int, 'bins', None, validate_positive, 'Number of histogram bins.')
+
+        self._index = None
+
+    def reset(self):
+        super().reset()
+        self._index = None
+
+    def index(self) -> statistics.StatisticsIndex:
+        """
+        Returns the index of image statistics.
+        """
+        if self._index is None:
+            path = self._config_dict['index']
+            if path == 'default':
+                path = os.path.join(appdirs.AppDirs('delta', 'nasa').user_data_dir, 'statistics.json')
+            self._index = statistics.StatisticsIndex(path, self._config_dict['bins'])
+        return self._index
+
+_ARCHIVE_MODES = ['extract', 'direct', 'auto']
+def _validate_archive_mode(mode, _):
+    if mode not in _ARCHIVE_MODES:
+        raise ValueError('archive_mode must be one of %s, is %s.' % (', '.join(_ARCHIVE_MODES), mode))
+    return mode
+
+_TILE_LOADERS = ['thread', 'process']
+def _validate_tile_loader(loader, _):
+    if loader not in _TILE_LOADERS:
+        raise ValueError('tile_loader must be one of %s, is %s.' % (', '.join(_TILE_LOADERS), loader))
+    return loader
+
 class IOConfig(DeltaConfigComponent):
     def __init__(self):
         super().__init__()
         self.register_field('threads', int, 'threads', '--threads', None, 'Number of threads to use.')
         self.register_field('block_size_mb', int, 'block_size_mb', '--block-size-mb', validate_positive,
                             'Size of an image block to load in memory at once.')
+        self.register_field('strip_size_mb', int, 'strip_size_mb', '--strip-size-mb', validate_positive,
+                            'Size of the strips of blocks to read from images at once when training.')
         self.register_field('interleave_images', int, 'interleave_images', None, validate_positive,
                             'Number of images to interleave at a time when training.')
         self.register_field('tile_ratio', float, 'tile_ratio', '--tile-ratio', validate_positive,
                             'Width to height ratio of blocks to load in images.')
+        self.register_field('archive_mode', str, 'archive_mode', '--archive-mode', _validate_archive_mode,
+                            'Whether to extract images in archives to the cache or read them directly.')
+        self.register_field('tile_loader', str, 'tile_loader', '--tile-loader', _validate_tile_loader,
+                            'Load training tiles in threads or in separate processes.')
+        self.register_field('image_index', str, None, None, validate_path,
+                            'File to store image sizes and metadata in.')
         self.register_component(CacheConfig(), 'cache')
+        self.register_component(StatisticsConfig(), 'statistics')
+
+        self._image_index = None
+
+    def reset(self):
+        super().reset()
+        self._image_index = None
+
+    def image_index(self) -> image_index.ImageIndex:
+        """
+        Returns the index of image metadata.
+        """
+        if self._image_index is None:
+            path = self._config_dict['image_index']
+            if path == 'default':
+                path = os.path.join(appdirs.AppDirs('delta', 'nasa').user_data_dir, 'images.json')
+            self._image_index = image_index.ImageIndex(path)
+        return self._image_index
 
 def register():
     """
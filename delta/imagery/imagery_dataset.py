@@ -18,24 +18,55 @@
 """
 Tools for loading input images into the TensorFlow Dataset class.
 """
+import copy
 import functools
 import math
 import random
 import sys
 
+import numpy as np
 import tensorflow as tf
 
 from delta.config import config
-from delta.imagery import rectangle
+from delta.imagery import profiling, rectangle, sampling, tile_producer
 from delta.imagery.sources import loader
 
+# bits of the cursor for the image index, and for the image and tile without the epoch, see `_tile_generator`
+_IMAGE_MASK = 0xFFFF
+_TILE_CURSOR_MASK = 0xFFFFFFFFFFFF
+
+class _Position: #pylint:disable=too-few-public-methods
+    """Which tiles an `ImageryDataset` loads, and where it is in them."""
+    def __init__(self):
+        # (epoch, image, tile) to start the next iteration from, and the cursor of the most recently batched chunk
+        self.start = None
+        self.last = None
+        # (index, count) of the part of the tiles this process loads, see `ImageryDataset.shard`
+        self.shard = None
+        # regions of the tiles held out for validation, and whether to load only those,
+        # see `ImageryDataset.split_validation`
+        self.held_out = None
+        self.only_held_out = False
+
 class ImageryDataset:
     """Create dataset with all files as described in the provided config file.
     """
 
-    def __init__(self, images, labels, chunk_size, output_size, chunk_stride=1):
+    def __init__(self, images, labels, chunk_size, output_size, chunk_stride=1, #pylint:disable=too-many-arguments
+                 class_balance=None, seed=0, native_input=False, class_samples=0.5):
         """
-        Initialize the dataset based on the specified image and label ImageSets
+        Initialize the dataset based on the specified image and label ImageSets.
+
+        If `class_balance` is given, a list of the target proportion of each label class, tiles are
+        sampled to balance the classes (see `delta.imagery.sampling`) instead of using every tile.
+        `class_samples` is the number of tiles to sample, either an integer or a float fraction
+        of the tiles with labels (by default half of them), drawn again each epoch; sample fewer
+        tiles to read less of the images.
+        `seed` determines the random order of the tiles.
+
+        If `native_input` is true and the images have integer data with preprocessing that is only a
+        scale and offset, chunks are kept in the images' own data type, so they take less memory and
+        bandwidth, and the preprocessing is left to the model (see `input_transform`).
         """
 
         # Record some of the config values
@@ -51,72 +82,403 @@ class ImageryDataset:
             assert len(images) == len(labels)
         self._images = images
         self._labels = labels
+        if class_balance is not None and not labels:
+            raise ValueError('Class balancing requires labels.')
+        self._class_balance = class_balance
+        self._class_samples = class_samples
+        self._seed = seed
+        self._position = _Position()
+        # images opened by tile producer processes
+        self._open_images = {}
+
+        # image sizes and bands come from the index, so we don't have to open every image
+        self._num_bands = self._image_info()[0].num_bands()
+        # (gain, offset) to apply to chunks on the device, if they are in the images' own type
+        self._input_transform = None
+        if native_input:
+            self._use_native_input()
+
+    def _image_info(self):
+        """Returns a list of `delta.imagery.image_index.ImageInfo` for each image."""
+        return config.io.image_index().info(self._images)
 
-        # Load the first image to get the number of bands for the input files.
-        self._num_bands = loader.load_image(images, 0).num_bands()
+    def _use_native_input(self):
+        """
+        Keep the chunks in the images' integer data type, if all the images have the same one
+        and their preprocessing can be done on the device.
+        """
+        dtypes = set(info.dtype() for info in self._image_info())
+        preprocess = self._images.preprocess()
+        if preprocess is None:
+            transform = (np.float32(1.0), np.float32(0.0))
+        else:
+            transform = preprocess.affine() if hasattr(preprocess, 'affine') else None
+        dtype = dtypes.pop() if len(dtypes) == 1 else None
+        if dtype is None or not np.issubdtype(np.dtype(dtype), np.integer) or transform is None:
+            print('Warning: images must have the same integer data type and only scale and offset preprocessing '
+                  'to keep them in their own type, using float32.', file=sys.stderr)
+            return
+        self._data_type = tf.as_dtype(dtype)
+        self._input_transform = transform
+
+    def _load_image(self, is_labels, image_index):
+        """Opens an image or label image, without preprocessing if that is done on the device."""
+        if is_labels:
+            return loader.load_image(self._labels, image_index)
+        if self._input_transform is not None:
+            return loader.load(self._images[image_index], self._images.type())
+        return loader.load_image(self._images, image_index)
 
     def _load_tensor_imagery(self, is_labels, image_index, bbox):
-        """Loads a single image as a tensor."""
-        image = loader.load_image(self._labels if is_labels else self._images, image_index.numpy())
+        """Loads a single image as a tensor, with the axis it is read along x (see `_split_strips`)."""
+        image = self._load_image(is_labels, image_index.numpy())
         w = int(bbox[2])
         h = int(bbox[3])
         rect = rectangle.Rectangle(int(bbox[0]), int(bbox[1]), w, h)
         r = image.read(rect)
-        return r
+        return (r, np.int32(image.X_AXIS))
 
-    def _tile_images(self):
+    def _tile_shape(self):
+        """Returns the (width, height) of the tiles to chunk at once, from `io.block_size_mb` and `io.tile_ratio`."""
+        max_block_bytes = config.io.block_size_mb() * 1024 * 1024
+        # w * h * bands * 4 * chunk * chunk = max_block_bytes
+        tile_width = int(math.sqrt(max_block_bytes / self._num_bands / self._data_type.size /
+                                   config.io.tile_ratio()))
+        tile_height = int(config.io.tile_ratio() * tile_width)
+        if tile_width < self._chunk_size or tile_height < self._chunk_size:
+            raise ValueError('max_block_bytes is too low.')
+        return (tile_width, tile_height)
+
+    def _check_block_size(self):
         max_block_bytes = config.io.block_size_mb() * 1024 * 1024
-        def tile_generator():
-            tgs = []
-            for i in range(len(self._images)):
-                img = loader.load_image(self._images, i)
-                # w * h * bands * 4 * chunk * chunk = max_block_bytes
-                tile_width = int(math.sqrt(max_block_bytes / img.num_bands() / self._data_type.size /
-                                           config.io.tile_ratio()))
-                tile_height = int(config.io.tile_ratio() * tile_width)
-                min_block_size = self._chunk_size ** 2 * config.io.tile_ratio() * img.num_bands() * 4
-                if max_block_bytes < min_block_size:
-                    print('Warning: max_block_bytes=%g MB, but %g MB is recommended (minimum: %g MB)' % ( \
-                          max_block_bytes / 1024 / 1024, min_block_size * 2 / 1024 / 1024, min_block_size / 1024/ 1024),
-                          file=sys.stderr)
-                if tile_width < self._chunk_size or tile_height < self._chunk_size:
-                    raise ValueError('max_block_bytes is too low.')
-                tiles = img.tiles(tile_width, tile_height, min_width=self._chunk_size, min_height=self._chunk_size,
-                                  overlap=self._chunk_size - 1)
-                random.Random(0).shuffle(tiles) # gives consistent random ordering so labels will match
-                tgs.append((i, tiles))
-            while tgs:
-                cur = tgs[:config.io.interleave_images()]
-                tgs = tgs[config.io.interleave_images():]
-                done = False
-                while not done:
-                    done = True
-                    for it in cur:
-                        if not it[1]:
-                            continue
-                        t = it[1].pop(0)
-                        if t:
-                            done = False
-                            yield (it[0], t.min_x, t.min_y, t.max_x, t.max_y)
-                    if done:
-                        break
-        return tf.data.Dataset.from_generator(tile_generator,
-                                              (tf.int32, tf.int32, tf.int32, tf.int32, tf.int32))
+        min_block_size = self._chunk_size ** 2 * config.io.tile_ratio() * self._num_bands * 4
+        if max_block_bytes < min_block_size:
+            print('Warning: max_block_bytes=%g MB, but %g MB is recommended (minimum: %g MB)' % ( \
+                  max_block_bytes / 1024 / 1024, min_block_size * 2 / 1024 / 1024, min_block_size / 1024/ 1024),
+                  file=sys.stderr)
+
+    def _image_tiles(self):
+        """
+        Returns the tiles to load from each image, as a list of (N, 4) arrays
+        (see `delta.imagery.rectangle.to_array`).
+        """
+        self._check_block_size()
+        (tile_width, tile_height) = self._tile_shape()
+        return [img.tile_array(tile_width, tile_height, min_width=self._chunk_size, min_height=self._chunk_size,
+                          overlap=self._chunk_size - 1) for img in self._image_info()]
+
+    def _image_strips(self):
+        """
+        Returns the regions to read from each image, as a list of (N, 4) arrays. Each is a strip of up to
+        `io.strip_size_mb`, a row of tiles side by side, which is read at once and then split into its tiles
+        in memory (see `_strip_tiles`). Neighboring tiles overlap by a chunk so every chunk is loaded, and only
+        the pixels where strips overlap are read twice. With class balancing, tiles are sampled on their own,
+        so each tile is read separately.
+        """
+        if self._class_balance is not None:
+            return self._image_tiles()
+        self._check_block_size()
+        (tile_width, tile_height) = self._tile_shape()
+        overlap = self._chunk_size - 1
+        spacing = tile_width - overlap
+        strip_bytes = config.io.strip_size_mb() * 1024 * 1024
+        count = int((strip_bytes / (tile_height * self._num_bands * self._data_type.size) - overlap) // spacing)
+        strip_width = max(count, 1) * spacing + overlap
+        return [img.tile_array(strip_width, tile_height, min_width=self._chunk_size, min_height=self._chunk_size,
+                          overlap=overlap) for img in self._image_info()]
+
+    def _strip_tiles(self, width):
+        """
+        Returns the (start, width) of the tiles to split a strip `width` pixels wide into, as in `_image_tiles`.
+        """
+        tile_width = self._tile_shape()[0]
+        spacing = tile_width - (self._chunk_size - 1)
+        return [(x, min(tile_width, width - x)) for x in range(0, width, spacing) if width - x >= self._chunk_size]
+
+    def _split_strips(self, ds):
+        """
+        Splits each strip in a dataset of (images..., axis, cursor) into its tiles along x, like
+        `_strip_tiles`, so a tile is chunked at a time. The axis is the `X_AXIS` of the image type
+        the strip was read from: the rows for some types, like `TiffImage`, and the columns for others,
+        like `NumpyImage`.
+        """
+        tile_width = self._tile_shape()[0]
+        spacing = tile_width - (self._chunk_size - 1)
+        def split(*items):
+            (images, axis, cursor) = (items[:-2], tf.ensure_shape(items[-2], ()), items[-1])
+            rows = tf.math.equal(axis, 0)
+            width = tf.shape(images[0])[axis]
+            starts = tf.range(0, width, spacing)
+            starts = tf.boolean_mask(starts, width - starts >= self._chunk_size)
+            def tile(image, x):
+                return tf.cond(rows, lambda: image[x:x + tile_width], lambda: image[:, x:x + tile_width])
+            return tf.data.Dataset.from_tensor_slices(starts).map(
+                lambda x: tuple(tile(image, x) for image in images) + (cursor,))
+        return ds.flat_map(split)
+
+    def read_overhead(self):
+        """
+        Fraction of pixels read more than once in each pass over the images, because the strips
+        read overlap so that every chunk is loaded.
+        """
+        infos = self._image_info()
+        read = sum(int(rectangle.areas(strips).sum()) for strips in self._image_strips())
+        return read / sum(info.width() * info.height() for info in infos) - 1
+
+    def _balanced_tiles(self, image_tiles, start=0, epoch=0):
+        """
+        Sample tiles so the label classes are in the proportions given by class_balance.
+        Only tiles with labels are sampled, and each tile may be sampled more than once.
+        Each epoch draws a different sample, so with `class_samples` less than every tile,
+        all of the tiles are trained on over the epochs.
+        Yields (image index, [min_x, min_y, max_x, max_y]) for each sample from `start` on.
+        """
+        index = config.io.image_index()
+        histograms = [index.tile_histograms(self._labels, i, rectangle.rectangles(tiles), len(self._class_balance))
+                      for (i, tiles) in enumerate(image_tiles)]
+        weights = sampling.balance_weights(np.concatenate(histograms), self._class_balance)
+        all_tiles = [(i, t) for (i, tiles) in enumerate(image_tiles) for t in tiles.tolist()]
+        count = sampling.sample_count(weights, self._class_samples)
+        samples = sampling.sample_tiles(weights, count, seed=[self._seed, epoch])
+        for j in samples[start:]:
+            yield all_tiles[j]
+
+    def _tile_generator(self, start=None, epoch=0):
+        """
+        Yields (image index, min_x, min_y, max_x, max_y, cursor) for each region to load (a strip of
+        tiles, see `_image_strips`) in `epoch`, in order, beginning at the (image index, tile index) `start`.
+        The cursor encodes the epoch, the image index and the position of the strip in that image's strips
+        (or of the tile in the samples, for balanced sampling) as `epoch * 2**48 + image * 2**32 + tile`;
+        see `cursor`.
+        """
+        image_tiles = self._image_strips()
+        if len(image_tiles) > _IMAGE_MASK + 1:
+            raise ValueError('At most %d images are supported.' % (_IMAGE_MASK + 1))
+        (first_image, first_tile) = start if start is not None else (0, 0)
+        base = epoch << 48
+        if self._class_balance is not None:
+            # consistent sampling so labels will match
+            for (j, (i, t)) in enumerate(self._balanced_tiles(image_tiles, first_tile, epoch), first_tile):
+                yield (i, t[0], t[1], t[2], t[3], base + (i << 32) + j)
+            return
+        for (i, tiles) in enumerate(image_tiles):
+            order = list(range(len(tiles)))
+            random.Random(self._seed).shuffle(order) # gives consistent random ordering so labels will match
+            image_tiles[i] = tiles[order].tolist()
+        # take a tile from each of interleave_images images in turn, so the starting point
+        # can be found directly without going through the earlier tiles
+        interleave = config.io.interleave_images()
+        first_group = first_image - first_image % interleave
+        for group in range(first_group, len(image_tiles), interleave):
+            images = range(group, min(group + interleave, len(image_tiles)))
+            first_round = first_tile if group == first_group else 0
+            for r in range(first_round, max(len(image_tiles[i]) for i in images)):
+                for i in images:
+                    if r >= len(image_tiles[i]) or (group == first_group and r == first_round and i < first_image):
+                        continue
+                    t = image_tiles[i][r]
+                    yield (i, t[0], t[1], t[2], t[3], base + (i << 32) + r)
+
+    def _tiles(self):
+        """
+        Returns a function that returns a `_tile_generator` for each epoch in turn. The first generator
+        starts from the cursor given to `set_cursor`, and later ones (for the following epochs) from the start.
+        """
+        state = {'epoch': 0, 'start': None}
+        start = self._position.start
+        if start is not None:
+            state = {'epoch': start[0], 'start': start[1:]}
+        def tiles():
+            (epoch, start) = (state['epoch'], state['start'])
+            state['epoch'] += 1
+            state['start'] = None
+            return profiling.timed_generator('tiles', self._filter_tiles(self._tile_generator(start, epoch)))
+        return tiles
+
+    def _filter_tiles(self, tiles):
+        """
+        Drops the tiles from a `_tile_generator` that are in other shards, or held out for validation.
+        Shards are split by cursor, without the epoch, and tiles are held out by their region.
+        """
+        position = self._position
+        if position.shard is not None:
+            (index, count) = position.shard
+            tiles = (t for t in tiles if (t[5] & _TILE_CURSOR_MASK) % count == index)
+        if position.held_out is not None:
+            tiles = (t for t in tiles if (tuple(t[:5]) in position.held_out) == position.only_held_out)
+        return tiles
+
+    def split_validation(self, chunks):
+        """
+        Holds out the first tiles loaded, enough for about `chunks` chunks, for validation, so they
+        are no longer loaded by this dataset. Returns a copy of the dataset that loads only those tiles.
+        The count is an estimate, since chunks with nodata labels are dropped later.
+        """
+        held_out = set()
+        total = 0
+        for t in self._filter_tiles(self._tile_generator()):
+            if total >= chunks:
+                break
+            held_out.add(tuple(t[:5]))
+            total += ((t[3] - t[1] - self._chunk_size) // self._chunk_stride + 1) * \
+                     ((t[4] - t[2] - self._chunk_size) // self._chunk_stride + 1)
+        validation = copy.copy(self)
+        validation._position = _Position() #pylint:disable=protected-access
+        validation._position.shard = self._position.shard #pylint:disable=protected-access
+        validation._position.held_out = held_out #pylint:disable=protected-access
+        validation._position.only_held_out = True #pylint:disable=protected-access
+        validation._open_images = {} #pylint:disable=protected-access
+        self._position.held_out = held_out
+        return validation
+
+    def _tile_images(self):
+        return tf.data.Dataset.from_generator(self._tiles(),
+                                              (tf.int32, tf.int32, tf.int32, tf.int32, tf.int32, tf.int64))
+
+    def _worker_image(self, is_labels, image_index):
+        """
+        Returns an open image, for use by a tile producer process. Keeps the most
+        recently used images open, since tiles from the same images are loaded together.
+        """
+        key = (is_labels, image_index)
+        if key not in self._open_images:
+            if len(self._open_images) >= 2 * config.io.interleave_images():
+                del self._open_images[next(iter(self._open_images))]
+            self._open_images[key] = self._load_image(is_labels, image_index)
+        return self._open_images[key]
+
+    def _load_tile_pair(self, image_index, x1, y1, x2, y2, cursor): #pylint:disable=too-many-arguments
+        """
+        Loads an image tile and its labels, with the axis the image is read along x and the tile's
+        cursor (see `_split_strips`), in a tile producer process.
+        """
+        rect = rectangle.Rectangle(x1, y1, x2, y2)
+        image = self._worker_image(False, image_index)
+        (axis, cursor) = (np.array(image.X_AXIS, np.int32), np.array(cursor, np.int64))
+        image = image.read(rect).astype(self._data_type.as_numpy_dtype, copy=False)
+        if self._labels is self._images:
+            return (image, axis, cursor)
+        labels = self._worker_image(True, image_index).read(rect).astype(np.uint8, copy=False)
+        return (image, labels, axis, cursor)
+
+    def _chunk_tile(self, image_index, x1, y1, x2, y2, cursor): #pylint:disable=too-many-arguments
+        """
+        Loads a strip and splits each of its tiles into chunks and labels with numpy, like `_chunk_image`
+        and `_reshape_labels`, in a batch producer process. Chunks with nodata labels are dropped.
+        Yields the chunks, labels, and the strip's cursor for each chunk, for each tile.
+        """
+        items = self._load_tile_pair(image_index, x1, y1, x2, y2, cursor)
+        (strip, axis) = (items[:-2], items[-2])
+        for (x, w) in self._strip_tiles(x2 - x1):
+            yield self._chunk_arrays(tuple(a[x:x + w] if axis == 0 else a[:, x:x + w] for a in strip), cursor)
+
+    def _chunk_arrays(self, tile, cursor):
+        """Splits a tile, and its labels if given, into chunks and labels, see `_chunk_tile`."""
+        s = self._chunk_stride
+        with profiling.timed('chunk'):
+            chunks = np.lib.stride_tricks.sliding_window_view(tile[0], (self._chunk_size, self._chunk_size),
+                                                              axis=(0, 1))[::s, ::s]
+            # [M, N, bands, chunk, chunk] -> [chunks, chunk, chunk, bands]
+            chunks = chunks.transpose((0, 1, 3, 4, 2)).reshape((-1, self._chunk_size, self._chunk_size,
+                                                                self._num_bands))
+            cursors = np.full(len(chunks), cursor, np.int64)
+            if len(tile) == 1:
+                return (chunks, chunks, cursors)
+            w = (self._chunk_size - self._output_size) // 2
+            labels = tile[1][w:tile[1].shape[0] - w, w:tile[1].shape[1] - w, 0]
+            labels = np.lib.stride_tricks.sliding_window_view(labels,
+                                                              (self._output_size, self._output_size))[::s, ::s]
+            labels = labels.reshape((-1, self._output_size, self._output_size))
+        nodata = self._labels.nodata_value()
+        if nodata:
+            with profiling.timed('filter'):
+                keep = np.all(labels != nodata, axis=(1, 2))
+                return (chunks[keep], labels[keep], cursors[keep])
+        return (chunks, labels, cursors)
+
+    def batches(self, batch_size):
+        """
+        Returns a dataset of batches of `batch_size` pairs of image chunks and labels.
+        As each batch is taken, `cursor` is updated to where it came from.
+
+        With `io.tile_loader` set to `process`, `io.threads` processes load, preprocess and chunk
+        the tiles and fill fixed size batches in shared memory (see `delta.imagery.tile_producer`),
+        so the training process only copies each batch into a tensor. Otherwise,
+        the same as batching `dataset`.
+        """
+        if config.io.tile_loader() != 'process':
+            return self._cursor_dataset().batch(batch_size).map(self._record_cursor)
+        chunk_shape = (self._chunk_size, self._chunk_size, self._num_bands)
+        (label_shape, label_type) = (chunk_shape, self._data_type)
+        if self._labels is not self._images:
+            (label_shape, label_type) = ((self._output_size, self._output_size), self._label_type)
+        producer = tile_producer.BatchProducer(self._chunk_tile, self._tiles(), config.io.threads(),
+                                               batch_size, [(chunk_shape, self._data_type.as_numpy_dtype),
+                                                            (label_shape, label_type.as_numpy_dtype),
+                                                            ((), np.int64)])
+        ds = tf.data.Dataset.from_generator(producer,
+                                            output_signature=(tf.TensorSpec((None,) + chunk_shape, self._data_type),
+                                                              tf.TensorSpec((None,) + label_shape, label_type),
+                                                              tf.TensorSpec((None,), tf.int64)))
+        # record the cursor after prefetching, when the batch is taken
+        return ds.prefetch(tf.data.experimental.AUTOTUNE).map(self._record_cursor)
+
+    def _record_cursor(self, x, y, cursor):
+        """Records the cursor of the last chunk in a batch, and drops the cursors."""
+        record = tf.numpy_function(self._set_last, [cursor[-1]], tf.int64)
+        with tf.control_dependencies([record]):
+            return (tf.identity(x), y)
+
+    def _set_last(self, cursor):
+        self._position.last = int(cursor)
+        return cursor
+
+    def _producer_dataset(self):
+        """
+        Dataset of (image chunks, label chunks, cursors) for each tile, with strips loaded by a pool
+        of `io.threads` processes (see `delta.imagery.tile_producer`).
+        """
+        max_pixels = max(int(rectangle.areas(strips).max(initial=0)) for strips in self._image_strips())
+        # images of the data type and uint8 labels
+        slot_bytes = max_pixels * (self._num_bands * self._data_type.size + self._label_type.size)
+        producer = tile_producer.TileProducer(self._load_tile_pair, self._tiles(),
+                                              config.io.threads(), slot_bytes)
+        image_spec = tf.TensorSpec([None, None, self._num_bands], self._data_type)
+        axis_spec = tf.TensorSpec((), tf.int32)
+        cursor_spec = tf.TensorSpec((), tf.int64)
+        if self._labels is self._images:
+            ds = tf.data.Dataset.from_generator(producer, output_signature=(image_spec, axis_spec, cursor_spec))
+            ds = self._split_strips(ds)
+            ds = ds.map(lambda x, c: self._with_cursors(c, self._chunk_image(x), self._chunk_image(x)))
+        else:
+            label_spec = tf.TensorSpec([None, None, None], self._label_type)
+            ds = tf.data.Dataset.from_generator(producer, output_signature=(image_spec, label_spec, axis_spec,
+                                                                            cursor_spec))
+            ds = self._split_strips(ds)
+            ds = ds.map(lambda x, y, c: self._with_cursors(c, self._chunk_image(x), self._reshape_labels(y)),
+                        num_parallel_calls=config.io.threads())
+        return ds.prefetch(tf.data.experimental.AUTOTUNE).unbatch()
+
+    @staticmethod
+    def _with_cursors(cursor, *items):
+        """Returns the items (chunks and labels) with a copy of the tile's cursor for each chunk."""
+        return items + (tf.fill(tf.shape(items[0])[:1], cursor),)
 
     def _load_images(self, is_labels, data_type):
         """
-        Loads a list of images as tensors.
+        Loads a list of images as tensors, paired with the cursor of each tile. Strips are read
+        at once and then split into tiles.
         If label_list is specified, load labels instead. The corresponding image files are still required however.
         """
         ds_input = self._tile_images()
-        def load_tile(image_index, x1, y1, x2, y2):
-            img = tf.py_function(functools.partial(self._load_tensor_imagery,
-                                                   is_labels),
-                                 [image_index, [x1, y1, x2, y2]], data_type)
-            return img
+        def load_tile(image_index, x1, y1, x2, y2, cursor): #pylint:disable=too-many-arguments
+            (img, axis) = tf.py_function(functools.partial(self._load_tensor_imagery,
+                                                           is_labels),
+                                         [image_index, [x1, y1, x2, y2]], [data_type, tf.int32])
+            return (img, axis, cursor)
         ret = ds_input.map(load_tile, num_parallel_calls=config.io.threads())
 
-        return ret.prefetch(tf.data.experimental.AUTOTUNE)
+        return self._split_strips(ret.prefetch(tf.data.experimental.AUTOTUNE))
 
     def _chunk_image(self, image):
         """Split up a tensor image into tensor chunks"""
@@ -143,46 +505,111 @@ class ImageryDataset:
                                           padding='VALID')
         return tf.reshape(labels, [-1, self._output_size, self._output_size])
 
-    def data(self):
+    def _cursor_data(self):
         """
-        Unbatched dataset of image chunks.
+        Unbatched dataset of image chunks and the cursor of the tile each came from.
         """
         ret = self._load_images(False, self._data_type)
-        ret = ret.map(self._chunk_image, num_parallel_calls=config.io.threads())
+        ret = ret.map(lambda img, c: self._with_cursors(c, self._chunk_image(img)),
+                      num_parallel_calls=config.io.threads())
         return ret.unbatch()
 
+    def data(self):
+        """
+        Unbatched dataset of image chunks.
+        """
+        return self._cursor_data().map(lambda x, c: x)
+
     def labels(self):
         """
         Unbatched dataset of labels.
         """
         label_set = self._load_images(True, self._label_type)
-        label_set = label_set.map(self._reshape_labels)
+        label_set = label_set.map(lambda img, c: self._reshape_labels(img))
 
         return label_set.unbatch()
 
-    def dataset(self):
+    def _cursor_dataset(self):
         """
-        Return the underlying TensorFlow dataset object that this class creates.
+        Unbatched dataset of (image chunk, label, cursor).
         """
-
-        # Pair the data and labels in our dataset
-        ds = tf.data.Dataset.zip((self.data(), self.labels()))
+        if config.io.tile_loader() == 'process':
+            ds = self._producer_dataset()
+        else:
+            ds = tf.data.Dataset.zip((self._cursor_data(), self.labels()))
+            ds = ds.map(lambda xc, y: (xc[0], y, xc[1]))
         # ignore labels with no data
         if self._labels.nodata_value():
-            ds = ds.filter(lambda x, y: tf.math.not_equal(y, self._labels.nodata_value()))
+            ds = ds.filter(lambda x, y, c: tf.math.not_equal(y, self._labels.nodata_value()))
 
         return ds
 
+    def dataset(self):
+        """
+        Return the underlying TensorFlow dataset object that this class creates.
+        """
+        return self._cursor_dataset().map(lambda x, y, c: (x, y))
+
+    def cursor(self):
+        """
+        Returns the position in the dataset of the most recent batch taken from `batches`, as a dict
+        of the seed, the epoch, the image index and the tile index in that image's shuffled tiles (or in the
+        epoch's samples, with class balancing). Returns None if no batches have been taken.
+
+        Batches are recorded as they are taken from the dataset, so a few batches prefetched
+        by the consumer may not have been used yet.
+        """
+        last = self._position.last
+        if last is None:
+            return None
+        return {'seed': self._seed, 'epoch': last >> 48, 'image': (last >> 32) & _IMAGE_MASK, 'tile': last & 0xFFFFFFFF}
+
+    def set_cursor(self, cursor):
+        """
+        Continue from the tile given by a dict from `cursor`, without loading any of the
+        tiles before it. That tile is loaded again from its beginning. The first iteration of datasets
+        created afterwards starts from the cursor, in the cursor's epoch, and later iterations (for the
+        following epochs) from the beginning.
+        """
+        self._seed = cursor['seed']
+        self._position.start = (cursor.get('epoch', 0), cursor['image'], cursor['tile'])
+        self._position.last = None
+
+    def shard(self, index, count):
+        """
+        Only load part `index` of `count` disjoint parts of the tiles, for one of `count` training
+        workers. Tiles are split by their cursor, so a cursor continues each part from the same place.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError('Invalid shard %d of %d.' % (index, count))
+        self._position.shard = (index, count) if count > 1 else None
+
     def num_bands(self):
         """
         Return the number of bands in each image of the data set.
         """
         return self._num_bands
 
+    def data_type(self):
+        """
+        TensorFlow data type of the image chunks.
+        """
+        return self._data_type
+
+    def input_transform(self):
+        """
+        If the image chunks are in the images' own data type (see `native_input`), returns (gain, offset),
+        each a scalar or an array with a value for each band, which the model must apply to the chunks after
+        converting them to floating point to preprocess them. Otherwise None.
+        """
+        return self._input_transform
+
     def chunk_size(self):
         """
         Size of chunks used for inputs.
         """
+        return self._chunk_size
+
     def output_shape(self):
         """
         Output size of blocks of labels.
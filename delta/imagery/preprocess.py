@@ -0,0 +1,282 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Vectorized preprocessing kernels applied to image data as it is read.
+
+All functions take data in [row, col, band] order, or [row, col] if a single
+band was read, along with `bands`, the image bands present in data (as passed to
+a `delta.imagery.sources.delta_image.DeltaImage` preprocessing callback).
+Per-band parameters are given for all bands of the image and are selected with `bands`.
+"""
+import json
+
+import numpy as np
+
+from delta.imagery import statistics
+
+def band_values(values, bands, dtype=np.float32):
+    """
+    Select the values for `bands` from a per-band sequence of `values`, as an array
+    which broadcasts against data read for those bands. Missing (None) values are NaN.
+    """
+    values = np.array([np.nan if v is None else v for v in values], dtype=dtype)
+    return values[bands]
+
+def float_buffer(data, dtype=np.float32):
+    """
+    Returns data as a floating point array we can modify: data itself if it
+    already is one, otherwise a single converted copy.
+    """
+    if data.dtype == dtype and data.flags.writeable:
+        return data
+    return data.astype(dtype)
+
+def apply_gain_offset(data, bands, gain, offset=None, nodata=0.0, valid=None):
+    """
+    Compute `data * gain + offset` with per-band gain and optional offset, in one pass and
+    in place if data is already float32. Pixels which are not `valid` (by default,
+    those <= 0) are set to `nodata`.
+    """
+    if valid is None:
+        valid = data > 0
+    out = float_buffer(data)
+    np.multiply(out, band_values(gain, bands), out=out)
+    if offset is not None:
+        np.add(out, band_values(offset, bands), out=out)
+    np.copyto(out, np.float32(nodata), where=~valid)
+    return out
+
+def apply_brightness_temperature(data, bands, k1, k2, nodata=0.0):
+    """
+    Convert radiance to brightness temperature, `k2 / log(k1 / data + 1)`, in place
+    for the bands with k1 and k2 constants (usually only thermal bands). Other bands
+    are unchanged. Pixels <= 0 are set to `nodata`.
+    """
+    k1 = np.atleast_1d(band_values(k1, bands))
+    k2 = np.atleast_1d(band_values(k2, bands))
+    thermal = np.flatnonzero(~np.isnan(k1))
+    out = float_buffer(data)
+    if thermal.size == 0:
+        return out
+    if out.ndim == 2: # single band
+        t = out
+    else:
+        t = out[:, :, thermal]
+    valid = t > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(k1[thermal], t, out=t)
+        np.log1p(t, out=t)
+        np.divide(k2[thermal], t, out=t)
+    np.copyto(t, np.float32(nodata), where=~valid)
+    if out.ndim != 2:
+        out[:, :, thermal] = t
+    return out
+
+def _select(values, bands):
+    # scalars apply to all bands
+    if values.ndim == 0:
+        return values
+    return values[bands]
+
+def _stage(stage):
+    if not isinstance(stage, dict) or len(stage) != 1:
+        raise ValueError('Preprocessing stage must be a dictionary with a single key: %s' % (stage,))
+    (name, args) = next(iter(stage.items()))
+    if name not in _STAGES:
+        raise ValueError('Unknown preprocessing stage %s, must be one of %s.' % (name, ', '.join(_STAGES)))
+    return (name, args)
+
+_STAGES = ['toa', 'normalize', 'scale', 'offset', 'clip']
+# stages which depend on the image, and so need the pipeline to be bound
+_BOUND_STAGES = ['toa', 'normalize']
+_NORMALIZE_METHODS = ['standard', 'minmax', 'percentile']
+
+class Pipeline:
+    """
+    A sequence of preprocessing stages, applied to image data as it is read.
+
+    Stages are specified as a list of single entry dictionaries, as in the YAML config files:
+
+     * `toa`: Top of atmosphere correction, for images which support it (landsat and worldview).
+       Takes the argument `reflectance`, which is false to compute radiance.
+     * `scale`: Divide by a value, or a list with a value for each band.
+     * `offset`: Add a value, or a list with a value for each band.
+     * `clip`: Clip to the range `[min, max]`. Either may be null, and if both are it does nothing.
+     * `normalize`: Normalize each band with the image's statistics (see `delta.imagery.statistics`).
+       Takes the arguments `method`: `standard` (the default) for zero mean and unit variance,
+       `minmax` to scale the range of the band to `[0, 1]`, or `percentile` to scale the range
+       between `percentiles` (default `[2, 98]`) to `[0, 1]`; and `approximate`, to estimate
+       the statistics from a reduced resolution image. Must be the first stage, since statistics
+       are of the raw image data.
+
+    Consecutive linear stages are combined into a single multiply and add, and all stages
+    operate in place on one floating point buffer, so data is processed in a single pass.
+    Pipelines with stages that depend on the image, like `toa` and `normalize`, must be bound to an image with
+    `bind` before use. Pipelines can be pickled, and `key` identifies the stages for caching.
+
+    A `Pipeline` is a valid callback for `delta.imagery.sources.delta_image.DeltaImage.set_preprocess`.
+    """
+    def __init__(self, stages, nodata=0.0):
+        """
+        Creates a pipeline from a list of `stages`. Pixels that an image's `toa` correction
+        marks as invalid are set to `nodata`.
+        """
+        self._stages = [dict([_stage(s)]) for s in stages]
+        self._nodata = nodata
+        self._ops = None
+        self._mask = False
+        if not any(name in _BOUND_STAGES for (name, _) in self.stages()):
+            (self._ops, self._mask) = self._compile(None)
+
+    def stages(self):
+        """
+        Returns a list of (stage name, arguments).
+        """
+        return [next(iter(s.items())) for s in self._stages]
+
+    def key(self):
+        """
+        Returns a string uniquely identifying the stages in this pipeline, suitable to use as a cache key.
+        """
+        return json.dumps({'stages' : self._stages, 'nodata' : self._nodata}, sort_keys=True)
+
+    def __eq__(self, other):
+        return isinstance(other, Pipeline) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'Pipeline(%s)' % (self._stages,)
+
+    def affine(self):
+        """
+        If the pipeline is only a multiply and add (i.e., `scale` and `offset` stages), which
+        don't depend on the image, returns (gain, offset), each a scalar or per band array. Otherwise None.
+        """
+        if self._ops is None or self._mask or len(self._ops) > 1:
+            return None
+        if not self._ops:
+            return (np.float32(1.0), np.float32(0.0))
+        if self._ops[0][0] != 'affine':
+            return None
+        return self._ops[0][1:]
+
+    def bind(self, image):
+        """
+        Returns a copy of this pipeline specialized to the given image.
+        """
+        p = Pipeline(self._stages, self._nodata)
+        (p._ops, p._mask) = p._compile(image) #pylint:disable=protected-access
+        return p
+
+    @staticmethod
+    def _toa_parameters(image, args):
+        if image is None:
+            raise ValueError('Pipeline with toa stage must be bound to an image.')
+        if not hasattr(image, 'toa_parameters'):
+            raise ValueError('Image type %s does not support toa correction.' % (type(image).__name__))
+        return image.toa_parameters((args or {}).get('reflectance', False))
+
+    @staticmethod
+    def _normalize_parameters(image, args):
+        """
+        Returns (gain, offset) per band to normalize the image.
+        """
+        if image is None:
+            raise ValueError('Pipeline with normalize stage must be bound to an image.')
+        args = args or {}
+        method = args.get('method', 'standard')
+        if method not in _NORMALIZE_METHODS:
+            raise ValueError('Unknown normalization method %s, must be one of %s.' %
+                             (method, ', '.join(_NORMALIZE_METHODS)))
+        stats = statistics.image_statistics(image, approximate=args.get('approximate', False))
+        if method == 'standard':
+            (center, scale) = (stats.mean(), stats.std())
+        elif method == 'minmax':
+            (center, scale) = (stats.minimum(), stats.maximum() - stats.minimum())
+        else:
+            (low, high) = args.get('percentiles', [2, 98])
+            center = stats.percentile(low)
+            scale = stats.percentile(high) - center
+        scale = np.where(scale > 0, scale, 1.0)
+        return ((1.0 / scale).astype(np.float32), (-center / scale).astype(np.float32))
+
+    def _compile(self, image):
+        """
+        Convert the stages to a list of operations, combining consecutive linear stages.
+        Returns (operations, whether to mask invalid input pixels).
+        """
+        ops = []
+        mask = False
+        linear = None # (gain, offset) of the current linear operation
+        for (name, args) in self.stages():
+            if name == 'clip':
+                (low, high) = args
+                if low is None and high is None:
+                    continue
+                if linear is not None:
+                    ops.append(('affine',) + linear)
+                    linear = None
+                ops.append(('clip', low, high))
+                continue
+
+            k = None
+            if name == 'normalize':
+                if ops or linear is not None:
+                    raise ValueError('normalize must be the first preprocessing stage.')
+                (g, o) = self._normalize_parameters(image, args)
+            elif name == 'scale':
+                (g, o) = (1.0 / np.asarray(args, dtype=np.float32), np.float32(0.0))
+            elif name == 'offset':
+                (g, o) = (np.float32(1.0), np.asarray(args, dtype=np.float32))
+            else: # toa
+                params = self._toa_parameters(image, args)
+                g = band_values(params['gain'], slice(None))
+                o = np.float32(0.0) if params.get('offset') is None else band_values(params['offset'], slice(None))
+                if params.get('k1') is not None:
+                    k = (band_values(params['k1'], slice(None)), band_values(params['k2'], slice(None)))
+                mask = True
+            linear = (g, o) if linear is None else (linear[0] * g, linear[1] * g + o)
+            # temperature conversion is non-linear, so can't be combined with later stages
+            if k is not None:
+                ops.append(('affine',) + linear)
+                ops.append(('temperature',) + k)
+                linear = None
+        if linear is not None:
+            ops.append(('affine',) + linear)
+        return (ops, mask)
+
+    def __call__(self, data, _, bands):
+        if self._ops is None:
+            raise ValueError('Pipeline with %s stage must be bound to an image.' %
+                             (' or '.join(_BOUND_STAGES)))
+        valid = data > 0 if self._mask else None
+        out = float_buffer(data)
+        for op in self._ops:
+            if op[0] == 'affine':
+                np.multiply(out, _select(op[1], bands), out=out)
+                if op[2].any():
+                    np.add(out, _select(op[2], bands), out=out)
+            elif op[0] == 'temperature':
+                out = apply_brightness_temperature(out, bands, op[1], op[2], self._nodata)
+            else:
+                np.clip(out, op[1], op[2], out=out)
+        if valid is not None:
+            np.copyto(out, np.float32(self._nodata), where=~valid)
+        return out
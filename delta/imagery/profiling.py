@@ -0,0 +1,96 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time the stages of loading training data, to find what limits training throughput.
+
+Timing is off until `enable` is called, and then costs a clock read and a locked
+add for each tile. Times are kept in shared memory, so stages run in forked tile
+producer processes (see `delta.imagery.tile_producer`) are counted as well.
+
+Only stages run in Python are timed. With `io.tile_loader` set to `thread`, chunking,
+filtering and batching are TensorFlow operations, which show up in a `tf.profiler` trace instead.
+"""
+
+import contextlib
+import multiprocessing
+import time
+
+STAGES = ['tiles', 'read', 'preprocess', 'chunk', 'filter', 'batch']
+
+# [seconds, count] for each stage, or None if disabled
+_times = None
+
+def enable():
+    """Start timing, from zero."""
+    global _times #pylint:disable=global-statement
+    _times = multiprocessing.get_context('fork').Array('d', 2 * len(STAGES))
+
+def disable():
+    """Stop timing."""
+    global _times #pylint:disable=global-statement
+    _times = None
+
+def enabled():
+    return _times is not None
+
+def add(stage, seconds, count=1):
+    """Adds `seconds` spent in `stage`, for `count` items."""
+    values = _times
+    if values is None:
+        return
+    i = 2 * STAGES.index(stage)
+    with values.get_lock():
+        values[i] += seconds
+        values[i + 1] += count
+
+@contextlib.contextmanager
+def timed(stage):
+    """Context manager adding the time spent inside it to `stage`."""
+    if _times is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, time.perf_counter() - start)
+
+def timed_generator(stage, generator):
+    """Yields the items of `generator`, adding the time to generate each to `stage`."""
+    if _times is None:
+        yield from generator
+        return
+    generator = iter(generator)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(generator)
+        except StopIteration:
+            return
+        add(stage, time.perf_counter() - start)
+        yield item
+
+def times():
+    """
+    Returns a dict of (seconds, count) for each stage timed so far.
+    """
+    if _times is None:
+        return {}
+    with _times.get_lock():
+        values = list(_times)
+    return {s : (values[2 * i], int(values[2 * i + 1])) for (i, s) in enumerate(STAGES) if values[2 * i + 1]}
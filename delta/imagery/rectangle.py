@@ -17,13 +17,20 @@
 
 """
 Simple rectangle class, useful for dealing with ROIs and tiles.
+
+Large sets of tiles can also be handled as arrays of shape (N, 4), where each row
+is [min_x, min_y, max_x, max_y], to avoid creating a Python object for each tile.
 """
 import math
 
+import numpy as np
+
 class Rectangle:
     """Simple rectangle class for ROIs. Max values are NON-INCLUSIVE.
        When using it, stay consistent with float or integer values.
     """
+    __slots__ = ('min_x', 'min_y', 'max_x', 'max_y')
+
     def __init__(self, min_x, min_y, max_x=0, max_y=0,
                  width=0, height=0):
         """Specify width/height by name to use those instead of max_x/max_y."""
@@ -157,28 +164,72 @@ class Rectangle:
         overlap_area = self.get_intersection(other_rect)
         return overlap_area.has_area()
 
-    def make_tile_rois(self, tile_width, tile_height, min_width=0, min_height=0,
-                       include_partials=True, overlap_amount=0):
-        '''Return a list of tiles encompassing the entire area of this Rectangle'''
+    def tile_array(self, tile_width, tile_height, min_width=0, min_height=0,
+                   include_partials=True, overlap_amount=0):
+        '''Returns the tiles of `make_tile_rois`, in the same order, as an (N, 4) array (see `to_array`)'''
 
         tile_spacing_x = tile_width  - overlap_amount
         tile_spacing_y = tile_height - overlap_amount
         num_tiles = (int(math.ceil(self.width()  / tile_spacing_x )),
                      int(math.ceil(self.height() / tile_spacing_y)))
-        output_tiles = []
-        for c in range(0, num_tiles[0]):
-            for r in range(0, num_tiles[1]):
-
-                tile = Rectangle(self.min_x + c*tile_spacing_x,
-                                 self.min_y + r*tile_spacing_y,
-                                 width=tile_width, height=tile_height)
-
-                if include_partials: # Crop the tile to the valid area and use it
-                    tile = tile.get_intersection(self)
-                    if tile.width() < min_width or tile.height() < min_height:
-                        continue
-                    output_tiles.append(tile)
-                else: # Only use it if the uncropped tile fits entirely in this Rectangle
-                    if self.contains_rect(tile):
-                        output_tiles.append(tile)
-        return output_tiles
+        # ordered by column, then row
+        min_x = np.repeat(self.min_x + np.arange(num_tiles[0]) * tile_spacing_x, num_tiles[1])
+        min_y = np.tile(self.min_y + np.arange(num_tiles[1]) * tile_spacing_y, num_tiles[0])
+        tiles = np.stack([min_x, min_y, min_x + tile_width, min_y + tile_height], axis=1)
+        if include_partials: # Crop the tiles to the valid area and use them
+            tiles = intersect(tiles, self)
+            keep = (tiles[:, 2] - tiles[:, 0] >= min_width) & (tiles[:, 3] - tiles[:, 1] >= min_height)
+        else: # Only use the uncropped tiles that fit entirely in this Rectangle
+            keep = (tiles[:, 2] <= self.max_x) & (tiles[:, 3] <= self.max_y)
+        return tiles[keep]
+
+    def make_tile_rois(self, tile_width, tile_height, min_width=0, min_height=0,
+                       include_partials=True, overlap_amount=0):
+        '''Return a list of tiles encompassing the entire area of this Rectangle'''
+        return rectangles(self.tile_array(tile_width, tile_height, min_width, min_height,
+                                          include_partials, overlap_amount))
+
+def to_array(rects):
+    '''Returns an (N, 4) array of [min_x, min_y, max_x, max_y] for each Rectangle in `rects`'''
+    return np.array([(r.min_x, r.min_y, r.max_x, r.max_y) for r in rects]).reshape((-1, 4))
+
+def rectangles(array):
+    '''Returns a list of Rectangles for each row of an (N, 4) array from `to_array`'''
+    return [Rectangle(*r) for r in np.asarray(array).tolist()]
+
+def intersect(array, rect):
+    '''Returns the overlap of each rectangle in an (N, 4) array with the Rectangle `rect`, like `get_intersection`'''
+    array = np.asarray(array)
+    return np.stack([np.maximum(array[:, 0], rect.min_x), np.maximum(array[:, 1], rect.min_y),
+                     np.minimum(array[:, 2], rect.max_x), np.minimum(array[:, 3], rect.max_y)], axis=1)
+
+def areas(array):
+    '''Returns the valid area of each rectangle in an (N, 4) array, like `Rectangle.area`'''
+    array = np.asarray(array)
+    return np.maximum(array[:, 2] - array[:, 0], 0) * np.maximum(array[:, 3] - array[:, 1], 0)
+
+def block_ranges(array, block_width, block_height):
+    '''
+    Returns an (N, 4) array of the first column and row, and one past the last column and row, of the
+    blocks of size `block_width` by `block_height`, starting at the origin, that each rectangle in an
+    (N, 4) array touches.
+    '''
+    array = np.asarray(array)
+    return np.stack([array[:, 0] // block_width, array[:, 1] // block_height,
+                     -(-array[:, 2] // block_width), -(-array[:, 3] // block_height)], axis=1)
+
+def group_by(keys):
+    '''
+    Groups the rows of an (N, K) array `keys` that are equal, in one pass. Returns a list of
+    (key, indices of the rows) for each group, in order of the first row of each group.
+    '''
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return []
+    (unique, first, inverse) = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # indices sorted by group, in their original order within each group
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1]
+    groups = np.split(order, bounds)
+    return [(tuple(unique[g].tolist()), groups[g]) for g in np.argsort(first, kind='stable')]
@@ -0,0 +1,88 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Class-balanced sampling of image tiles, using the histogram of label classes in each tile.
+"""
+import numpy as np
+
+def tile_histograms(image, tiles, num_classes):
+    """
+    Returns an array of shape (tiles, num_classes) with the number of pixels of each class
+    in each tile of the label image. Values outside `[0, num_classes)`, such as nodata,
+    are not counted.
+    """
+    result = np.zeros((len(tiles), num_classes), dtype=np.int64)
+    for (i, t) in enumerate(tiles):
+        data = image.read(t).ravel()
+        data = data[(data >= 0) & (data < num_classes)].astype(np.int64)
+        result[i] = np.bincount(data, minlength=num_classes)
+    return result
+
+def balance_weights(histograms, target, iterations=50):
+    """
+    Find the probabilities with which to sample each tile so that the expected fraction of
+    pixels of each class is as close as possible to `target`, a list of proportions for each class.
+
+    `histograms` is an array of shape (tiles, classes) with the number of pixels
+    of each class in each tile. Probabilities are found by iterative proportional fitting:
+    tiles are reweighted according to how much their classes are under or over represented.
+    Tiles without any labeled pixels are never sampled.
+    """
+    histograms = np.asarray(histograms, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    if histograms.ndim != 2 or histograms.shape[1] != len(target):
+        raise ValueError('Expected %d classes in tile histograms.' % (len(target)))
+    if np.any(target < 0) or target.sum() <= 0:
+        raise ValueError('Class proportions must be non-negative and not all zero.')
+    target = target / target.sum()
+
+    pixels = histograms.sum(axis=1)
+    labeled = pixels > 0
+    if not np.any(labeled):
+        raise ValueError('No labeled pixels in any tile.')
+    fractions = np.zeros_like(histograms)
+    fractions[labeled] = histograms[labeled] / pixels[labeled, np.newaxis]
+    # classes which are not present can't be balanced
+    present = histograms.sum(axis=0) > 0
+
+    weights = labeled.astype(np.float64)
+    for _ in range(iterations):
+        expected = weights @ histograms
+        expected /= expected.sum()
+        ratio = np.ones_like(target)
+        ratio[present] = target[present] / np.maximum(expected[present], 1e-12)
+        weights *= fractions @ ratio
+        weights /= weights.sum()
+    return weights
+
+def sample_count(weights, samples):
+    """
+    Returns the number of tiles to sample: `samples` if it is an integer, otherwise
+    that fraction of the tiles with nonzero `weights`, and at least one.
+    """
+    if isinstance(samples, int):
+        return samples
+    return max(1, int(round(samples * np.count_nonzero(weights))))
+
+def sample_tiles(weights, count, seed=0):
+    """
+    Returns `count` tile indices drawn with replacement according to `weights`, in a
+    consistent random order for the given `seed`.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.choice(len(weights), size=count, p=weights / np.sum(weights))
@@ -0,0 +1,210 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Save the chunks and labels of an `delta.imagery.imagery_dataset.ImageryDataset` to
+shuffled, compressed TFRecord shards, and read them back for training.
+
+Reading shards skips loading, preprocessing and chunking the images, so
+repeated training runs on the same data are much faster.
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from delta.config import config
+from delta.imagery.imagery_config import ImageSet
+
+_INDEX_FILE = 'index.json'
+_COMPRESSION = 'GZIP'
+
+def _example(image, label):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'image' : tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        'label' : tf.train.Feature(bytes_list=tf.train.BytesList(value=[label.tobytes()]))})).SerializeToString()
+
+class _ShardWriter:
+    """Writes records to one shard, shuffling them in a buffer first."""
+    def __init__(self, path, buffer_size, rng):
+        self._writer = tf.io.TFRecordWriter(path, options=tf.io.TFRecordOptions(compression_type=_COMPRESSION))
+        self._buffer = []
+        self._buffer_size = buffer_size
+        self._rng = rng
+        self.count = 0
+
+    def add(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        for i in self._rng.permutation(len(self._buffer)):
+            self._writer.write(self._buffer[i])
+        self.count += len(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+def write_shards(ids, output_dir, num_shards=16, shuffle_buffer=1000, seed=0, batch_size=1024):
+    """
+    Save the chunks and labels of the dataset `ids` to `num_shards` files in `output_dir`, along with an index.
+
+    Each chunk is written to a random shard, and the chunks in each shard are shuffled in groups
+    of `shuffle_buffer`. Returns the number of chunks written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    names = ['shard-%05d.tfrecord.gz' % (i) for i in range(num_shards)]
+    writers = [_ShardWriter(os.path.join(output_dir, n), shuffle_buffer, rng) for n in names]
+    shapes = None
+    try:
+        for (images, labels) in ids.batches(batch_size).as_numpy_iterator():
+            if shapes is None:
+                shapes = {'image_shape' : images.shape[1:], 'image_dtype' : images.dtype.name,
+                          'label_shape' : labels.shape[1:], 'label_dtype' : labels.dtype.name}
+            for (i, s) in enumerate(rng.integers(num_shards, size=len(images))):
+                writers[s].add(_example(images[i], labels[i]))
+    finally:
+        for w in writers:
+            w.close()
+    if shapes is None:
+        raise ValueError('Dataset is empty.')
+
+    images = ids.image_set()
+    index = {'chunk_size' : ids.chunk_size(), 'output_shape' : ids.output_shape(),
+             'num_bands' : ids.num_bands(), 'count' : sum(w.count for w in writers),
+             'shards' : [{'file' : n, 'count' : w.count} for (n, w) in zip(names, writers)],
+             'images' : {'type' : images.type(), 'files' : list(images), 'preprocess' : repr(images.preprocess())}}
+    index.update({k : list(v) if isinstance(v, tuple) else v for (k, v) in shapes.items()})
+    with open(os.path.join(output_dir, _INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index['count']
+
+class ShardDataset:
+    """
+    Dataset of chunks and labels read from shards saved by `write_shards`. Provides
+    the same interface as `delta.imagery.imagery_dataset.ImageryDataset` for training.
+    """
+    def __init__(self, shard_dir):
+        """
+        Reads the shards in `shard_dir`.
+        """
+        self._dir = shard_dir
+        path = os.path.join(shard_dir, _INDEX_FILE)
+        if not os.path.exists(path):
+            raise ValueError('No shard index found in %s.' % (shard_dir))
+        with open(path, 'r') as f:
+            self._index = json.load(f)
+        self._shard = (0, 1)
+
+    def __len__(self):
+        return self._index['count']
+
+    def _files(self):
+        files = [os.path.join(self._dir, s['file']) for s in self._index['shards'] if s['count'] > 0]
+        (index, count) = self._shard
+        return files[index::count]
+
+    def shard(self, index, count):
+        """
+        Only read part `index` of `count` disjoint parts of the shard files, for one of `count` training workers.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError('Invalid shard %d of %d.' % (index, count))
+        files = len([s for s in self._index['shards'] if s['count'] > 0])
+        if count > files:
+            raise ValueError('Only %d shard files for %d workers.' % (files, count))
+        self._shard = (index, count)
+
+    def _records(self):
+        """Dataset of serialized records, reading the shards in parallel in a random order."""
+        files = self._files()
+        ds = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files))
+        return ds.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=_COMPRESSION),
+                             cycle_length=min(len(files), max(config.io.threads(), 1)),
+                             num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=False)
+
+    def _parse(self, records):
+        """Decode a batch of records to (images, labels)."""
+        features = tf.io.parse_example(records, {'image' : tf.io.FixedLenFeature([], tf.string),
+                                                 'label' : tf.io.FixedLenFeature([], tf.string)})
+        images = tf.io.decode_raw(features['image'], tf.as_dtype(self._index['image_dtype']))
+        labels = tf.io.decode_raw(features['label'], tf.as_dtype(self._index['label_dtype']))
+        return (tf.reshape(images, [-1] + self._index['image_shape']),
+                tf.reshape(labels, [-1] + self._index['label_shape']))
+
+    def batches(self, batch_size):
+        """
+        Returns a dataset of batches of `batch_size` pairs of image chunks and labels.
+        """
+        ds = self._records().batch(batch_size)
+        ds = ds.map(self._parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return ds.prefetch(tf.data.experimental.AUTOTUNE)
+
+    def dataset(self):
+        """
+        Unbatched dataset of (image chunk, label) pairs.
+        """
+        return self.batches(256).unbatch()
+
+    def num_bands(self):
+        """
+        Return the number of bands in each image of the data set.
+        """
+        return self._index['num_bands']
+
+    def data_type(self):
+        """
+        TensorFlow data type of the image chunks.
+        """
+        return tf.as_dtype(self._index['image_dtype'])
+
+    def input_transform(self): #pylint:disable=no-self-use
+        """
+        Chunks are stored already preprocessed.
+        """
+        return None
+
+    def chunk_size(self):
+        """
+        Size of chunks used for inputs.
+        """
+        return self._index['chunk_size']
+
+    def output_shape(self):
+        """
+        Output size of blocks of labels.
+        """
+        return tuple(self._index['output_shape'])
+
+    def image_set(self):
+        """
+        Returns the set of images the shards were made from. The preprocessing
+        function is only a description.
+        """
+        images = self._index['images']
+        return ImageSet(images['files'], images['type'], images['preprocess'])
+
+    def label_set(self): #pylint:disable=no-self-use
+        """
+        Label images are not stored with the shards.
+        """
+        return None
@@ -20,20 +20,26 @@ Base class for loading images.
 """
 
 from abc import ABC, abstractmethod
+import collections
 import concurrent.futures
-import copy
-import functools
+import itertools
 from typing import Callable, Iterator, List, Tuple
 
 import numpy as np
 
-from delta.imagery import rectangle, utilities
+from delta.imagery import profiling, rectangle, utilities
+
+# number of regions roi_generator reads ahead of the ROIs it yields
+_READ_AHEAD = 2
 
 class DeltaImage(ABC):
     """
     Base class used for wrapping input images in a way that they can be passed
     to Tensorflow dataset objects.
     """
+    # axis of the arrays returned by `read` along x, the image's width
+    X_AXIS = 1
+
     def __init__(self):
         self.__preprocess_function = None
 
@@ -55,13 +61,15 @@ class DeltaImage(ABC):
                                  (roi.min_x, roi.min_y, roi.max_x, roi.max_y, self.width(), self.height()))
         if bands is None:
             bands = range(self.num_bands())
-        if isinstance(bands, int):
-            result = self._read(roi, [bands], buf)
-            result = result[:, :, 0] # reduce dimensions
-        else:
-            result = self._read(roi, bands, buf)
+        with profiling.timed('read'):
+            if isinstance(bands, int):
+                result = self._read(roi, [bands], buf)
+                result = result[:, :, 0] # reduce dimensions
+            else:
+                result = self._read(roi, bands, buf)
         if self.__preprocess_function:
-            return self.__preprocess_function(result, roi, bands)
+            with profiling.timed('preprocess'):
+                return self.__preprocess_function(result, roi, bands)
         return result
 
     def set_preprocess(self, callback: Callable[[np.ndarray, rectangle.Rectangle, List[int]], np.ndarray]) -> None:
@@ -73,6 +81,12 @@ class DeltaImage(ABC):
         """
         self.__preprocess_function = callback
 
+    def get_preprocess(self) -> Callable[[np.ndarray, rectangle.Rectangle, List[int]], np.ndarray]:
+        """
+        Returns the preprocessing function set with `set_preprocess`, or None.
+        """
+        return self.__preprocess_function
+
     @abstractmethod
     def _read(self, roi, bands, buf=None):
         """
@@ -81,6 +95,13 @@ class DeltaImage(ABC):
         This function is intended to be overwritten by subclasses.
         """
 
+    def source(self): #pylint:disable=no-self-use
+        """
+        Returns the file, or list of files, the image was loaded from, or None if it was not
+        loaded from a file. Used to identify the image, i.e., for `delta.imagery.statistics`.
+        """
+        return None
+
     def metadata(self): #pylint:disable=no-self-use
         """
         Returns a dictionary of metadata, in the format used by GDAL.
@@ -114,52 +135,69 @@ class DeltaImage(ABC):
         return input_bounds.make_tile_rois(width, height, min_width=min_width, min_height=min_height,
                                            include_partials=True, overlap_amount=overlap)
 
-    def roi_generator(self, requested_rois: Iterator[rectangle.Rectangle]) -> Iterator[rectangle.Rectangle]:
+    def block_aligned_rois(self, rois: np.ndarray) -> np.ndarray:
         """
-        Generator that yields ROIs of blocks in the requested region.
+        Returns `block_aligned_roi` of each ROI in an (N, 4) array (see `delta.imagery.rectangle.to_array`).
         """
-        block_rois = copy.copy(requested_rois)
+        return rectangle.to_array([self.block_aligned_roi(r) for r in rectangle.rectangles(rois)])
 
+    def _check_rois(self, requested_rois: List[rectangle.Rectangle]) -> np.ndarray:
+        """
+        Raises an exception if any of the ROIs are outside the image, otherwise returns them as an
+        (N, 4) array (see `delta.imagery.rectangle.to_array`).
+        """
+        rois = rectangle.to_array(requested_rois)
         whole_bounds = rectangle.Rectangle(0, 0, width=self.width(), height=self.height())
-        for roi in requested_rois:
-            if not whole_bounds.contains_rect(roi):
-                raise Exception('Roi outside image bounds: ' + str(roi) + str(whole_bounds))
+        outside = np.any(rectangle.intersect(rois, whole_bounds) != rois, axis=1)
+        if np.any(outside):
+            roi = requested_rois[int(np.argmax(outside))]
+            raise Exception('Roi outside image bounds: ' + str(roi) + str(whole_bounds))
+        return rois
 
+    def _read_regions(self, regions: Iterator[Tuple[rectangle.Rectangle, object]]) \
+            -> Iterator[Tuple[rectangle.Rectangle, object, np.ndarray]]:
+        """
+        Reads each (region, value) in `regions` and yields (region, value, data), in order.
+        Reads are done in a separate thread, a few regions ahead of the ones yielded.
+        """
+        regions = iter(regions)
         # gdal doesn't work reading multithreading. But this let's a thread
         # take care of IO input while we do computation.
-        exe = concurrent.futures.ThreadPoolExecutor(1)
-        jobs = []
-
-        total_rois = len(block_rois)
-        while block_rois:
-            # For the next (output) block, figure out the (input block) aligned
-            # data read that we need to perform to get it.
-            read_roi = self.block_aligned_roi(block_rois[0])
-
-            applicable_rois = []
-
-            # Loop through the remaining ROIs and apply the callback function to each
-            # ROI that is contained in the section we read in.
-            index = 0
-            while index < len(block_rois):
-
-                if not read_roi.contains_rect(block_rois[index]):
-                    index += 1
-                    continue
-                applicable_rois.append(block_rois.pop(index))
-
-            buf = exe.submit(functools.partial(self.read, read_roi))
-            jobs.append((buf, read_roi, applicable_rois))
-
-        num_remaining = total_rois
-        for (buf_exe, read_roi, rois) in jobs:
-            buf = buf_exe.result()
-            for roi in rois:
+        with concurrent.futures.ThreadPoolExecutor(1) as exe:
+            jobs = collections.deque()
+            for (region, value) in itertools.islice(regions, _READ_AHEAD):
+                jobs.append((exe.submit(self.read, region), region, value))
+            while jobs:
+                (buf_exe, region, value) = jobs.popleft()
+                for (r, v) in itertools.islice(regions, 1):
+                    jobs.append((exe.submit(self.read, r), r, v))
+                yield (region, value, buf_exe.result())
+
+    def roi_generator(self, requested_rois: Iterator[rectangle.Rectangle]) \
+            -> Iterator[Tuple[rectangle.Rectangle, np.ndarray, Tuple[int, int]]]:
+        """
+        Generator that yields (roi, data, (number, total)) for each of the requested ROIs.
+
+        ROIs are grouped, in one pass, by the block aligned region (see `block_aligned_roi`) to read
+        for them, and each region is read once, in the order of the first ROI in it. Reads are done
+        in a separate thread, ahead of the ROIs being yielded.
+        """
+        requested_rois = list(requested_rois)
+        total_rois = len(requested_rois)
+        if not total_rois:
+            return
+        rois = self._check_rois(requested_rois)
+
+        reads = ((rectangle.Rectangle(*region), indices)
+                 for (region, indices) in rectangle.group_by(self.block_aligned_rois(rois)))
+        num_done = 0
+        for (read_roi, indices, buf) in self._read_regions(reads):
+            for i in indices:
+                roi = requested_rois[i]
                 x0 = roi.min_x - read_roi.min_x
                 y0 = roi.min_y - read_roi.min_y
-                num_remaining -= 1
-                yield (roi, buf[x0:x0 + roi.width(), y0:y0 + roi.height(), :],
-                       (total_rois - num_remaining, total_rois))
+                num_done += 1
+                yield (roi, buf[x0:x0 + roi.width(), y0:y0 + roi.height(), :], (num_done, total_rois))
 
     def process_rois(self, requested_rois: Iterator[rectangle.Rectangle],
                      callback_function: Callable[[rectangle.Rectangle, np.ndarray], None],
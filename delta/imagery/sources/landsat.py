@@ -23,10 +23,9 @@ import math
 import functools
 import os
 import os.path
-import numpy as np
 
 from delta.config import config
-from delta.imagery import utilities
+from delta.imagery import preprocess, utilities
 from . import tiff
 
 # Use this for all the output Landsat data we write.
@@ -138,24 +137,57 @@ def _get_landsat_bands_to_use(sensor_name):
                 raise Exception('Unknown landsat type: ' + sensor_name)
     return bands
 
-def _get_band_paths(mtl_data, folder, bands_to_use=None):
+def _get_band_paths(mtl_data, folder, bands_to_use=None, in_place=None):
     """Return full paths to all band files that should be in the folder.
-       Optionally specify a list of bands to use, otherwise all are used"""
+       Optionally specify a list of bands to use, otherwise all are used.
+       Bands with file names in the dictionary in_place use the path given there instead."""
 
     paths = []
     if not bands_to_use: # Default is to use all bands
         bands_to_use = range(1,len(mtl_data['FILE_NAME'])+1)
     for b in bands_to_use:
         filename = mtl_data['FILE_NAME'][b-1]
-        band_path = os.path.join(folder, filename)
+        if in_place and filename in in_place:
+            band_path = in_place[filename]
+        else:
+            band_path = os.path.join(folder, filename)
         paths.append(band_path)
     return paths
 
-def _check_if_files_present(mtl_data, folder, bands_to_use=None):
-    """Return True if all the files associated with the MTL data are present."""
+def _band_from_filename(filename):
+    """Returns the one-based band index of a band file name, consistent with _parse_mtl_file,
+       or None if this is not a band file."""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    parts = name.split('_B')
+    if len(parts) < 2:
+        return None
+    band = parts[-1].replace('6_VCID_1', '6').replace('6_VCID_2', '9')
+    try:
+        return int(band)
+    except ValueError:
+        return None
+
+def _is_band_file(filename, bands):
+    """Returns True if filename (in a Landsat archive) is one of bands."""
+    if os.path.splitext(filename)[1].upper() != '.TIF':
+        return False
+    return _band_from_filename(filename) in bands
+
+def _is_needed_file(filename, bands, skip=()):
+    """Returns True if filename (in a Landsat archive) is the MTL file or one of bands,
+       and is not in skip."""
+    if filename in skip:
+        return False
+    return filename.endswith('_MTL.txt') or _is_band_file(filename, bands)
 
-    band_paths = _get_band_paths(mtl_data, folder, bands_to_use)
+def _check_if_files_present(mtl_data, folder, bands_to_use=None, in_place=None):
+    """Return True if all the files associated with the MTL data are present,
+       either in the folder or readable from the archive in the dictionary in_place."""
+
+    band_paths = _get_band_paths(mtl_data, folder, bands_to_use, in_place)
     for b in band_paths:
+        if b.startswith('/vsi'):
+            continue
         if not os.path.exists(b):
             return False
     return True
@@ -193,7 +225,17 @@ class LandsatImage(tiff.TiffImage):
 
         # Get the folder where this will be stored from the cache manager
         name = '_'.join([self._sensor, self._lpath, self._lrow, self._date])
-        untar_folder = config.cache_manager().register_item(name)
+        untar_folder = os.path.normpath(self._cache_item(name))
+
+        bands_to_use = _get_landsat_bands_to_use(self._sensor)
+        self._bands = bands_to_use
+
+        # Find bands we can read directly from the archive, the MTL file is always extracted
+        in_place_members = {}
+        if config.io.archive_mode() != 'extract':
+            in_place_members = utilities.in_place_paths(paths, functools.partial(_is_band_file, bands=bands_to_use),
+                                                        force=config.io.archive_mode() == 'direct')
+        in_place = {os.path.basename(n) : p for (n, p) in in_place_members.items()}
 
         # Check if we already unpacked this data
         all_files_present = False
@@ -201,29 +243,73 @@ class LandsatImage(tiff.TiffImage):
             mtl_path = _find_mtl_file(untar_folder)
             if mtl_path:
                 mtl_data = _parse_mtl_file(mtl_path)
-                all_files_present = _check_if_files_present(mtl_data, untar_folder)
+                all_files_present = _check_if_files_present(mtl_data, untar_folder, bands_to_use, in_place)
 
+        self._pending = {}
         if all_files_present:
             print('Already have unpacked files in ' + untar_folder)
         else:
             print('Unpacking tar file ' + paths + ' to folder ' + untar_folder)
-            utilities.unpack_to_folder(paths, untar_folder)
-
-        bands_to_use = _get_landsat_bands_to_use(self._sensor)
+            os.makedirs(untar_folder, exist_ok=True)
+            # only extract the files we use, bands are opened as they finish
+            self._pending = utilities.extract_members(paths, untar_folder,
+                                                      functools.partial(_is_needed_file, bands=bands_to_use,
+                                                                        skip=in_place_members))
+            for (p, f) in self._pending.items():
+                if p.endswith('_MTL.txt'):
+                    f.result()
 
         # Generate all the band file names (the MTL file is not returned)
         self._mtl_path = _find_mtl_file(untar_folder)
+        if self._mtl_path is None:
+            raise Exception('Did not find MTL file in ' + paths)
         self._mtl_data = _parse_mtl_file(self._mtl_path)
-        output_paths = _get_band_paths(self._mtl_data, untar_folder, bands_to_use)
+        output_paths = _get_band_paths(self._mtl_data, untar_folder, bands_to_use, in_place)
 
         # Check that the files exist
         for p in output_paths:
-            if not os.path.exists(p):
+            if p not in self._pending and not p.startswith('/vsi') and not os.path.exists(p):
                 raise Exception('Did not find expected file: ' + p
                                 + ' after unpacking tar file ' + paths)
 
         return output_paths
 
+    def _open(self, path):
+        # wait for the band to finish unpacking
+        if path in self._pending:
+            self._pending[path].result()
+        return super()._open(path)
+
+    def bands(self):
+        """Returns the one-based landsat band numbers of the bands in this image, in order."""
+        return self._bands
+
+    def toa_parameters(self, calc_reflectance=False):
+        """Returns the per-band parameters for top of atmosphere correction used by
+           `delta.imagery.preprocess.Pipeline`, as a dictionary. The gain and offset convert
+           to radiance, or reflectance if calc_reflectance is set. In that case the k1 and k2
+           constants convert thermal bands from radiance to temperature instead."""
+        def image_bands(values):
+            return [values[b - 1] for b in self.bands()]
+
+        factors = image_bands(self.radiance_mult())
+        constants = image_bands(self.radiance_add())
+        if not calc_reflectance:
+            return {'gain' : factors, 'offset' : constants, 'k1' : None, 'k2' : None}
+
+        k1 = image_bands(self.k1_constant())
+        k2 = image_bands(self.k2_constant())
+        # thermal bands have k constants and are converted to temperature from radiance,
+        # fold the sun elevation into the reflectance factors for the rest
+        se = math.sin(math.radians(self.sun_elevation()))
+        for (i, (m, a)) in enumerate(zip(image_bands(self.reflectance_mult()), image_bands(self.reflectance_add()))):
+            if k1[i] is None:
+                factors[i] = m / se
+                constants[i] = a / se
+        if all(k is None for k in k1):
+            (k1, k2) = (None, None)
+        return {'gain' : factors, 'offset' : constants, 'k1' : k1, 'k2' : k2}
+
     def radiance_mult(self):
         return self._mtl_data['RADIANCE_MULT']
     def radiance_add(self):
@@ -239,53 +325,9 @@ class LandsatImage(tiff.TiffImage):
     def sun_elevation(self):
         return self._mtl_data['SUN_ELEVATION']
 
-# top of atmosphere correction
-def _apply_toa_radiance(data, _, bands, factors, constants):
-    """Apply a top of atmosphere radiance conversion to landsat data"""
-    buf = np.zeros(data.shape, dtype=np.float32)
-    for b in bands:
-        f = factors[b]
-        c = constants[b]
-        buf[:, :, b] = np.where(data[:, :, b] > 0, data[:, :, b] * f + c, OUTPUT_NODATA)
-    return buf
-
-def _apply_toa_temperature(data, _, bands, factors, constants, k1, k2):
-    """Apply a top of atmosphere radiance + temp conversion to landsat data"""
-    buf = np.zeros(data.shape, dtype=np.float32)
-    for b in bands:
-        f = factors[b]
-        c = constants[b]
-        k1 = k1[b]
-        k2 = k2[b]
-        buf[:, :, b] = np.where(data[:, :, b] > 0, k2 / np.log(k1 / (data[:, :, b] * f + c) + 1.0), OUTPUT_NODATA)
-    return buf
-
-def _apply_toa_reflectance(data, _, bands, factors, constants, sun_elevation):
-    """Apply a top of atmosphere radiance + temp conversion to landsat data"""
-    buf = np.zeros(data.shape, dtype=np.float32)
-    for b in bands:
-        f = factors[b]
-        c = constants[b]
-        se = sun_elevation[b]
-        buf[:, :, b] = np.where(data[:, :, b] > 0, (data[:, :, b] * f + c) / math.sin(se), OUTPUT_NODATA)
-    return buf
-
 def toa_preprocess(image, calc_reflectance=False):
-    """Convert landsat files in one folder to TOA corrected files in the output folder.
+    """Set a LandsatImage's preprocessing function to do landsat TOA correction.
        Using the reflectance calculation is slightly more complicated but may be more useful.
-       Multiprocessing is used if multiple processes are specified."""
-
-    if calc_reflectance:
-        if image.k1_constant() is None:
-            user_function = functools.partial(_apply_toa_reflectance, factors=image.reflectance_mult(),
-                                              constants=image.reflectance_add(),
-                                              sun_elevation=math.radians(image.sun_elevation()))
-        else:
-            user_function = functools.partial(_apply_toa_temperature, factors=image.radiance_mult(),
-                                              constants=image.radiance_add(), k1=image.k1_constant(),
-                                              k2=image.k2_constant())
-    else:
-        user_function = functools.partial(_apply_toa_radiance, factors=image.radiance_mult(),
-                                          constants=image.radiance_add())
-
-    image.set_preprocess(user_function)
+       With the reflectance calculation, thermal bands are converted to temperature."""
+    pipeline = preprocess.Pipeline([{'toa' : {'reflectance' : calc_reflectance}}], nodata=OUTPUT_NODATA)
+    image.set_preprocess(pipeline.bind(image))
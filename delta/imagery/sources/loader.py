@@ -26,7 +26,7 @@ _IMAGE_TYPES = {
         'landsat' : landsat.LandsatImage,
         'tiff' : tiff.TiffImage,
         'rgba' : tiff.RGBAImage,
-        'npy' : npy.NumpyImage
+        'npy' : lambda filename: npy.NumpyImage(path=filename)
 }
 
 def register_image_type(image_type, image_class):
@@ -48,6 +48,9 @@ def load(filename, image_type, preprocess=False):
         raise ValueError('Unexpected image_type %s.' % (image_type))
     img = _IMAGE_TYPES[image_type](filename)
     if preprocess:
+        # pipelines may depend on the image (i.e., for TOA correction)
+        if hasattr(preprocess, 'bind'):
+            preprocess = preprocess.bind(img)
         img.set_preprocess(preprocess)
     return img
 
@@ -31,6 +31,7 @@ class NumpyImage(delta_image.DeltaImage):
     """
     def __init__(self, data=None, path=None):
         super(NumpyImage, self).__init__()
+        self._path = path
 
         if path:
             assert not data
@@ -48,12 +49,17 @@ class NumpyImage(delta_image.DeltaImage):
 
         This function is intended to be overwritten by subclasses.
         """
-        if buf is None:
-            buf = np.zeros(shape=(roi.width(), roi.height(), self.num_bands() ), dtype=self._data.dtype)
         (min_x, max_x, min_y, max_y) = roi.get_bounds()
-        buf = self._data[min_y:max_y,min_x:max_x,:]
+        # copy, so preprocessing can't modify our data
+        data = self._data[min_y:max_y, min_x:max_x, :][:, :, list(bands)]
+        if buf is None:
+            return data
+        buf[:] = data
         return buf
 
+    def source(self):
+        return self._path
+
     def size(self):
         """Return the size of this image in pixels, as (width, height)."""
         return (self._data.shape[1], self._data.shape[0])
@@ -62,6 +68,10 @@ class NumpyImage(delta_image.DeltaImage):
         """Return the number of bands in the image."""
         return self._data.shape[2]
 
+    def numpy_type(self):
+        """Return the numpy data type of the image."""
+        return self._data.dtype
+
 class NumpyImageWriter(delta_image.DeltaImageWriter):
     def __init__(self):
         self._buffer = None
@@ -18,6 +18,9 @@
 """
 Block-aligned reading from multiple Geotiff files.
 """
+import collections
+import concurrent.futures
+import itertools
 import os
 import math
 
@@ -25,12 +28,45 @@ from osgeo import gdal
 import numpy as np
 
 from delta.config import config
-from delta.imagery import rectangle
+from delta.imagery import rectangle, utilities
 
 from . import delta_image
 
+# TiffImage.roi_generator reads runs of neighboring blocks of up to this many pixels at once
+_MAX_MERGE_PIXELS = 1024 * 1024
+
+# image opened by each process in TiffImage.process_rois
+_worker_image = None
+
+def _init_worker(image_class, source, preprocess):
+    global _worker_image #pylint: disable=global-statement
+    _worker_image = image_class(source)
+    if preprocess:
+        _worker_image.set_preprocess(preprocess)
+
+def _read_worker(roi):
+    return _worker_image.read(roi)
+
+def _slices(roi, region):
+    """Returns the slices of a buffer read from the Rectangle `region` holding the Rectangle `roi` inside it."""
+    return (slice(roi.min_x - region.min_x, roi.max_x - region.min_x),
+            slice(roi.min_y - region.min_y, roi.max_y - region.min_y))
+
+def _assemble(roi, runs):
+    """Returns the data for the Rectangle `roi` from the list of (rectangle, buffer) runs covering it."""
+    if len(runs) == 1:
+        (region, buf) = runs[0]
+        return buf[_slices(roi, region)]
+    data = np.empty((roi.width(), roi.height(), runs[0][1].shape[2]), dtype=runs[0][1].dtype)
+    for (region, buf) in runs:
+        part = roi.get_intersection(region)
+        data[_slices(part, roi)] = buf[_slices(part, region)]
+    return data
+
 class TiffImage(delta_image.DeltaImage):
     """For geotiffs."""
+    # reads are transposed to [x, y, band]
+    X_AXIS = 0
 
     def __init__(self, path):
         '''
@@ -38,17 +74,14 @@ class TiffImage(delta_image.DeltaImage):
         For a list, the images are opened in order as a multi-band image, assumed to overlap.
         '''
         super(TiffImage, self).__init__()
+        self._source = path
+        self._cache_items = []
         paths = self._prep(path)
 
         self._paths = paths
         self._handles = []
         for p in paths:
-            if not os.path.exists(p):
-                raise Exception('Image file does not exist: ' + p)
-            result = gdal.Open(p)
-            if result is None:
-                raise Exception('Failed to open tiff file %s.' % (p))
-            self._handles.append(result)
+            self._handles.append(self._open(p))
         self._band_map = []
         for i, h in enumerate(self._handles):
             if h.RasterXSize != self._handles[0].RasterXSize or h.RasterYSize != self._handles[0].RasterYSize:
@@ -70,6 +103,29 @@ class TiffImage(delta_image.DeltaImage):
             return [paths]
         return paths
 
+    def _open(self, path): #pylint:disable=no-self-use
+        """
+        Open one of the files returned by `_prep` with GDAL.
+
+        Subclasses may override this, for example to wait until the file is ready.
+        """
+        # paths in GDAL's virtual file systems (i.e., in archives) can't be checked
+        if not path.startswith('/vsi') and not os.path.exists(path):
+            raise Exception('Image file does not exist: ' + path)
+        result = gdal.Open(path)
+        if result is None:
+            raise Exception('Failed to open tiff file %s.' % (path))
+        return result
+
+    def _cache_item(self, name):
+        """
+        Register an item with the disk cache and return its path. The item is
+        pinned so it cannot be evicted until this image is closed.
+        """
+        path = config.io.cache.manager().register_item(name, pin=True)
+        self._cache_items.append(name)
+        return path
+
     def __asert_open(self):
         if self._handles is None:
             raise IOError('Operating on an image that has been closed.')
@@ -78,6 +134,10 @@ class TiffImage(delta_image.DeltaImage):
         self._handles = None # gdal doesn't have a close function for some reason
         self._band_map = None
         self._paths = None
+        if self._cache_items:
+            for name in self._cache_items:
+                config.io.cache.manager().unpin(name)
+            self._cache_items = []
 
     def num_bands(self):
         self.__asert_open()
@@ -91,7 +151,7 @@ class TiffImage(delta_image.DeltaImage):
         self.__asert_open()
 
         if buf is None:
-            buf = np.zeros(shape=(self.num_bands(), roi.width(), roi.height()), dtype=self.numpy_type())
+            buf = np.empty(shape=(len(bands), roi.width(), roi.height()), dtype=self.numpy_type())
         for i, b in enumerate(bands):
             band_handle = self._gdal_band(b)
             s = buf[i, :, :].shape
@@ -101,6 +161,26 @@ class TiffImage(delta_image.DeltaImage):
             band_handle.ReadAsArray(roi.min_y, roi.min_x, roi.height(), roi.width(), buf_obj=buf[i, :, :])
         return np.transpose(buf, [1, 2, 0])
 
+    def read_overview(self, max_size=1024, bands=None):
+        """
+        Reads a reduced resolution version of the entire image, at most `max_size` pixels
+        on each side, in [row, col, band] order. GDAL reads from the image's overviews when
+        available, so this is much faster than reading the full image.
+        """
+        self.__asert_open()
+        if bands is None:
+            bands = range(self.num_bands())
+        ratio = max(1.0, max(self.width(), self.height()) / max_size)
+        (rows, cols) = (max(1, int(self.width() / ratio)), max(1, int(self.height() / ratio)))
+        result = np.empty(shape=(rows, cols, len(bands)), dtype=self.numpy_type())
+        for i, b in enumerate(bands):
+            result[:, :, i] = self._gdal_band(b).ReadAsArray(0, 0, self.height(), self.width(),
+                                                             buf_xsize=cols, buf_ysize=rows)
+        return result
+
+    def source(self):
+        return self._source
+
     def _gdal_band(self, band):
         (h, b) = self._band_map[band]
         ret = self._handles[h].GetRasterBand(b)
@@ -208,9 +288,115 @@ class TiffImage(delta_image.DeltaImage):
         bounds = rectangle.Rectangle(0, 0, width=self.width(), height=self.height())
         return ans.get_intersection(bounds)
 
-    def save(self, path, tile_size=(0,0), nodata_value=None, show_progress=False):
+    def roi_generator(self, requested_rois, max_merge_pixels=_MAX_MERGE_PIXELS):
+        """
+        Same as `delta.imagery.sources.delta_image.DeltaImage.roi_generator`, but each block of the image
+        is read and decoded at most once, even when ROIs straddle block boundaries.
+
+        The image is read in runs of neighboring blocks in the same row of blocks, of up to
+        `max_merge_pixels` pixels, in the order they are stored. Each ROI is yielded as soon as every
+        run it touches has been read, copied together from the runs if it spans more than one, and
+        runs are freed once all the ROIs touching them have been yielded.
+        """
+        requested_rois = list(requested_rois)
+        total_rois = len(requested_rois)
+        if not total_rois:
+            return
+        (reads, touched, counts, ready) = self._plan_runs(self._check_rois(requested_rois), max_merge_pixels)
+
+        cache = {}
+        num_done = 0
+        for (read_roi, index, buf) in self._read_regions(reads):
+            cache[index] = (read_roi, buf)
+            for i in ready[index].tolist():
+                roi = requested_rois[i]
+                data = _assemble(roi, [cache[t] for t in touched[i]])
+                for t in touched[i]:
+                    counts[t] -= 1
+                    if not counts[t]:
+                        del cache[t]
+                num_done += 1
+                yield (roi, data, (num_done, total_rois))
+
+    def _plan_runs(self, rois, max_merge_pixels):
+        """
+        Plans the runs of blocks `roi_generator` reads for the array of ROIs `rois`.
+
+        Returns a generator of (run rectangle, run index) to read, in storage order, a list of the
+        run indices each ROI touches, an array counting the ROIs touching each run, and a list
+        of the ROIs ready once each run is read, in the order to yield them.
+        """
+        (block_size, unused_num_blocks) = self.block_info(0)
+        (width, height) = (self.width(), self.height())
+        run_height = block_size[1] * int(min(max(max_merge_pixels // (block_size[0] * block_size[1]), 1),
+                                             -(-height // block_size[1])))
+        grid = (-(-width // block_size[0]), -(-height // run_height))
+        # first and one past the last run touched by each ROI
+        runs = rectangle.block_ranges(rois, block_size[0], run_height)
+        # number of ROIs touching each run, from prefix sums over the corners of their ranges
+        counts = np.zeros((grid[0] + 1, grid[1] + 1), dtype=np.int64)
+        for (x, y, sign) in [(0, 1, 1), (0, 3, -1), (2, 1, -1), (2, 3, 1)]:
+            np.add.at(counts, (runs[:, x], runs[:, y]), sign)
+        counts = np.cumsum(np.cumsum(counts, axis=0), axis=1)[:grid[0], :grid[1]].ravel()
+        touched = [[x * grid[1] + y for x in range(x0, x1) for y in range(y0, y1)]
+                   for (x0, y0, x1, y1) in runs.tolist()]
+        # each ROI is ready once the last run it touches is read
+        last = np.ravel_multi_index((runs[:, 2] - 1, runs[:, 3] - 1), grid)
+        order = np.argsort(last, kind='stable')
+        ready = np.split(order, np.searchsorted(last[order], np.arange(len(counts) - 1), side='right'))
+
+        def run_rect(index):
+            (x, y) = divmod(index, grid[1])
+            return rectangle.Rectangle(x * block_size[0], y * run_height, min((x + 1) * block_size[0], width),
+                                       min((y + 1) * run_height, height))
+        reads = ((run_rect(i), i) for i in np.flatnonzero(counts).tolist())
+        return (reads, touched, counts, ready)
+
+    def block_aligned_rois(self, rois):
+        self.__asert_open()
+        (block_size, unused_num_blocks) = self.block_info(0)
+        aligned = rectangle.block_ranges(rois, block_size[0], block_size[1]) * np.tile(block_size, 2)
+        return rectangle.intersect(aligned, rectangle.Rectangle(0, 0, width=self.width(), height=self.height()))
+
+    def process_rois(self, requested_rois, callback_function, show_progress=False, num_processes=1):
+        """
+        Same as `delta.imagery.sources.delta_image.DeltaImage.process_rois`, but if `num_processes`
+        is greater than one, ROIs are read and preprocessed in parallel by a pool of processes,
+        each of which opens the image itself. The callbacks are still executed in order on
+        this thread. The preprocessing function must be picklable, such as a
+        `delta.imagery.preprocess.Pipeline`.
+        """
+        if num_processes <= 1:
+            super().process_rois(requested_rois, callback_function, show_progress)
+            return
+        self.__asert_open()
+
+        total = len(requested_rois)
+        with concurrent.futures.ProcessPoolExecutor(num_processes, initializer=_init_worker,
+                                                    initargs=(type(self), self._source,
+                                                              self.get_preprocess())) as exe:
+            # limit the number of blocks in memory at once, but keep all the workers busy
+            jobs = collections.deque()
+            rois = iter(requested_rois)
+            for roi in itertools.islice(rois, 2 * num_processes):
+                jobs.append((roi, exe.submit(_read_worker, roi)))
+            i = 0
+            while jobs:
+                (roi, job) = jobs.popleft()
+                for r in itertools.islice(rois, 1):
+                    jobs.append((r, exe.submit(_read_worker, r)))
+                callback_function(roi, job.result())
+                i += 1
+                if show_progress:
+                    utilities.progress_bar('%d / %d' % (i, total), i / total, prefix='Blocks Processed:')
+        if show_progress:
+            print()
+
+    def save(self, path, tile_size=(0,0), nodata_value=None, show_progress=False, num_processes=1):
         """
         Save a TiffImage to the file output_path, optionally overwriting the tile_size.
+        If num_processes is greater than one, tiles are read and preprocessed in parallel
+        processes (see `process_rois`) and compressed by multiple threads.
         """
 
         if nodata_value is None:
@@ -224,10 +410,13 @@ class TiffImage(delta_image.DeltaImage):
         if tile_size[1] > 0:
             block_size_y = tile_size[1]
 
+        # preprocessing converts to floating point
+        data_type = self.data_type() if self.get_preprocess() is None else gdal.GDT_Float32
+
         # Set up the output image
         with TiffWriter(path, self.width(), self.height(), self.num_bands(),
-                        self.data_type(), block_size_x, block_size_y,
-                        nodata_value, self.metadata()) as writer:
+                        data_type, block_size_x, block_size_y,
+                        nodata_value, self.metadata(), num_threads=num_processes) as writer:
             input_bounds = rectangle.Rectangle(0, 0, width=self.width(), height=self.height())
             output_rois = input_bounds.make_tile_rois(block_size_x, block_size_y, include_partials=True)
 
@@ -242,7 +431,8 @@ class TiffImage(delta_image.DeltaImage):
                 for band in range(data.shape[2]):
                     writer.write_block(data[:, :, band], block_x, block_y, band)
 
-            self.process_rois(output_rois, callback_function, show_progress=show_progress)
+            self.process_rois(output_rois, callback_function, show_progress=show_progress,
+                              num_processes=num_processes)
 
 class RGBAImage(TiffImage):
     """Basic RGBA images where the alpha channel needs to be stripped"""
@@ -252,7 +442,7 @@ class RGBAImage(TiffImage):
 
         # Get the path to the cached image
         fname = os.path.basename(paths)
-        output_path = config.cache_manager().register_item(fname)
+        output_path = self._cache_item(fname)
 
         if not os.path.exists(output_path):
             # Just remove the alpha band from the original image
@@ -300,7 +490,10 @@ class TiffWriter:
     """Class to manage block writes to a Geotiff file.
     """
     def __init__(self, path, width, height, num_bands=1, data_type=gdal.GDT_Byte, #pylint:disable=too-many-arguments
-                 tile_width=256, tile_height=256, no_data_value=None, metadata=None):
+                 tile_width=256, tile_height=256, no_data_value=None, metadata=None, num_threads=1):
+        """
+        If num_threads is greater than one, GDAL compresses blocks with multiple threads.
+        """
         self._width  = width
         self._height = height
         self._tile_height = tile_height
@@ -311,6 +504,8 @@ class TiffWriter:
         options = ['COMPRESS=LZW', 'BigTIFF=IF_SAFER', 'INTERLEAVE=BAND']
         options += ['BLOCKXSIZE='+str(self._tile_height),
                     'BLOCKYSIZE='+str(self._tile_width)]
+        if num_threads > 1:
+            options += ['NUM_THREADS=' + str(num_threads)]
         MIN_SIZE_FOR_TILES=100
         if width > MIN_SIZE_FOR_TILES or height > MIN_SIZE_FOR_TILES:
             options += ['TILED=YES']
@@ -20,12 +20,11 @@ Functions to support the WorldView satellites.
 """
 
 import math
-import functools
 import os
 import numpy as np
 
 from delta.config import config
-from delta.imagery import utilities
+from delta.imagery import preprocess, utilities
 from . import tiff
 
 # Use this value for all WorldView nodata values we write, though they usually don't have any nodata.
@@ -55,6 +54,16 @@ def _get_files_from_unpack_folder(folder):
             break
     return (tif_path, imd_path)
 
+def _is_image_file(filename):
+    """Returns True if filename (in a WorldView archive) is the image."""
+    (folder, name) = os.path.split(filename)
+    return not folder and os.path.splitext(name)[1] == '.tif'
+
+def _is_needed_file(filename):
+    """Returns True if filename (in a WorldView archive) is read by _get_files_from_unpack_folder."""
+    (folder, name) = os.path.split(filename)
+    return _is_image_file(filename) or (folder == 'vendor_metadata' and os.path.splitext(name)[1] == '.IMD')
+
 class WorldviewImage(tiff.TiffImage):
     """Compressed WorldView image tensorflow dataset wrapper (see imagery_dataset.py)"""
     def __init__(self, paths):
@@ -65,18 +74,27 @@ class WorldviewImage(tiff.TiffImage):
     def _unpack(self, paths):
         # Get the folder where this will be stored from the cache manager
         name = '_'.join([self._sensor, self._date])
-        unpack_folder = config.io.cache.manager().register_item(name)
+        unpack_folder = self._cache_item(name)
+
+        # Find images we can read directly from the archive, the metadata is always extracted
+        in_place = {}
+        if config.io.archive_mode() != 'extract':
+            in_place = utilities.in_place_paths(paths, _is_image_file, force=config.io.archive_mode() == 'direct')
 
         # Check if we already unpacked this data
         (tif_path, imd_path) = _get_files_from_unpack_folder(unpack_folder)
 
-        if imd_path and tif_path:
+        if imd_path and (tif_path or in_place):
             #print('Already have unpacked files in ' + unpack_folder)
             pass
         else:
             print('Unpacking file ' + paths + ' to folder ' + unpack_folder)
-            utilities.unpack_to_folder(paths, unpack_folder)
+            os.makedirs(unpack_folder, exist_ok=True)
+            utilities.unpack_to_folder(paths, unpack_folder,
+                                       members=lambda n: _is_needed_file(n) and n not in in_place)
             (tif_path, imd_path) = _get_files_from_unpack_folder(unpack_folder)
+        if in_place:
+            tif_path = in_place[sorted(in_place.keys())[0]]
         return (tif_path, imd_path)
 
     # This function is currently set up for the HDDS archived WV data, files from other
@@ -139,6 +157,20 @@ class WorldviewImage(tiff.TiffImage):
         self._meta_path = meta_path
         self._meta = data
 
+    def toa_parameters(self, calc_reflectance=False):
+        """
+        Returns the per-band parameters for top of atmosphere correction used by
+        `delta.imagery.preprocess.Pipeline`, as a dictionary. The gain converts to
+        radiance, or reflectance if calc_reflectance is set. There is no offset.
+        """
+        gain = [f / w for (f, w) in zip(self.scale(), self.bandwidth())]
+        if calc_reflectance:
+            des2 = _get_earth_sun_distance() ** 2
+            theta = np.pi / 2.0 - math.radians(self._meta['MEANSUNEL'])
+            gain = [g * (des2 * np.pi) / (_get_esun_value(self._meta['SATID'], b) * math.cos(theta))
+                    for (b, g) in enumerate(gain)]
+        return {'gain' : gain, 'offset' : [0.0] * len(gain), 'k1' : None, 'k2' : None}
+
     def scale(self):
         return self._meta['ABSCALFACTOR']
     def bandwidth(self):
@@ -163,46 +195,10 @@ def _get_earth_sun_distance():
     # TODO: Copy the calculation from the WV manuals.
     return 1.0
 
-# The np.where clause handles input nodata values.
-
-def _apply_toa_radiance(data, _, bands, factors, widths):
-    """Apply a top of atmosphere radiance conversion to WorldView data"""
-    buf = np.zeros(data.shape, dtype=np.float32)
-    for b in bands:
-        f = factors[b]
-        w = widths[b]
-        buf[:, :, b] = np.where(data[:, :, b] > 0, (data[:, :, b] * f) / w, OUTPUT_NODATA)
-    return buf
-
-def _apply_toa_reflectance(data, band, factor, width, sun_elevation,
-                           satellite, earth_sun_distance):
-    """Apply a top of atmosphere reflectance conversion to WorldView data"""
-    f = factor[band]
-    w = width [band]
-
-    esun    = _get_esun_value(satellite, band)
-    des2    = earth_sun_distance*earth_sun_distance
-    theta   = np.pi/2.0 - sun_elevation
-    scaling = (des2*np.pi) / (esun*math.cos(theta))
-    return np.where(data>0, ((data*f)/w)*scaling, OUTPUT_NODATA)
-
-
 def toa_preprocess(image, calc_reflectance=False):
     """
     Set a WorldviewImage's preprocessing function to do worldview TOA correction.
     Using the reflectance calculation is slightly more complicated but may be more useful.
     """
-
-    #ds = get_earth_sun_distance() # TODO: Implement this function!
-
-    if not calc_reflectance:
-        user_function = functools.partial(_apply_toa_radiance, factors=image.scale(), widths=image.bandwidth())
-    else:
-        raise Exception('TODO: WV reflectance calculation is not fully implemented!')
-
-        #user_function = functools.partial(apply_toa_reflectance, factor=scale, width=bwidth,
-        #                                  sun_elevation=math.radians(data['MEANSUNEL']),
-        #                                  satellite=data['SATID'],
-        #                                  earth_sun_distance=ds)
-
-    image.set_preprocess(user_function)
+    pipeline = preprocess.Pipeline([{'toa' : {'reflectance' : calc_reflectance}}], nodata=OUTPUT_NODATA)
+    image.set_preprocess(pipeline.bind(image))
@@ -0,0 +1,315 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-band image statistics, computed once per image and stored in an index for reuse.
+
+Statistics are computed by streaming over the image in blocks, or approximately
+from a reduced resolution version of the image (which GDAL reads from the image's overviews
+when present). The `StatisticsIndex` stores the statistics for each image file, and
+recomputes them only if the file has been modified.
+"""
+import json
+
+import numpy as np
+
+from delta.config import config
+from delta.imagery import utilities
+
+class ImageStatistics:
+    """
+    Statistics for each band of an image: the number of valid pixels, minimum, maximum,
+    mean, standard deviation and a histogram over the range `[minimum, maximum]`.
+    """
+    #pylint:disable=too-many-arguments
+    def __init__(self, count, minimum, maximum, mean, std, histogram, approximate=False):
+        """
+        All arguments are sequences with one entry per band. Each band's histogram
+        is a list of counts for equally sized bins from the band's minimum to maximum.
+        """
+        self._count = np.asarray(count, dtype=np.int64)
+        self._min = np.asarray(minimum, dtype=np.float64)
+        self._max = np.asarray(maximum, dtype=np.float64)
+        self._mean = np.asarray(mean, dtype=np.float64)
+        self._std = np.asarray(std, dtype=np.float64)
+        self._histogram = np.asarray(histogram, dtype=np.int64)
+        self._approximate = approximate
+
+    def num_bands(self):
+        """Number of bands."""
+        return len(self._count)
+
+    def count(self):
+        """Number of valid pixels in each band."""
+        return self._count
+
+    def minimum(self):
+        """Minimum value of each band."""
+        return self._min
+
+    def maximum(self):
+        """Maximum value of each band."""
+        return self._max
+
+    def mean(self):
+        """Mean value of each band."""
+        return self._mean
+
+    def std(self):
+        """Standard deviation of each band."""
+        return self._std
+
+    def histogram(self):
+        """Array of histogram counts, with shape (bands, bins)."""
+        return self._histogram
+
+    def approximate(self):
+        """True if the statistics were computed from a reduced resolution image."""
+        return self._approximate
+
+    def percentile(self, q):
+        """
+        Estimate the value of each band at percentile `q` (between 0 and 100)
+        by interpolating within the histogram bins.
+        """
+        result = np.empty(self.num_bands(), dtype=np.float64)
+        for b in range(self.num_bands()):
+            hist = self._histogram[b]
+            cdf = np.cumsum(hist)
+            if cdf[-1] == 0 or self._max[b] <= self._min[b]:
+                result[b] = self._min[b]
+                continue
+            target = q / 100.0 * cdf[-1]
+            i = min(int(np.searchsorted(cdf, target)), len(hist) - 1)
+            before = cdf[i - 1] if i > 0 else 0
+            frac = (target - before) / hist[i] if hist[i] else 0.0
+            width = (self._max[b] - self._min[b]) / len(hist)
+            result[b] = self._min[b] + (i + frac) * width
+        return result
+
+    def to_dict(self):
+        """Returns a dictionary that can be stored as JSON."""
+        return {'count' : self._count.tolist(), 'min' : self._min.tolist(), 'max' : self._max.tolist(),
+                'mean' : self._mean.tolist(), 'std' : self._std.tolist(),
+                'histogram' : self._histogram.tolist(), 'approximate' : self._approximate}
+
+    @staticmethod
+    def from_dict(d):
+        """Load statistics saved with `to_dict`."""
+        return ImageStatistics(d['count'], d['min'], d['max'], d['mean'], d['std'], d['histogram'],
+                               d['approximate'])
+
+class _Accumulator:
+    """
+    Accumulates statistics over blocks of data. Moments are merged between blocks
+    with Chan's parallel algorithm so they remain accurate for large images.
+    Integer data of at most 16 bits is histogrammed exactly by value, otherwise
+    a second pass with `add_histogram` is needed once the range is known.
+    """
+    def __init__(self, num_bands, nodata):
+        self._nodata = nodata
+        self.count = np.zeros(num_bands, dtype=np.int64)
+        self.mean = np.zeros(num_bands, dtype=np.float64)
+        self.m2 = np.zeros(num_bands, dtype=np.float64)
+        self.min = np.full(num_bands, np.inf)
+        self.max = np.full(num_bands, -np.inf)
+        self.value_counts = [None] * num_bands # exact histograms of integer data
+        self.value_offset = 0
+        self.histogram = None
+
+    def _valid(self, v):
+        if np.issubdtype(v.dtype, np.floating):
+            keep = ~np.isnan(v)
+            if self._nodata is not None:
+                keep &= v != self._nodata
+            return v[keep]
+        if self._nodata is not None:
+            return v[v != self._nodata]
+        return v
+
+    def _band_values(self, data):
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        for b in range(data.shape[2]):
+            yield (b, self._valid(data[:, :, b].ravel()))
+
+    def add(self, data):
+        """Add a block of data in [row, col, band] order."""
+        exact = np.issubdtype(data.dtype, np.integer) and data.dtype.itemsize <= 2
+        if exact:
+            self.value_offset = int(np.iinfo(data.dtype).min)
+        for (b, v) in self._band_values(data):
+            if v.size == 0:
+                continue
+            n = v.size
+            m = float(np.mean(v, dtype=np.float64))
+            m2 = float(np.var(v, dtype=np.float64)) * n
+            total = self.count[b] + n
+            delta = m - self.mean[b]
+            self.mean[b] += delta * n / total
+            self.m2[b] += m2 + delta * delta * self.count[b] * n / total
+            self.count[b] = total
+            self.min[b] = min(self.min[b], float(v.min()))
+            self.max[b] = max(self.max[b], float(v.max()))
+            if exact:
+                counts = np.bincount((v.astype(np.int64) - self.value_offset),
+                                     minlength=np.iinfo(data.dtype).max - self.value_offset + 1)
+                if self.value_counts[b] is None:
+                    self.value_counts[b] = counts
+                else:
+                    self.value_counts[b] += counts
+
+    def needs_histogram_pass(self):
+        """True if `add_histogram` must be called for all the data."""
+        return any(c is None and n > 0 for (c, n) in zip(self.value_counts, self.count))
+
+    def add_histogram(self, data, bins):
+        """Add a block of data to the histogram, after all data has been passed to `add`."""
+        if self.histogram is None:
+            self.histogram = np.zeros((len(self.count), bins), dtype=np.int64)
+        for (b, v) in self._band_values(data):
+            if v.size:
+                self.histogram[b] += np.histogram(v, bins, range=self._range(b))[0]
+
+    def _range(self, b):
+        if self.count[b] == 0:
+            return (0.0, 1.0)
+        return (self.min[b], self.max[b])
+
+    def statistics(self, bins, approximate):
+        """Returns the accumulated `ImageStatistics`."""
+        hist = np.zeros((len(self.count), bins), dtype=np.int64)
+        for b, counts in enumerate(self.value_counts):
+            if counts is not None:
+                values = np.flatnonzero(counts)
+                hist[b] = np.histogram(values + self.value_offset, bins, range=self._range(b),
+                                       weights=counts[values])[0]
+            elif self.histogram is not None:
+                hist[b] = self.histogram[b]
+        empty = self.count == 0
+        std = np.sqrt(np.divide(self.m2, self.count, out=np.zeros_like(self.m2), where=~empty))
+        return ImageStatistics(self.count, np.where(empty, 0.0, self.min), np.where(empty, 0.0, self.max),
+                               self.mean, std, hist, approximate)
+
+def compute_statistics(image, bins=256, approximate=False, nodata=None, block_pixels=4 * 1024 * 1024):
+    """
+    Compute `ImageStatistics` for a `delta.imagery.sources.delta_image.DeltaImage`, ignoring
+    NaN and `nodata` pixels (by default, the image's nodata value if it has one).
+    Statistics are computed on the raw image data, without preprocessing.
+
+    The image is read in strips of about `block_pixels` pixels. If `approximate` is set
+    and the image supports it, the statistics are instead computed from a reduced resolution
+    version of the image, which for GeoTIFFs with overviews is much faster.
+    """
+    if nodata is None and hasattr(image, 'nodata_value'):
+        nodata = image.nodata_value()
+    acc = _Accumulator(image.num_bands(), nodata)
+
+    if approximate and hasattr(image, 'read_overview'):
+        data = image.read_overview()
+        acc.add(data)
+        if acc.needs_histogram_pass():
+            acc.add_histogram(data, bins)
+        return acc.statistics(bins, True)
+
+    preprocess = image.get_preprocess()
+    image.set_preprocess(None)
+    try:
+        strips = list(image.tiles(max(1, block_pixels // max(1, image.height())), image.height()))
+        for roi in strips:
+            acc.add(image.read(roi))
+        if acc.needs_histogram_pass():
+            for roi in strips:
+                acc.add_histogram(image.read(roi), bins)
+    finally:
+        image.set_preprocess(preprocess)
+    return acc.statistics(bins, False)
+
+class StatisticsIndex:
+    """
+    Stores the statistics of image files in a JSON index file, so they are computed only once.
+    Statistics are recomputed if the image file's modification time changes.
+
+    The index can be shared by multiple processes, and is protected by a lock file.
+    """
+    def __init__(self, path, bins=256, lock_timeout=300):
+        """
+        Stores the index in the file `path`. Histograms are computed with `bins` bins.
+        """
+        self._index = utilities.LockedJSON(path, 'images', lock_timeout=lock_timeout)
+        self._bins = bins
+        self._memo = {}
+
+    def path(self):
+        """The index file."""
+        return self._index.path()
+
+    def bins(self):
+        """The number of histogram bins."""
+        return self._bins
+
+    def statistics(self, image, approximate=False, nodata=None):
+        """
+        Returns `ImageStatistics` for the image, computing them if they are not in the index
+        or the image has been modified. If `approximate` is false, approximate statistics
+        in the index are recomputed exactly. The image must have a source file
+        (see `delta.imagery.sources.delta_image.DeltaImage.source`).
+        """
+        source = image.source()
+        if source is None:
+            raise ValueError('Cannot index statistics of an image not loaded from a file.')
+        paths = utilities.source_paths(source)
+        key = json.dumps(paths)
+        if nodata is None and hasattr(image, 'nodata_value'):
+            nodata = image.nodata_value()
+        mtime = utilities.modified_time(paths)
+
+        memo_key = (key, mtime, nodata, approximate)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        with self._index.lock():
+            entry = self._index.load().get(key)
+        if self._is_valid(entry, mtime, nodata, approximate):
+            stats = ImageStatistics.from_dict(entry['statistics'])
+        else:
+            stats = compute_statistics(image, self._bins, approximate, nodata)
+            with self._index.lock():
+                items = self._index.load()
+                items[key] = {'mtime' : mtime, 'nodata' : nodata, 'bins' : self._bins,
+                              'statistics' : stats.to_dict()}
+                self._index.save(items)
+        self._memo[memo_key] = stats
+        return stats
+
+    def _is_valid(self, entry, mtime, nodata, approximate):
+        if entry is None:
+            return False
+        if entry['mtime'] != mtime or entry['nodata'] != nodata or entry['bins'] != self._bins:
+            return False
+        return approximate or not entry['statistics']['approximate']
+
+def image_statistics(image, approximate=False, index=None):
+    """
+    Returns `ImageStatistics` for an image, from `index` (by default, the index configured in
+    `io.statistics`) if the image was loaded from a file, and otherwise computed directly.
+    """
+    if image.source() is None:
+        return compute_statistics(image, approximate=approximate)
+    if index is None:
+        index = config.io.statistics.index()
+    return index.statistics(image, approximate)
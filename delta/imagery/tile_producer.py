@@ -0,0 +1,291 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load data in a pool of worker processes, passing the results back through shared memory.
+
+Reading and preprocessing images in Python holds the GIL, so threads in the training
+process can't do it in parallel. Instead, each worker process runs a load function
+and writes the resulting arrays into a slot of a ring of fixed size shared memory
+buffers. Only the slot number, shapes and types are sent between processes, so the
+arrays themselves are never pickled.
+
+`TileProducer` returns each loaded tile. `BatchProducer` goes further: workers
+split their tiles into items (i.e., chunks) and fill fixed size batches directly in shared
+memory, which the consumer copies out once.
+"""
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import traceback
+
+import numpy as np
+
+from delta.imagery import profiling
+
+_ALIGNMENT = 64
+
+def _aligned(n):
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+def _worker(load_function, shm_name, slot_bytes, tasks, results):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (task_id, slot, args) = task
+            try:
+                arrays = load_function(*args)
+                layout = []
+                offset = slot * slot_bytes
+                end = offset + slot_bytes
+                for a in arrays:
+                    a = np.require(a, requirements='C')
+                    if offset + a.nbytes > end:
+                        raise ValueError('Loaded data of %d bytes does not fit in buffer of %d bytes.' %
+                                         (sum(np.asarray(x).nbytes for x in arrays), slot_bytes))
+                    np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)[...] = a
+                    layout.append((a.shape, a.dtype.str, offset))
+                    offset = _aligned(offset + a.nbytes)
+                results.put((task_id, slot, layout, None))
+            except Exception: #pylint:disable=broad-except
+                results.put((task_id, slot, None, traceback.format_exc()))
+    finally:
+        shm.close()
+
+class TileProducer:
+    """
+    Runs `load_function` on a sequence of arguments in a pool of processes, yielding
+    the results in order. `load_function` returns a tuple of numpy arrays, which
+    together must fit in `slot_bytes` bytes (plus alignment padding).
+
+    Up to `num_slots` results are loaded ahead of the consumer. Each yielded array
+    is copied out of shared memory once, so the slot can be reused immediately.
+
+    Worker processes are forked, so `load_function` and everything it uses is
+    inherited from this process rather than pickled. They must not use TensorFlow.
+    """
+    def __init__(self, load_function, args_function, num_processes, slot_bytes, num_slots=None):
+        """
+        `args_function` returns an iterable of argument tuples to pass to `load_function`.
+        It is called each time the producer is iterated.
+        """
+        self._load_function = load_function
+        self._args_function = args_function
+        self._num_processes = max(1, num_processes)
+        # room for alignment of each array
+        self._slot_bytes = _aligned(slot_bytes + 4 * _ALIGNMENT)
+        self._num_slots = num_slots if num_slots is not None else 2 * self._num_processes
+
+    def __call__(self):
+        """Returns a generator of the results, suitable for `tf.data.Dataset.from_generator`."""
+        return iter(self)
+
+    def __iter__(self):
+        ctx = multiprocessing.get_context('fork')
+        shm = shared_memory.SharedMemory(create=True, size=self._slot_bytes * self._num_slots)
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_worker, daemon=True,
+                               args=(self._load_function, shm.name, self._slot_bytes, tasks, results))
+                   for _ in range(self._num_processes)]
+        try:
+            for w in workers:
+                w.start()
+            args = iter(self._args_function())
+            next_id = 0
+            pending = {}
+            # each submitted task owns a slot until its result is consumed, so workers never wait
+            for (slot, a) in zip(range(self._num_slots), args):
+                tasks.put((next_id, slot, a))
+                next_id += 1
+            done = 0
+            while done < next_id:
+                while done not in pending:
+                    pending.update(self._receive(results, workers))
+                (slot, layout) = pending.pop(done)
+                done += 1
+                out = tuple(np.ndarray(shape, np.dtype(dtype), buffer=shm.buf, offset=offset).copy()
+                            for (shape, dtype, offset) in layout)
+                a = next(args, None)
+                if a is not None:
+                    tasks.put((next_id, slot, a))
+                    next_id += 1
+                yield out
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for w in workers:
+                w.join(timeout=5)
+                if w.is_alive():
+                    w.terminate()
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def _receive(results, workers):
+        while True:
+            try:
+                (task_id, slot, layout, error) = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not all(w.is_alive() for w in workers):
+                    raise RuntimeError('Tile producer process exited unexpectedly.')
+        if error is not None:
+            raise RuntimeError('Error loading data in tile producer:\n' + error)
+        return {task_id : (slot, layout)}
+
+def _fill(batch, count, items, start, take):
+    for (dest, src) in zip(batch, items):
+        dest[count:count + take] = src[start:start + take]
+
+def _batch_worker(k, num_workers, load_function, args, #pylint:disable=too-many-arguments,too-many-locals
+                  shm_name, layout, batch_size, free, results):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = {}
+    try:
+        def batch_arrays(slot):
+            if slot not in slots:
+                slots[slot] = [np.ndarray((batch_size,) + shape, dtype, buffer=shm.buf, offset=offset)
+                               for (shape, dtype, offset) in layout[slot]]
+            return slots[slot]
+        slot = None
+        count = 0
+        # tiles are assigned to workers in turn, so results are in a consistent order
+        for a in itertools.islice(args, k, None, num_workers):
+            parts = load_function(*a)
+            for items in ([parts] if isinstance(parts, tuple) else parts):
+                n = len(items[0])
+                start = 0
+                while start < n:
+                    if slot is None:
+                        slot = free.get()
+                        count = 0
+                    take = min(n - start, batch_size - count)
+                    with profiling.timed('batch'):
+                        _fill(batch_arrays(slot), count, items, start, take)
+                    count += take
+                    start += take
+                    if count == batch_size:
+                        results.put((slot, count, None))
+                        slot = None
+        if slot is not None and count > 0:
+            results.put((slot, count, None))
+        results.put((None, 0, None))
+    except Exception: #pylint:disable=broad-except
+        results.put((None, 0, traceback.format_exc()))
+    finally:
+        slots.clear()
+        shm.close()
+
+class BatchProducer:
+    """
+    Produces fixed size batches of items with a pool of processes, filling each batch in shared memory.
+
+    `load_function` returns a tuple of arrays for each argument tuple from `args_function`, where the
+    first dimension of each array is the items (for example, the chunks of an image tile and their labels),
+    or yields several such tuples, so not all the items need to be in memory at once.
+    Workers fill batches of `batch_size` items, with each item of the shape and dtype given
+    in `item_specs`, a list of (shape, dtype) for each array. Each worker loads every
+    `num_processes`-th argument and batches are taken from the workers in turn, so the
+    order of the batches is consistent. The last batch of each worker may be smaller.
+
+    Each yielded array is copied out of shared memory once, so the slot can be reused immediately.
+    The arrays are not views of the shared memory because `tf.data.Dataset.from_generator`
+    keeps aligned arrays as tensors without copying them, and those tensors may be kept for any time.
+    """
+    #pylint:disable=too-many-arguments
+    def __init__(self, load_function, args_function, num_processes, batch_size, item_specs, slots_per_process=3):
+        self._load_function = load_function
+        self._args_function = args_function
+        self._num_processes = max(1, num_processes)
+        self._batch_size = batch_size
+        self._item_specs = [(tuple(shape), np.dtype(dtype)) for (shape, dtype) in item_specs]
+        self._slots_per_process = slots_per_process
+
+    def __call__(self):
+        """Returns a generator of the results, suitable for `tf.data.Dataset.from_generator`."""
+        return iter(self)
+
+    def _layout(self):
+        """Returns the (shape, dtype, offset) of each array in each slot, and the total size."""
+        layout = []
+        offset = 0
+        for _ in range(self._num_processes * self._slots_per_process):
+            arrays = []
+            for (shape, dtype) in self._item_specs:
+                arrays.append((shape, dtype, offset))
+                offset = _aligned(offset + self._batch_size * int(np.prod(shape)) * dtype.itemsize)
+            layout.append(arrays)
+        return (layout, max(offset, 1))
+
+    def __iter__(self): #pylint:disable=too-many-locals
+        ctx = multiprocessing.get_context('fork')
+        (layout, size) = self._layout()
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        free = [ctx.Queue() for _ in range(self._num_processes)]
+        results = [ctx.Queue() for _ in range(self._num_processes)]
+        for k in range(self._num_processes):
+            for j in range(self._slots_per_process):
+                free[k].put(k * self._slots_per_process + j)
+        # called here so any state args_function keeps is updated in this process,
+        # then each worker iterates its own forked copy
+        args = self._args_function()
+        workers = [ctx.Process(target=_batch_worker, daemon=True,
+                               args=(k, self._num_processes, self._load_function, args,
+                                     shm.name, layout, self._batch_size, free[k], results[k]))
+                   for k in range(self._num_processes)]
+        try:
+            for w in workers:
+                w.start()
+            active = list(range(self._num_processes))
+            while active:
+                for k in list(active):
+                    (slot, count, error) = self._receive(results[k], workers[k])
+                    if error is not None:
+                        raise RuntimeError('Error loading data in batch producer:\n' + error)
+                    if slot is None:
+                        active.remove(k)
+                        continue
+                    arrays = tuple(np.ndarray((count,) + shape, dtype, buffer=shm.buf, offset=offset).copy()
+                                   for (shape, dtype, offset) in layout[slot])
+                    free[k].put(slot)
+                    yield arrays
+        finally:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join()
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def _receive(results, worker):
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not worker.is_alive():
+                    break
+        # the worker may have exited just after sending its last result
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            raise RuntimeError('Batch producer process exited unexpectedly.')
@@ -18,32 +18,237 @@
 """
 Miscellaneous utility classes/functions.
 """
+import concurrent.futures
+import json
 import os
 import sys
 import shutil
+import tempfile
 import zipfile
 import tarfile
 
-def unpack_to_folder(compressed_path, unpack_folder):
+import portalocker
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+def _is_zip(compressed_path):
+    return os.path.splitext(compressed_path)[1].lower() == '.zip'
+
+def _member_path(unpack_folder, name):
+    """Returns where to write an archive member, or None if it would be outside unpack_folder."""
+    path = os.path.normpath(os.path.join(unpack_folder, name))
+    if not path.startswith(os.path.normpath(unpack_folder) + os.sep):
+        return None
+    return path
+
+def _write_member(src, path):
     """
-    Unpack a file into the given folder.
+    Copy a file object to path, only creating path once the copy is complete. The copy is
+    written to a uniquely named file first, so processes extracting the same file at once
+    each move a complete copy into place.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(suffix='.part', prefix='.' + os.path.basename(path) + '_',
+                                      dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst, _COPY_BUFFER_SIZE)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+def _extract_zip_member(compressed_path, name, path):
+    # each thread uses its own handle so members are decompressed in parallel
+    with zipfile.ZipFile(compressed_path, 'r') as zf:
+        with zf.open(name) as src:
+            return _write_member(src, path)
+
+def _extract_tar_members(compressed_path, unpack_folder, members):
+    """Extract the tar members matching members in a single pass, returning the paths written."""
+    paths = []
+    # compressed tar files can only be read sequentially, so stream through once
+    with tarfile.open(compressed_path, 'r|*') as tf:
+        for m in tf:
+            if not m.isfile() or (members is not None and not members(m.name)):
+                continue
+            p = _member_path(unpack_folder, m.name)
+            if p is None:
+                raise IOError('Archive member %s would be extracted outside of %s.' % (m.name, unpack_folder))
+            with tf.extractfile(m) as src:
+                paths.append(_write_member(src, p))
+    return paths
+
+def extract_members(compressed_path, unpack_folder, members=None, threads=None):
+    """
+    Start extracting files from a zip or tar archive into the given folder, in the background.
+
+    If `members` is specified, it is a function taking the name of a file in the
+    archive and returning True if it should be extracted. Otherwise all files are
+    extracted. Members of zip files are decompressed in parallel with `threads`
+    threads (default: one per CPU) and this function returns immediately. Tar files
+    can only be read sequentially, and are extracted in a single pass before returning.
+
+    Returns a dictionary mapping the path of each file being extracted to a
+    `concurrent.futures.Future`, which completes once that file has been fully written.
+    Files appear at their final path only once they are complete.
+    """
+    result = {}
+    if not _is_zip(compressed_path): # Assume a tar file
+        for p in _extract_tar_members(compressed_path, unpack_folder, members):
+            result[p] = concurrent.futures.Future()
+            result[p].set_result(p)
+        return result
+
+    with zipfile.ZipFile(compressed_path, 'r') as zf:
+        names = [i.filename for i in zf.infolist() if not i.is_dir()]
+    if members is not None:
+        names = [n for n in names if members(n)]
+    if not names:
+        return result
+    paths = {}
+    for n in names:
+        p = _member_path(unpack_folder, n)
+        if p is None:
+            raise IOError('Archive member %s would be extracted outside of %s.' % (n, unpack_folder))
+        paths[n] = p
+
+    if threads is None:
+        threads = os.cpu_count()
+    exe = concurrent.futures.ThreadPoolExecutor(max(1, min(threads, len(paths))))
+    for (n, p) in paths.items():
+        result[p] = exe.submit(_extract_zip_member, compressed_path, n, p)
+    exe.shutdown(wait=False)
+    return result
+
+def _is_compressed_tar(compressed_path):
+    try:
+        with tarfile.open(compressed_path, 'r:'):
+            return False
+    except tarfile.ReadError:
+        return True
+
+def in_place_paths(compressed_path, members, force=False):
     """
+    Find files in a zip or tar archive that GDAL can read without extracting them.
 
-    tmpdir = os.path.normpath(unpack_folder) + '_working'
+    Returns a dictionary mapping the names of the archive files for which `members(name)`
+    is true to GDAL virtual file paths (using `/vsizip/` or `/vsitar/`). Unless `force`
+    is true, only files stored without compression are included, since GDAL must
+    decompress compressed files from the start to seek within them.
+    """
+    path = os.path.abspath(compressed_path)
+    result = {}
+    if _is_zip(path):
+        with zipfile.ZipFile(path, 'r') as zf:
+            for i in zf.infolist():
+                if i.is_dir() or not members(i.filename):
+                    continue
+                if force or i.compress_type == zipfile.ZIP_STORED:
+                    result[i.filename] = '/vsizip/' + path + '/' + i.filename
+        return result
+
+    if not force and _is_compressed_tar(path):
+        return result
+    with tarfile.open(path, 'r:*') as tf:
+        for m in tf.getmembers():
+            if m.isfile() and members(m.name):
+                result[m.name] = '/vsitar/' + path + '/' + m.name
+    return result
+
+def unpack_to_folder(compressed_path, unpack_folder, members=None, threads=None):
+    """
+    Unpack a file into the given folder.
 
-    ext = os.path.splitext(compressed_path)[1]
+    If `members` is specified, only the archive files for which `members(name)` is
+    true are extracted, directly into the existing folder. Otherwise the whole archive
+    is unpacked and moved into place once complete. See `extract_members`.
+    """
+    if members is not None:
+        for f in extract_members(compressed_path, unpack_folder, members, threads).values():
+            f.result()
+        return
+
+    # unique per process, so processes unpacking the same archive don't write over each other
+    unpack_folder = os.path.normpath(unpack_folder)
+    os.makedirs(os.path.dirname(os.path.abspath(unpack_folder)), exist_ok=True)
+    tmpdir = tempfile.mkdtemp(suffix='_working', prefix=os.path.basename(unpack_folder) + '_',
+                              dir=os.path.dirname(unpack_folder))
     try:
-        if ext.lower() == '.zip':
-            with zipfile.ZipFile(compressed_path, 'r') as zf:
-                zf.extractall(tmpdir)
-        else: # Assume a tar file
-            with tarfile.TarFile(compressed_path, 'r') as tf:
-                tf.extractall(tmpdir)
+        for f in extract_members(compressed_path, tmpdir, threads=threads).values():
+            f.result()
     except:
-        shutil.rmtree(tmpdir)
+        shutil.rmtree(tmpdir, ignore_errors=True)
         raise
     # make this atomic so we don't have incomplete data
-    os.rename(tmpdir, unpack_folder)
+    try:
+        os.rename(tmpdir, unpack_folder)
+    except OSError:
+        # another process finished first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(unpack_folder):
+            raise
+
+def source_paths(source):
+    """
+    Returns a list of absolute paths from an image source, either a single path
+    or a list of paths (see `delta.imagery.sources.delta_image.DeltaImage.source`).
+    """
+    return [os.path.abspath(p) for p in ([source] if isinstance(source, str) else source)]
+
+def modified_time(paths):
+    """
+    Returns the latest modification time of the files, or for folders, any file in the folder.
+    """
+    mtime = 0.0
+    for p in paths:
+        mtime = max(mtime, os.path.getmtime(p))
+        if os.path.isdir(p):
+            for f in os.listdir(p):
+                mtime = max(mtime, os.path.getmtime(os.path.join(p, f)))
+    return mtime
+
+class LockedJSON:
+    """
+    A dictionary stored in a JSON file which may be shared by multiple processes. Hold
+    the lock from `lock` around `load` and `save`, including between a `load` and the `save`
+    of the modified dictionary.
+    """
+    def __init__(self, path, field, lock_path=None, lock_timeout=300):
+        """
+        Stores the dictionary under `field` in the file `path`. The lock file is
+        `lock_path`, by default `path` with `.lock` appended.
+        """
+        self._path = path
+        self._field = field
+        self._lock_path = path + '.lock' if lock_path is None else lock_path
+        self._lock_timeout = lock_timeout
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def path(self):
+        """The JSON file."""
+        return self._path
+
+    def lock(self):
+        """Returns a context manager holding the lock file."""
+        return portalocker.Lock(self._lock_path, timeout=self._lock_timeout)
+
+    def load(self):
+        """Returns the dictionary, or an empty one if the file is missing or invalid."""
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)[self._field]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save(self, items):
+        """Atomically replaces the file with the dictionary `items`."""
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({self._field : items}, f)
+        os.replace(tmp_path, self._path)
 
 def progress_bar(text, fill_amount, prefix = '', length = 80): #pylint: disable=W0613
     """
@@ -0,0 +1,130 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Data parallel training with several worker processes, on one machine or across hosts.
+
+Each worker is described by the `TF_CONFIG` environment variable, in TensorFlow's format:
+`{"cluster": {"worker": ["host:port", ...]}, "task": {"type": "worker", "index": i}}`.
+`launch` starts workers on the local machine, and `load_cluster` sets `TF_CONFIG` from a
+file for a worker on one of several hosts.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import tensorflow as tf
+
+_STRATEGY = None
+
+def _cluster():
+    """Returns the parsed `TF_CONFIG`, or None if not set."""
+    tf_config = os.environ.get('TF_CONFIG')
+    return json.loads(tf_config) if tf_config else None
+
+def load_cluster(filename):
+    """
+    Sets `TF_CONFIG` from the json file `filename`, describing the cluster and this worker's task.
+    """
+    with open(filename, 'r') as f:
+        tf_config = json.load(f)
+    if 'cluster' not in tf_config or 'task' not in tf_config:
+        raise ValueError('%s must have cluster and task entries.' % (filename))
+    os.environ['TF_CONFIG'] = json.dumps(tf_config)
+
+def num_workers():
+    """
+    Number of workers training together, 1 if not part of a cluster.
+    """
+    tf_config = _cluster()
+    if tf_config is None:
+        return 1
+    cluster = tf_config['cluster']
+    return len(cluster.get('chief', [])) + len(cluster.get('worker', []))
+
+def worker_index():
+    """
+    Index of this worker in the cluster, where 0 is the chief.
+    """
+    tf_config = _cluster()
+    if tf_config is None:
+        return 0
+    task = tf_config['task']
+    if task['type'] == 'chief':
+        return 0
+    return task['index'] + len(tf_config['cluster'].get('chief', []))
+
+def is_chief():
+    """
+    True if this is the worker that logs to MLFlow and saves the model.
+    """
+    return worker_index() == 0
+
+def strategy():
+    """
+    Returns a `MultiWorkerMirroredStrategy` if this is part of a cluster, otherwise None.
+    The strategy is created by the first call, which must be before TensorFlow runs any operations.
+    """
+    global _STRATEGY #pylint:disable=global-statement
+    if _STRATEGY is None and num_workers() > 1:
+        _STRATEGY = tf.distribute.MultiWorkerMirroredStrategy()
+    return _STRATEGY
+
+def _free_ports(count):
+    """Returns `count` ports that are currently free on the local machine."""
+    sockets = []
+    for _ in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def launch(workers, args=None):
+    """
+    Runs the command `args`, by default this program with the same arguments, in `workers`
+    processes on the local machine, each a worker in one cluster. If any worker fails, the
+    others are stopped, since they would wait for it forever. Returns the first nonzero exit code, or 0.
+    """
+    if args is None:
+        args = [sys.executable] + sys.argv
+    cluster = {'worker': ['localhost:%d' % (p) for p in _free_ports(workers)]}
+    processes = []
+    for i in range(workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': i}})
+        processes.append(subprocess.Popen(args, env=env))
+    result = 0
+    try:
+        while any(p.poll() is None for p in processes):
+            result = next((p.returncode for p in processes if p.returncode), 0)
+            if result:
+                break
+            time.sleep(0.5)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+    return result or next((p.returncode for p in processes if p.returncode), 0)
@@ -31,7 +31,7 @@ class ValidationSet:#pylint:disable=too-few-public-methods
     """
     Specifies the images and labels in a validation set.
     """
-    def __init__(self, images=None, labels=None, from_training=False, steps=1000):
+    def __init__(self, images=None, labels=None, from_training=False, steps=1000, cache='memory'):
         """
         Uses the specified `delta.imagery.sources.ImageSet`s images and labels.
 
@@ -39,18 +39,24 @@ class ValidationSet:#pylint:disable=too-few-public-methods
         before they are used for training.
 
         The number of samples to use for validation is set by `steps`.
+
+        The validation samples are loaded once and then kept in memory if `cache` is `memory`,
+        or in files in the cache directory if it is `disk`. If `none`, they are loaded
+        again for every validation.
         """
         self.images = images
         self.labels = labels
         self.from_training = from_training
         self.steps = steps
+        self.cache = cache
 
 class TrainingSpec:#pylint:disable=too-few-public-methods,too-many-arguments
     """
     Options used in training by `delta.ml.train.train`.
     """
     def __init__(self, batch_size, epochs, loss_function, metrics, validation=None, steps=None,
-                 chunk_stride=1, optimizer='adam'):
+                 chunk_stride=1, optimizer='adam', class_balance=None, precision='float32', native_input=False,
+                 class_samples=0.5):
         self.batch_size = batch_size
         self.epochs = epochs
         self.loss_function = loss_function
@@ -59,6 +65,10 @@ class TrainingSpec:#pylint:disable=too-few-public-methods,too-many-arguments
         self.metrics = metrics
         self.chunk_stride = chunk_stride
         self.optimizer = optimizer
+        self.class_balance = class_balance
+        self.class_samples = class_samples
+        self.precision = precision
+        self.native_input = native_input
 
 class NetworkModelConfig(config.DeltaConfigComponent):
     def __init__(self):
@@ -109,6 +119,12 @@ class NetworkConfig(config.DeltaConfigComponent):
         group = parser.add_argument_group('Network')
         super().setup_arg_parser(group, components)
 
+_VALIDATION_CACHES = ['memory', 'disk', 'none']
+def _validate_cache(cache, _):
+    if cache not in _VALIDATION_CACHES:
+        raise ValueError('cache must be one of %s, is %s.' % (', '.join(_VALIDATION_CACHES), cache))
+    return cache
+
 class ValidationConfig(config.DeltaConfigComponent):
     def __init__(self):
         super().__init__()
@@ -116,6 +132,8 @@ class ValidationConfig(config.DeltaConfigComponent):
                             'If from training, validate for this many steps.')
         self.register_field('from_training', bool, 'from_training', None, None,
                             'Take validation data from training data.')
+        self.register_field('cache', str, 'cache', None, _validate_cache,
+                            'Where to keep validation data after it is first loaded: memory, disk or none.')
         self.register_component(ImageSetConfig(), 'images')
         self.register_component(ImageSetConfig(), 'labels')
         self.__images = None
@@ -144,6 +162,32 @@ class ValidationConfig(config.DeltaConfigComponent):
                                                                 self._components['labels'])
         return self.__labels
 
+_PRECISIONS = ['float32', 'mixed_float16', 'mixed_bfloat16', 'auto']
+def _validate_precision(precision, _):
+    if precision not in _PRECISIONS:
+        raise ValueError('precision must be one of %s, is %s.' % (', '.join(_PRECISIONS), precision))
+    return precision
+
+class ProfileConfig(config.DeltaConfigComponent):
+    def __init__(self):
+        super().__init__()
+        self.register_field('enabled', bool, 'enabled', None, None,
+                            'Time the input pipeline and training steps, and report the bottleneck.')
+        self.register_field('trace_start', int, 'trace_start', None, None,
+                            'Step to start a tf.profiler trace at.')
+        self.register_field('trace_steps', int, 'trace_steps', None, None,
+                            'Number of steps to trace with tf.profiler, 0 for no trace.')
+        self.register_field('dir', str, None, None, None, 'Directory to save tf.profiler traces in.')
+
+    def dir(self) -> str:
+        """
+        Returns the directory to save tf.profiler traces in.
+        """
+        d = self._config_dict['dir']
+        if d == 'default':
+            d = os.path.join(appdirs.AppDirs('delta', 'nasa').user_data_dir, 'profile')
+        return d
+
 class TrainingConfig(config.DeltaConfigComponent):
     def __init__(self):
         super().__init__()
@@ -157,8 +201,18 @@ class TrainingConfig(config.DeltaConfigComponent):
         self.register_field('metrics', list, None, None, None, 'List of metrics to apply.')
         self.register_field('steps', int, None, '--steps', config.validate_positive, 'Batches to train per epoch.')
         self.register_field('optimizer', str, None, None, None, 'Keras optimizer to use.')
+        self.register_field('class_balance', list, None, None, None,
+                            'Target proportion of each label class, to sample training tiles.')
+        self.register_field('class_samples', (int, float), None, None, config.validate_positive,
+                            'Number of tiles to sample with class_balance, or a fraction of the tiles with labels.')
+        self.register_field('precision', str, None, '--precision', _validate_precision,
+                            'Keras mixed precision policy to train with: float32, mixed_float16, mixed_bfloat16 '
+                            'or auto to pick what the hardware supports.')
+        self.register_field('native_input', bool, None, None, None,
+                            'Keep integer imagery in its own type in the input pipeline, and scale it on the device.')
         self.register_component(ValidationConfig(), 'validation')
         self.register_component(NetworkConfig(), 'network')
+        self.register_component(ProfileConfig(), 'profile')
         self.__training = None
 
     def setup_arg_parser(self, parser, components = None) -> None:
@@ -175,7 +229,8 @@ class TrainingConfig(config.DeltaConfigComponent):
             (vimg, vlabels) = (None, None)
             if not from_training:
                 (vimg, vlabels) = (self._components['validation'].images(), self._components['validation'].labels())
-            validation = ValidationSet(vimg, vlabels, from_training, vsteps)
+            validation = ValidationSet(vimg, vlabels, from_training, vsteps,
+                                       self._components['validation'].cache())
             self.__training = TrainingSpec(batch_size=self._config_dict['batch_size'],
                                            epochs=self._config_dict['epochs'],
                                            loss_function=self._config_dict['loss_function'],
@@ -183,10 +238,21 @@ class TrainingConfig(config.DeltaConfigComponent):
                                            validation=validation,
                                            steps=self._config_dict['steps'],
                                            chunk_stride=self._config_dict['chunk_stride'],
-                                           optimizer=self._config_dict['optimizer'])
+                                           optimizer=self._config_dict['optimizer'],
+                                           class_balance=self._config_dict['class_balance'],
+                                           class_samples=self._config_dict['class_samples'],
+                                           precision=self._config_dict['precision'],
+                                           native_input=self._config_dict['native_input'])
         return self.__training
 
 
+_CHECKPOINT_FORMATS = ['h5', 'tf']
+
+def _validate_checkpoint_format(checkpoint_format, _):
+    if checkpoint_format not in _CHECKPOINT_FORMATS:
+        raise ValueError('format must be one of %s, is %s.' % (', '.join(_CHECKPOINT_FORMATS), checkpoint_format))
+    return checkpoint_format
+
 class MLFlowCheckpointsConfig(config.DeltaConfigComponent):
     def __init__(self):
         super().__init__()
@@ -194,6 +260,20 @@ class MLFlowCheckpointsConfig(config.DeltaConfigComponent):
                             'Frequency in batches to store neural network checkpoints.')
         self.register_field('save_latest', bool, 'save_latest', None, None,
                             'If true, only keep the most recent checkpoint.')
+        self.register_field('format', str, 'format', None, _validate_checkpoint_format,
+                            'Save whole models to MLFlow (h5), or only variables with tf.train.Checkpoint (tf).')
+        self.register_field('keep', int, 'keep', None, config.validate_positive,
+                            'Number of tf format checkpoints to keep.')
+        self.register_field('dir', str, None, None, None, 'Directory to save tf format checkpoints in.')
+
+    def dir(self) -> str:
+        """
+        Returns the directory to save tf format checkpoints in, each run in a subdirectory.
+        """
+        d = self._config_dict['dir']
+        if d == 'default':
+            d = os.path.join(appdirs.AppDirs('delta', 'nasa').user_data_dir, 'checkpoints')
+        return d
 
 class MLFlowConfig(config.DeltaConfigComponent):
     def __init__(self):
@@ -229,6 +309,11 @@ class TensorboardConfig(config.DeltaConfigComponent):
             tbd = os.path.join(appdirs.AppDirs('delta', 'nasa').user_data_dir, 'tensorboard')
         return tbd
 
+def _validate_workers(workers, _):
+    if workers < 1:
+        raise ValueError('workers must be at least 1, is %s.' % (workers))
+    return workers
+
 def register():
     """
     Registers imagery config options with the global config manager.
@@ -238,6 +323,10 @@ def register():
     if not hasattr(config.config, 'general'):
         config.config.register_component(config.DeltaConfigComponent('General'), 'general')
     config.config.general.register_field('gpus', int, 'gpus', '--gpus', None, 'Number of gpus to use.')
+    config.config.general.register_field('workers', int, 'workers', '--workers', _validate_workers,
+                                         'Number of worker processes to train with on this machine.')
+    config.config.general.register_field('cluster', str, 'cluster', '--cluster', None,
+                                         'TF_CONFIG json file describing this worker of a multi-host cluster.')
 
     config.config.register_component(TrainingConfig(), 'train')
     config.config.register_component(MLFlowConfig(), 'mlflow')
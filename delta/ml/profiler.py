@@ -0,0 +1,149 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure training throughput, and find whether it is limited by the input pipeline or the network.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from delta.imagery import profiling
+
+# training is input bound if steps wait for batches more than this fraction of the time
+_STALL_THRESHOLD = 0.1
+
+class ProfileCallback(tf.keras.callbacks.Callback):
+    """
+    Times training steps and how long each waits for its batch, and reports the bottleneck
+    at the end of training, with the input pipeline stage times from `delta.imagery.profiling`.
+    The training dataset must be wrapped with `probe`, so the callback knows when each batch is ready.
+
+    Optionally records a `tf.profiler` trace of `trace_steps` steps starting at `trace_start`.
+    """
+    def __init__(self, batch_size, threads=1, trace_dir=None, #pylint:disable=too-many-arguments
+                 trace_start=0, trace_steps=0):
+        """
+        `threads` is the number of threads or processes the input stages (other than tile generation)
+        run in parallel with.
+        """
+        super(ProfileCallback, self).__init__()
+        self._batch_size = batch_size
+        self._threads = max(threads, 1)
+        self._trace = (trace_dir, trace_start, trace_start + trace_steps) if trace_dir and trace_steps else None
+        self._tracing = False
+        # time each batch reached the end of the input pipeline
+        self._ready = []
+        self._step = 0
+        self._step_time = 0.0
+        self._wait = 0.0
+        self._begin = None
+        self._start = None
+        self.report = None
+
+    def _set_ready(self):
+        self._ready.append(time.perf_counter())
+        return np.float64(0.0)
+
+    def probe(self, ds):
+        """
+        Returns the dataset `ds`, recording when each batch is ready to train on.
+        """
+        def ready(*items):
+            record = tf.numpy_function(self._set_ready, [], tf.float64)
+            with tf.control_dependencies([record]):
+                return tuple(tf.identity(x) for x in items)
+        # the prefetch takes batches as soon as they are ready, so they wait in its buffer, not in the probe
+        return ds.map(ready).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def on_train_begin(self, _=None):
+        self._start = time.perf_counter()
+
+    # Keras passes logs by name to the batch callbacks
+    def on_train_batch_begin(self, batch, logs=None): #pylint: disable=unused-argument
+        if self._trace and self._step == self._trace[1]:
+            tf.profiler.experimental.start(self._trace[0])
+            self._tracing = True
+        self._begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None): #pylint: disable=unused-argument
+        end = time.perf_counter()
+        self._step_time += end - self._begin
+        if self._step < len(self._ready):
+            self._wait += max(0.0, min(self._ready[self._step], end) - self._begin)
+        self._step += 1
+        if self._tracing and self._step >= self._trace[2]:
+            self._stop_trace()
+
+    def on_train_end(self, _=None):
+        if self._tracing:
+            self._stop_trace()
+        self.report = self._report(time.perf_counter() - self._start)
+
+    def _stop_trace(self):
+        tf.profiler.experimental.stop()
+        self._tracing = False
+        print('Saved profiler trace to %s.' % (self._trace[0]))
+
+    def _report(self, elapsed):
+        if self._step == 0:
+            return None
+        stages = {s : 1000 * seconds / self._step for (s, (seconds, _)) in profiling.times().items()}
+        stall = self._wait / self._step_time if self._step_time > 0 else 0.0
+        step_ms = 1000 * self._step_time / self._step
+        # time per batch each stage would take alone, all stages but generating tiles are split between the threads
+        alone = {s : ms / (1 if s == 'tiles' else self._threads) for (s, ms) in stages.items()}
+        if stall <= _STALL_THRESHOLD:
+            bottleneck = 'train step'
+        elif not alone or max(alone.values()) < step_ms / 2:
+            # the timed stages don't explain the wait, look at the trace
+            bottleneck = 'tensorflow input operations'
+        else:
+            bottleneck = max(alone, key=alone.get)
+        return {'steps' : self._step,
+                'samples_per_second' : self._step * self._batch_size / elapsed,
+                'stall_percent' : 100 * stall,
+                'step_ms' : step_ms,
+                'wait_ms' : 1000 * self._wait / self._step,
+                'stage_ms' : stages,
+                'bottleneck' : bottleneck}
+
+def report_metrics(report):
+    """
+    Returns a dict of the numbers in a report from `ProfileCallback`, to log as metrics.
+    """
+    metrics = {'profile_' + k : v for (k, v) in report.items() if k not in ('stage_ms', 'bottleneck')}
+    metrics.update({'profile_%s_ms' % (s) : v for (s, v) in report['stage_ms'].items()})
+    return metrics
+
+def print_report(report, threads=1):
+    """
+    Prints a report from `ProfileCallback`.
+    """
+    print('Profile of %d training steps:' % (report['steps']))
+    print('  Samples per second: %12.1f' % (report['samples_per_second']))
+    print('  Stalled on input:   %11.1f%%' % (report['stall_percent']))
+    print('  Train step:         %9.1f ms (%.1f ms waiting for input)' % (report['step_ms'], report['wait_ms']))
+    if report['stage_ms']:
+        print('  Input stages, time per batch (split between %d threads after tiles):' % (threads))
+        for (s, ms) in report['stage_ms'].items():
+            print('    %-16s  %9.2f ms' % (s, ms))
+    if 'read_overhead_percent' in report:
+        print('  Pixels read twice:  %11.1f%%' % (report['read_overhead_percent']))
+    print('  Bottleneck:         %s' % (report['bottleneck']))
@@ -19,15 +19,24 @@
 Train neural networks.
 """
 
+import json
 import os
+import queue
+import sys
 import tempfile
+import threading
+import time
 import shutil
 
 import mlflow
+from mlflow.entities import Metric
+import numpy as np
 import tensorflow as tf
 
 from delta.config import config
+from delta.imagery import profiling
 from delta.imagery.imagery_dataset import ImageryDataset
+from . import distributed, profiler
 from .layers import DeltaLayer
 
 def _devices(num_gpus):
@@ -50,29 +59,153 @@ def _devices(num_gpus):
     return devs
 
 def _strategy(devices):
-    '''Given a list of TensorFlow Logical Devices, returns a distribution strategy.'''
-    strategy = None
+    '''
+    Given a list of TensorFlow Logical Devices, returns a distribution strategy.
+    When training with several workers, returns the strategy for all of them instead.
+    '''
+    strategy = distributed.strategy()
+    if strategy is not None:
+        return strategy
     if len(devices) == 1:
         strategy = tf.distribute.OneDeviceStrategy(device=devices[0])
     else:
         strategy = tf.distribute.MirroredStrategy(devices=devices)
     return strategy
 
-def _prep_datasets(ids, tc, chunk_size, output_size):
-    ds = ids.dataset()
-    ds = ds.batch(tc.batch_size)
+def _set_policy(policy):
+    """Sets the global Keras mixed precision policy."""
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+def _global_policy():
+    """Returns the global Keras mixed precision policy."""
+    return tf.keras.mixed_precision.global_policy()
+
+def _cpu_supports_bfloat16():
+    """True if the CPU has bfloat16 instructions."""
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def _precision_policy(precision, num_gpus):
+    '''
+    Returns the Keras mixed precision policy for the `train.precision` option. For auto, uses
+    float16 on GPUs with tensor cores, bfloat16 on CPUs with bfloat16 instructions, and otherwise float32.
+    '''
+    if precision != 'auto':
+        return precision
+    if num_gpus == 0:
+        return 'mixed_bfloat16' if _cpu_supports_bfloat16() else 'float32'
+    for gpu in tf.config.list_physical_devices('GPU'):
+        details = tf.config.experimental.get_device_details(gpu)
+        if details.get('compute_capability', (0, 0)) >= (7, 0):
+            return 'mixed_float16'
+    return 'float32'
+
+class _DeviceInput(tf.keras.layers.Layer):
+    """
+    Converts chunks to float32 on the device, and applies the images' scale and offset preprocessing
+    if the chunks are in the images' own data type.
+    """
+    def __init__(self, gain=1.0, offset=0.0, **kwargs):
+        kwargs['dtype'] = 'float32'
+        super(_DeviceInput, self).__init__(**kwargs)
+        self._gain = np.asarray(gain, np.float32)
+        self._offset = np.asarray(offset, np.float32)
+
+    def get_config(self):
+        c = super(_DeviceInput, self).get_config()
+        c.update({'gain' : self._gain.tolist(), 'offset' : self._offset.tolist()})
+        return c
+
+    def call(self, inputs, **kwargs): # pylint: disable=unused-argument,arguments-differ
+        x = tf.cast(inputs, tf.float32)
+        if np.any(self._gain != 1.0) or np.any(self._offset != 0.0):
+            x = x * self._gain + self._offset
+        return x
+
+def _device_input_model(model, dataset):
+    """
+    Wraps `model` so it takes chunks of the dataset's data type, converts and preprocesses them
+    on the device, and outputs float32 even if the model uses mixed precision.
+    """
+    transform = dataset.input_transform()
+    (gain, offset) = transform if transform is not None else (1.0, 0.0)
+    inputs = tf.keras.Input(shape=model.get_input_at(0).shape[1:], dtype=dataset.data_type())
+    x = _DeviceInput(gain, offset)(inputs)
+    x = model(x)
+    outputs = tf.keras.layers.Activation('linear', dtype='float32')(x)
+    return tf.keras.Model(inputs, outputs)
+
+def _build_model(model_fn, dataset, training_spec, policy):
+    """
+    Builds and compiles the model. Returns the model and the model to fit, which is the model wrapped
+    with `_device_input_model` if the chunks are in the images' own data type or mixed precision is used.
+    """
+    wrap = dataset.input_transform() is not None or policy != 'float32'
+    if isinstance(model_fn, tf.keras.Model):
+        if not wrap:
+            return (model_fn, model_fn)
+        model = model_fn
+        (optimizer, loss) = (model.optimizer, model.loss)
+    with _strategy(_devices(config.general.gpus())).scope():
+        if not isinstance(model_fn, tf.keras.Model):
+            model = model_fn()
+            assert isinstance(model, tf.keras.models.Model),\
+                   "Model is not a Tensorflow Keras model"
+            (optimizer, loss) = (training_spec.optimizer, training_spec.loss_function)
+        fit_model = _device_input_model(model, dataset) if wrap else model
+        # TODO: specify learning rate and optimizer parameters, change learning rate over time
+        fit_model.compile(optimizer=optimizer, loss=loss, metrics=training_spec.metrics)
+    return (model, fit_model)
+
+def _cache_validation(validation, cache, cache_dir):
+    """
+    Keep the validation batches after they are first loaded, so the same samples are used for every
+    validation and they are only read once.
+    """
+    if cache == 'memory':
+        return validation.cache()
+    if cache == 'disk':
+        return validation.cache(os.path.join(cache_dir, 'validation'))
+    return validation
+
+def _same_transform(a, b):
+    if a is None or b is None:
+        return a is b
+    return all(np.array_equal(x, y) for (x, y) in zip(a, b))
+
+def _prep_datasets(ids, tc, chunk_size, output_size, cache_dir=None):
+    held_out = None
+    if tc.validation and tc.validation.from_training and hasattr(ids, 'split_validation'):
+        # hold out whole tiles, so training doesn't load the validation batches only to skip them
+        held_out = ids.split_validation(tc.validation.steps * tc.batch_size)
+    ds = ids.batches(tc.batch_size)
     if tc.validation:
         if tc.validation.from_training:
-            validation = ds.take(tc.validation.steps)
-            ds = ds.skip(tc.validation.steps)
+            if held_out is not None:
+                validation = held_out.batches(tc.batch_size).take(tc.validation.steps)
+            else:
+                # shards have no tiles to hold out
+                validation = ds.take(tc.validation.steps)
+                ds = ds.skip(tc.validation.steps)
         else:
             vimg = tc.validation.images
             vlabel = tc.validation.labels
             if not vimg or not vlabel:
                 validation = None
             else:
-                vimagery = ImageryDataset(vimg, vlabel, chunk_size, output_size, tc.chunk_stride)
-                validation = vimagery.dataset().batch(tc.batch_size).take(tc.validation.steps)
+                vimagery = ImageryDataset(vimg, vlabel, chunk_size, output_size, tc.chunk_stride,
+                                          native_input=tc.native_input)
+                if vimagery.data_type() != ids.data_type() or \
+                   not _same_transform(vimagery.input_transform(), ids.input_transform()):
+                    raise ValueError('Validation images must have the same data type and preprocessing '
+                                     'as the training images with native_input.')
+                validation = vimagery.batches(tc.batch_size).take(tc.validation.steps)
+        if validation is not None:
+            validation = _cache_validation(validation, tc.validation.cache, cache_dir)
     else:
         validation = None
     if tc.steps:
@@ -94,46 +227,237 @@ def _log_mlflow_params(model, dataset, training_spec):
     mlflow.log_param('Epochs', training_spec.epochs)
     mlflow.log_param('Batch Size', training_spec.batch_size)
     mlflow.log_param('Optimizer', training_spec.optimizer)
+    mlflow.log_param('Precision', training_spec.precision)
+    mlflow.log_param('Input Type', dataset.data_type().name)
     mlflow.log_param('Model Layers', len(model.layers))
     #mlflow.log_param('Status', 'Running')
 
+def _cursor_filename(checkpoint):
+    """Filename of the dataset cursor saved with a checkpoint."""
+    return os.path.splitext(checkpoint)[0] + '.cursor.json'
+
+def _checkpoint(model, optimizer):
+    """The `tf.train.Checkpoint` for tf format checkpoints, of the model's variables and the optimizer state."""
+    return tf.train.Checkpoint(model=model, optimizer=optimizer)
+
+def _checkpoint_options():
+    """Options to write checkpoints in the background, if this version of TensorFlow can."""
+    try:
+        return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except (AttributeError, TypeError):
+        return None
+
+def find_checkpoint(path):
+    """
+    If `path` is a tf format checkpoint, or a directory of them, returns the checkpoint's
+    prefix (the latest checkpoint for a directory). Otherwise returns None.
+    """
+    if os.path.isdir(path):
+        return tf.train.latest_checkpoint(path)
+    if os.path.exists(path + '.index'):
+        return path
+    return None
+
+def restore_cursor(dataset, checkpoint):
+    """
+    If a dataset cursor was saved with the checkpoint `checkpoint`, continue the
+    dataset from there. Returns True if the cursor was restored.
+    """
+    filename = _cursor_filename(checkpoint)
+    if not isinstance(dataset, ImageryDataset) or not os.path.exists(filename):
+        return False
+    with open(filename, 'r') as f:
+        dataset.set_cursor(json.load(f))
+    return True
+
+class _MLFlowLogger:
+    """
+    Logs metrics and artifacts to an MLFlow run from a background thread, so training never
+    waits for the tracking store or the artifact filesystem. Metrics queued while the thread is busy
+    are sent together with `log_batch`.
+    """
+    # most metrics MLFlow accepts in one log_batch call
+    _BATCH_METRICS = 1000
+
+    def __init__(self, run_id):
+        self._client = mlflow.tracking.MlflowClient()
+        self._run_id = run_id
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log_metrics(self, metrics, step=0):
+        """Logs a dict of metric values."""
+        timestamp = int(time.time() * 1000)
+        self._queue.put([Metric(k, float(v), timestamp, step) for (k, v) in metrics.items()])
+
+    def log_artifact(self, filename, artifact_path=None):
+        """Uploads the file `filename`, and then deletes it."""
+        self._queue.put((filename, artifact_path))
+
+    def flush(self):
+        """Waits until everything queued has been logged."""
+        self._queue.join()
+
+    def close(self):
+        """Logs everything queued and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _log(self, items):
+        metrics = [m for item in items if isinstance(item, list) for m in item]
+        for i in range(0, len(metrics), self._BATCH_METRICS):
+            self._client.log_batch(self._run_id, metrics=metrics[i:i + self._BATCH_METRICS])
+        for (filename, artifact_path) in [item for item in items if isinstance(item, tuple)]:
+            try:
+                self._client.log_artifact(self._run_id, filename, artifact_path)
+            finally:
+                os.remove(filename)
+
+    def _run(self):
+        done = False
+        while not done:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in items
+            try:
+                self._log([item for item in items if item is not None])
+            except Exception as e: #pylint: disable=broad-except
+                print('Warning: failed to log to MLFlow: %s' % (e), file=sys.stderr)
+            for _ in items:
+                self._queue.task_done()
+
+class _DiscardLogger:
+    """
+    Stands in for `_MLFlowLogger` on training workers other than the chief. They must save
+    checkpoints too, since saving is collective with several workers, but nothing is logged:
+    metrics are dropped and saved files deleted.
+    """
+    def log_metrics(self, _metrics, step=0): #pylint: disable=no-self-use
+        pass
+
+    def log_artifact(self, filename, _artifact_path=None): #pylint: disable=no-self-use
+        os.remove(filename)
+
+    def flush(self): #pylint: disable=no-self-use
+        pass
+
+    def close(self): #pylint: disable=no-self-use
+        pass
+
 class _MLFlowCallback(tf.keras.callbacks.Callback):
     """
-    Callback to log everything for MLFlow.
+    Callback to log everything for MLFlow. Logging is done by a `_MLFlowLogger` in the background.
     """
-    def __init__(self, temp_dir):
+    def __init__(self, temp_dir, dataset=None, checkpoint_model=None, chief=True):
+        """
+        Checkpoints save `checkpoint_model` if given, such as the model inside the wrapper from
+        `_device_input_model`, and otherwise the model being trained. If not `chief`, this is another
+        training worker, which saves checkpoints in `temp_dir` and doesn't log them (see `_DiscardLogger`).
+        """
         super(_MLFlowCallback, self).__init__()
         self.epoch = 0
         self.batch = 0
         self.temp_dir = temp_dir
+        self.dataset = dataset
+        self.checkpoint_model = checkpoint_model
+        self.chief = chief
+        # batches trained, over all epochs
+        self.step = 0
+        # for tf format checkpoints
+        if chief:
+            run_id = mlflow.active_run().info.run_id
+            self.logger = _MLFlowLogger(run_id)
+            self.checkpoint_dir = os.path.join(config.mlflow.checkpoints.dir(), run_id)
+        else:
+            self.logger = _DiscardLogger()
+            self.checkpoint_dir = os.path.join(temp_dir, 'checkpoints')
+        self._checkpoint = None
+        self._manager = None
+
+    def _save_cursor(self, checkpoint):
+        """
+        Saves the dataset's position with a checkpoint, so training can continue from there.
+        Returns the filename, or None if there is no position to save.
+        """
+        if not isinstance(self.dataset, ImageryDataset):
+            return None
+        cursor = self.dataset.cursor()
+        if cursor is None:
+            return None
+        filename = _cursor_filename(checkpoint)
+        with open(filename, 'w') as f:
+            json.dump(cursor, f)
+        return filename
+
+    def _save_h5(self):
+        """Saves the whole model to MLFlow."""
+        # each checkpoint gets its own directory, since earlier ones may not be uploaded yet
+        name = 'latest.h5' if config.mlflow.checkpoints.save_latest() else '%d.h5' % (self.step)
+        filename = os.path.join(tempfile.mkdtemp(dir=self.temp_dir), name)
+        model = self.checkpoint_model if self.checkpoint_model is not None else self.model
+        model.save(filename, save_format='h5')
+        self.logger.log_artifact(filename, 'checkpoints')
+        cursor = self._save_cursor(filename)
+        if cursor:
+            self.logger.log_artifact(cursor, 'checkpoints')
+
+    def _save_tf(self):
+        """Saves the model's variables and optimizer state in the background, keeping the most recent ones."""
+        prefix = self._manager.save(checkpoint_number=self.step, options=_checkpoint_options())
+        self._save_cursor(prefix)
+        kept = set(_cursor_filename(c) for c in self._manager.checkpoints)
+        for name in os.listdir(self.checkpoint_dir):
+            filename = os.path.join(self.checkpoint_dir, name)
+            if name.endswith('.cursor.json') and filename not in kept:
+                os.remove(filename)
+
+    def on_train_begin(self, _=None):
+        if config.mlflow.checkpoints.format() == 'tf':
+            model = self.checkpoint_model if self.checkpoint_model is not None else self.model
+            self._checkpoint = _checkpoint(model, self.model.optimizer)
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            self._manager = tf.train.CheckpointManager(self._checkpoint, self.checkpoint_dir,
+                                                       config.mlflow.checkpoints.keep())
+            if self.chief:
+                mlflow.log_param('Checkpoints', self.checkpoint_dir)
+
+    def on_train_end(self, _=None):
+        # wait for checkpoints being written in the background
+        if self._checkpoint is not None and hasattr(self._checkpoint, 'sync'):
+            self._checkpoint.sync()
+
+    @staticmethod
+    def _metrics(logs, prefix=''):
+        return {prefix + k : logs[k] for k in logs.keys() if k not in ('batch', 'size')}
 
     def on_epoch_end(self, epoch, _=None):
         self.epoch = epoch
 
     def on_train_batch_end(self, batch, logs=None):
         self.batch = batch
+        self.step += 1
         if batch % config.mlflow.frequency() == 0:
-            for k in logs.keys():
-                if k in ('batch', 'size'):
-                    continue
-                mlflow.log_metric(k, logs[k].item(), step=batch)
-        if config.mlflow.checkpoints.frequency() and batch % config.mlflow.checkpoints.frequency() == 0:
-            filename = os.path.join(self.temp_dir, '%d.h5' % (batch))
-            self.model.save(filename, save_format='h5')
-            if config.mlflow.checkpoints.save_latest():
-                old = filename
-                filename = os.path.join(self.temp_dir, 'latest.h5')
-                os.rename(old, filename)
-            mlflow.log_artifact(filename, 'checkpoints')
-            os.remove(filename)
-
-    def on_test_batch_end(self, _, logs=None): # pylint:disable=no-self-use
-        for k in logs.keys():
-            if k in ('batch', 'size'):
-                continue
-            mlflow.log_metric('validation_' + k, logs[k].item())
+            self.logger.log_metrics(self._metrics(logs), step=batch)
+        # the first checkpoint is after frequency batches, not before any training
+        if config.mlflow.checkpoints.frequency() and self.step % config.mlflow.checkpoints.frequency() == 0:
+            if self._manager is not None:
+                self._save_tf()
+            else:
+                self._save_h5()
+
+    def on_test_end(self, logs=None):
+        # the final values over all validation batches
+        self.logger.log_metrics(self._metrics(logs, 'validation_'), step=self.batch)
 
 def _mlflow_train_setup(model, dataset, training_spec):
+    if not distributed.is_chief():
+        # every worker saves checkpoints, but only the chief logs to MLFlow
+        return _MLFlowCallback(tempfile.mkdtemp(), dataset, model, chief=False)
     mlflow.set_tracking_uri(config.mlflow.uri())
     mlflow.set_experiment(config.mlflow.experiment())
     mlflow.start_run()
@@ -146,92 +470,161 @@ def _mlflow_train_setup(model, dataset, training_spec):
     mlflow.log_artifact(fname)
     os.remove(fname)
 
-    return _MLFlowCallback(temp_dir)
+    return _MLFlowCallback(temp_dir, dataset, model)
 
-def train(model_fn, dataset : ImageryDataset, training_spec):
+def _shard_dataset(dataset, training_spec):
     """
-    Trains the specified model on a dataset according to a training
-    specification.
+    Makes this training worker load only its own part of the dataset, if there are several.
+    Returns the number of workers.
     """
-    if isinstance(model_fn, tf.keras.Model):
-        model = model_fn
-    else:
-        with _strategy(_devices(config.general.gpus())).scope():
-            model = model_fn()
-            assert isinstance(model, tf.keras.models.Model),\
-                   "Model is not a Tensorflow Keras model"
-            loss = training_spec.loss_function
-            # TODO: specify learning rate and optimizer parameters, change learning rate over time
-            model.compile(optimizer=training_spec.optimizer, loss=loss,
-                          metrics=training_spec.metrics)
+    workers = distributed.num_workers()
+    if workers > 1:
+        dataset.shard(distributed.worker_index(), workers)
+        if not training_spec.steps:
+            print('Warning: with several workers, set train.steps so they all finish each epoch together.',
+                  file=sys.stderr)
+    return workers
 
-    input_shape = model.get_input_at(0).shape
-    output_shape = model.get_output_at(0).shape
-    chunk_size = input_shape[1]
+def _worker_dataset(ds, workers):
+    """Returns the training dataset, which TensorFlow must not split again if each worker loads its own part."""
+    if workers <= 1:
+        return ds
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return ds.with_options(options)
 
-    assert len(input_shape) == 4, 'Input to network is wrong shape.'
-    assert input_shape[0] is None, 'Input is not batched.'
-    # The below may no longer be valid if we move to convolutional architectures.
-    assert input_shape[1] == input_shape[2], 'Input to network is not chunked'
-    assert len(output_shape) == 2 or output_shape[1] == output_shape[2], 'Output from network is not chunked'
-    assert input_shape[3] == dataset.num_bands(), 'Number of bands in model does not match data.'
-    # last element differs for the sparse metrics
-    assert output_shape[1:-1] == dataset.output_shape()[:-1], \
-            'Network output shape %s does not match label shape %s.' % (output_shape[1:], dataset.output_shape())
+def _profile_callback(training_spec):
+    """Returns a `delta.ml.profiler.ProfileCallback` if `train.profile` is enabled, otherwise None."""
+    if not config.train.profile.enabled():
+        return None
+    # before tile producer processes are started, so they time their stages too
+    profiling.enable()
+    return profiler.ProfileCallback(training_spec.batch_size, config.io.threads(), config.train.profile.dir(),
+                                    config.train.profile.trace_start(), config.train.profile.trace_steps())
 
-    (ds, validation) = _prep_datasets(dataset, training_spec, chunk_size, output_shape[1])
+def _report_profile(pcb, dataset, mcb):
+    """Prints the profiler's report after training, and logs it to MLFlow with the chief's `mcb`."""
+    if pcb is None or pcb.report is None:
+        return
+    if hasattr(dataset, 'read_overhead'):
+        pcb.report['read_overhead_percent'] = 100 * dataset.read_overhead()
+    profiler.print_report(pcb.report, config.io.threads())
+    if mcb is not None and mcb.chief:
+        mcb.logger.log_metrics(profiler.report_metrics(pcb.report))
+        mlflow.log_param('Bottleneck', pcb.report['bottleneck'])
 
+def _callbacks(model):
+    """Returns the callbacks of the model's `DeltaLayer`s, and for TensorBoard if enabled."""
     callbacks = []
-    # add callbacks from DeltaLayers
     for l in model.layers:
         if isinstance(l, DeltaLayer):
             c = l.callback()
             if c:
                 callbacks.append(c)
-    if config.tensorboard.enabled():
+    if config.tensorboard.enabled() and distributed.is_chief():
         tcb = tf.keras.callbacks.TensorBoard(log_dir=config.tensorboard.dir(),
                                              update_freq='epoch',
                                              histogram_freq=1,
                                              write_images=True,
                                              embeddings_freq=1)
         callbacks.append(tcb)
+    return callbacks
+
+def _save_model(mcb, model, name, action, status):
+    """
+    Saves the model as the MLFlow artifact `name` at the end of training, and logs the `status`.
+    Every worker saves, since saving is collective with several workers, but only the chief logs.
+    """
+    model_path = os.path.join(mcb.temp_dir, name)
+    if mcb.chief:
+        mlflow.log_param('Status', status)
+        print('\n%s, saving model to %s.' % (action, mlflow.get_artifact_uri() + '/' + name))
+    model.save(model_path, save_format='h5')
+    mcb.logger.log_artifact(model_path)
+
+def _end_mlflow(mcb, status):
+    """Waits for the checkpoints and model to be uploaded, and ends the MLFlow run on the chief."""
+    mcb.logger.close()
+    if mcb.temp_dir:
+        shutil.rmtree(mcb.temp_dir, ignore_errors=True)
+    if mcb.chief:
+        mlflow.log_param('Epoch', mcb.epoch)
+        mlflow.log_param('Batch', mcb.batch)
+        mlflow.end_run(status)
+
+def train(model_fn, dataset : ImageryDataset, training_spec, resume=None):
+    """
+    Trains the specified model on a dataset according to a training
+    specification. If `resume` is the prefix of a tf format checkpoint (see `find_checkpoint`),
+    the model's variables and the optimizer state are restored from it first.
+    """
+    policy = _precision_policy(training_spec.precision, config.general.gpus())
+    if isinstance(model_fn, tf.keras.Model) and policy != 'float32':
+        print('Warning: precision only applies to new models, %s keeps its own.' % (model_fn.name), file=sys.stderr)
+        policy = 'float32'
+    old_policy = _global_policy()
+    _set_policy(policy)
+    try:
+        (model, fit_model) = _build_model(model_fn, dataset, training_spec, policy)
+    finally:
+        _set_policy(old_policy)
+    if resume is not None:
+        # optimizer state is restored as the optimizer creates its variables
+        _checkpoint(model, fit_model.optimizer).restore(resume).expect_partial()
+
+    input_shape = model.get_input_at(0).shape
+    output_shape = model.get_output_at(0).shape
+    chunk_size = input_shape[1]
+
+    assert len(input_shape) == 4, 'Input to network is wrong shape.'
+    assert input_shape[0] is None, 'Input is not batched.'
+    # The below may no longer be valid if we move to convolutional architectures.
+    assert input_shape[1] == input_shape[2], 'Input to network is not chunked'
+    assert len(output_shape) == 2 or output_shape[1] == output_shape[2], 'Output from network is not chunked'
+    assert input_shape[3] == dataset.num_bands(), 'Number of bands in model does not match data.'
+    # last element differs for the sparse metrics
+    assert output_shape[1:-1] == dataset.output_shape()[:-1], \
+            'Network output shape %s does not match label shape %s.' % (output_shape[1:], dataset.output_shape())
 
+    cache_dir = None
+    if training_spec.validation and training_spec.validation.cache == 'disk':
+        cache_dir = tempfile.mkdtemp(prefix='validation', dir=config.io.cache.manager().folder())
+    workers = _shard_dataset(dataset, training_spec)
+    pcb = _profile_callback(training_spec)
+    (ds, validation) = _prep_datasets(dataset, training_spec, chunk_size, output_shape[1], cache_dir)
+    if pcb is not None:
+        ds = pcb.probe(ds)
+    ds = _worker_dataset(ds, workers)
+    status = 'FINISHED'
+
+    # the profiler is first, so other callbacks' work after each step isn't counted in the step time
+    callbacks = ([pcb] if pcb is not None else []) + _callbacks(model)
+    mcb = None
     if config.mlflow.enabled():
         mcb = _mlflow_train_setup(model, dataset, training_spec)
         callbacks.append(mcb)
 
     try:
-        history = model.fit(ds,
-                            epochs=training_spec.epochs,
-                            callbacks=callbacks,
-                            validation_data=validation,
-                            validation_steps=training_spec.validation.steps if training_spec.validation else None,
-                            steps_per_epoch=training_spec.steps)
-        if config.mlflow.enabled():
-            model_path = os.path.join(mcb.temp_dir, 'final_model.h5')
-            print('\nFinished, saving model to %s.' % (mlflow.get_artifact_uri() + '/final_model.h5'))
-            model.save(model_path, save_format='h5')
-            mlflow.log_artifact(model_path)
-            os.remove(model_path)
-            mlflow.log_param('Status', 'Completed')
+        history = fit_model.fit(ds,
+                                epochs=training_spec.epochs,
+                                callbacks=callbacks,
+                                # validation already has validation.steps batches, and is read to the end so it
+                                # is cached
+                                validation_data=validation,
+                                steps_per_epoch=training_spec.steps)
+        _report_profile(pcb, dataset, mcb)
+        if mcb is not None:
+            _save_model(mcb, model, 'final_model.h5', 'Finished', 'Completed')
     except:
-        if config.mlflow.enabled():
-            mlflow.log_param('Status', 'Aborted')
-            mlflow.end_run('FAILED')
-            model_path = os.path.join(mcb.temp_dir, 'aborted_model.h5')
-            print('\nAborting, saving current model to %s.' % (mlflow.get_artifact_uri() + '/aborted_model.h5'))
-            model.save(model_path, save_format='h5')
-            mlflow.log_artifact(model_path)
-            os.remove(model_path)
+        if mcb is not None:
+            _save_model(mcb, model, 'aborted_model.h5', 'Aborting', 'Aborted')
+            status = 'FAILED'
         raise
     finally:
-        if config.mlflow.enabled():
-            mlflow.log_param('Epoch', mcb.epoch)
-            mlflow.log_param('Batch', mcb.batch)
-            if mcb and mcb.temp_dir:
-                shutil.rmtree(mcb.temp_dir)
-
-    if config.mlflow.enabled():
-        mlflow.end_run()
+        profiling.disable()
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        if mcb is not None:
+            _end_mlflow(mcb, status)
 
     return model, history
@@ -0,0 +1,60 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Find the io settings that load the dataset fastest, and save them to a config file.
+"""
+
+import sys
+
+from delta.config import config
+from delta.imagery import autotune
+
+def main(options):
+    images = config.dataset.images()
+    if not images:
+        print('No images specified.', file=sys.stderr)
+        return 1
+    labels = None
+    if not options.autoencoder:
+        labels = config.dataset.labels()
+        if not labels:
+            print('No labels specified.', file=sys.stderr)
+            return 1
+    indices = autotune.sample_images(images, options.sample_images)
+    tc = config.train.spec()
+    make_dataset = autotune.training_dataset(autotune.subset(images, indices), autotune.subset(labels, indices),
+                                             config.train.network.chunk_size(), config.train.network.output_size(),
+                                             tc.chunk_stride, options.autoencoder)
+    print('Measuring %d batches of %d chunks from %d images with each setting:' %
+          (options.batches, tc.batch_size, len(indices)))
+    try:
+        results = autotune.autotune(make_dataset, tc.batch_size, options.block_sizes, options.tile_ratios,
+                                    options.thread_counts, options.batches)
+    except KeyboardInterrupt:
+        print()
+        print('Cancelled.')
+        return 1
+    if not results or 'failed' in results[0]:
+        print('No settings worked.', file=sys.stderr)
+        return 1
+    best = results[0]
+    print('Fastest: block_size_mb=%d tile_ratio=%g threads=%d, %.1f chunks/s.' %
+          (best['block_size_mb'], best['tile_ratio'], best['threads'], best['chunks_per_second']))
+    autotune.write_config(options.output, best)
+    print('Saved to %s.' % (options.output))
+    return 0
@@ -0,0 +1,52 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Save the chunks and labels of a dataset to shards, to train on repeatedly.
+"""
+
+import sys
+
+from delta.config import config
+from delta.imagery import imagery_dataset, shards
+
+def main(options):
+    images = config.dataset.images()
+    if not images:
+        print('No images specified.', file=sys.stderr)
+        return 1
+    tc = config.train.spec()
+    if options.autoencoder:
+        ids = imagery_dataset.AutoencoderDataset(images, config.train.network.chunk_size(), tc.chunk_stride)
+    else:
+        labels = config.dataset.labels()
+        if not labels:
+            print('No labels specified.', file=sys.stderr)
+            return 1
+        ids = imagery_dataset.ImageryDataset(images, labels, config.train.network.chunk_size(),
+                                             config.train.network.output_size(), tc.chunk_stride,
+                                             class_balance=tc.class_balance, class_samples=tc.class_samples)
+
+    try:
+        count = shards.write_shards(ids, options.output, num_shards=options.shards,
+                                    shuffle_buffer=options.shuffle_buffer)
+    except KeyboardInterrupt:
+        print()
+        print('Cancelled.')
+        return 1
+    print('Wrote %d chunks to %s.' % (count, options.output))
+    return 0
@@ -34,7 +34,15 @@ def main_classify(options):
 
 def main_train(options):
     from . import train
-    train.main(options)
+    return train.main(options)
+
+def main_bake(options):
+    from . import bake
+    return bake.main(options)
+
+def main_autotune(options):
+    from . import autotune
+    return autotune.main(options)
 
 def main_mlflow_ui(options):
     from .import mlflow_ui
@@ -55,10 +63,41 @@ def setup_train(subparsers):
     config.setup_arg_parser(sub)
     sub.add_argument('--autoencoder', action='store_true',
                      help='Train autoencoder (ignores labels).')
-    sub.add_argument('--resume', help='Use the model as a starting point for the training.')
+    sub.add_argument('--resume', help='Use the model, or a tf format checkpoint (or the latest in a directory of them) '
+                     'with the network from the config, as a starting point for the training. If the dataset position '
+                     'was saved with it (as .cursor.json), continue the dataset from there.')
+    sub.add_argument('--shards', help='Train on shards saved with the bake command instead of the dataset.')
     sub.add_argument('model', nargs='?', default=None, help='File to save the network to.')
     sub.set_defaults(function=main_train)
 
+def setup_bake(subparsers):
+    sub = subparsers.add_parser('bake', help='Save dataset chunks and labels to shards for faster training.')
+    config.setup_arg_parser(sub, ['general', 'io', 'dataset', 'train'])
+    sub.add_argument('--autoencoder', action='store_true',
+                     help='Save chunks for the autoencoder (ignores labels).')
+    sub.add_argument('--shards', type=int, default=16, help='Number of shard files to write.')
+    sub.add_argument('--shuffle-buffer', dest='shuffle_buffer', type=int, default=1000,
+                     help='Number of chunks to shuffle together in each shard.')
+    sub.add_argument('output', help='Directory to save the shards to.')
+    sub.set_defaults(function=main_bake)
+
+def setup_autotune(subparsers):
+    sub = subparsers.add_parser('autotune', help='Find the io settings that load the dataset fastest.')
+    config.setup_arg_parser(sub, ['general', 'io', 'dataset', 'train'])
+    sub.add_argument('--autoencoder', action='store_true',
+                     help='Tune loading chunks for the autoencoder (ignores labels).')
+    sub.add_argument('--sample-images', dest='sample_images', type=int, default=4,
+                     help='Number of images to measure with, chosen at random.')
+    sub.add_argument('--batches', type=int, default=20, help='Number of batches to time for each setting.')
+    sub.add_argument('--block-sizes', dest='block_sizes', type=int, nargs='+', default=None,
+                     help='Values of io.block_size_mb to try.')
+    sub.add_argument('--tile-ratios', dest='tile_ratios', type=float, nargs='+', default=None,
+                     help='Values of io.tile_ratio to try.')
+    sub.add_argument('--thread-counts', dest='thread_counts', type=int, nargs='+', default=None,
+                     help='Values of io.threads to try, powers of two up to the number of CPUs by default.')
+    sub.add_argument('output', help='Config file to save the fastest settings to, updated if it exists.')
+    sub.set_defaults(function=main_autotune)
+
 def setup_mlflow_ui(subparsers):
     sub = subparsers.add_parser('mlflow_ui', help='Launch mlflow user interface to visualize run history.')
     config.setup_arg_parser(sub, ['mlflow'])
@@ -66,4 +105,4 @@ def setup_mlflow_ui(subparsers):
     sub.set_defaults(function=main_mlflow_ui)
 
 
-SETUP_COMMANDS = [setup_train, setup_classify, setup_mlflow_ui]
+SETUP_COMMANDS = [setup_train, setup_classify, setup_bake, setup_autotune, setup_mlflow_ui]
@@ -24,35 +24,55 @@ import sys
 import tensorflow as tf
 
 from delta.config import config
-from delta.imagery import imagery_dataset
-from delta.ml.train import train
+from delta.imagery import imagery_dataset, shards
+from delta.ml import distributed
+from delta.ml.train import train, restore_cursor, find_checkpoint
 from delta.ml.model_parser import config_model
 from delta.ml.layers import ALL_LAYERS
 
 def main(options):
-    images = config.dataset.images()
-    if not images:
-        print('No images specified.', file=sys.stderr)
-        return 1
+    if config.general.cluster():
+        distributed.load_cluster(config.general.cluster())
+    elif config.general.workers() > 1 and distributed.num_workers() == 1:
+        return distributed.launch(config.general.workers())
+    # the strategy for several workers must be created before TensorFlow runs anything
+    distributed.strategy()
+
     tc = config.train.spec()
-    if options.autoencoder:
-        ids = imagery_dataset.AutoencoderDataset(images, config.train.network.chunk_size(), tc.chunk_stride)
+    if options.shards:
+        ids = shards.ShardDataset(options.shards)
     else:
-        labels = config.dataset.labels()
-        if not labels:
-            print('No labels specified.', file=sys.stderr)
+        images = config.dataset.images()
+        if not images:
+            print('No images specified.', file=sys.stderr)
             return 1
-        ids = imagery_dataset.ImageryDataset(images, labels, config.train.network.chunk_size(),
-                                             config.train.network.output_size(), tc.chunk_stride)
+        if options.autoencoder:
+            ids = imagery_dataset.AutoencoderDataset(images, config.train.network.chunk_size(), tc.chunk_stride)
+        else:
+            labels = config.dataset.labels()
+            if not labels:
+                print('No labels specified.', file=sys.stderr)
+                return 1
+            ids = imagery_dataset.ImageryDataset(images, labels, config.train.network.chunk_size(),
+                                                 config.train.network.output_size(), tc.chunk_stride,
+                                                 class_balance=tc.class_balance, class_samples=tc.class_samples,
+                                                 native_input=tc.native_input)
 
     try:
+        checkpoint = None
         if options.resume is not None:
+            checkpoint = find_checkpoint(options.resume)
+        if options.resume is not None and checkpoint is None:
             model = tf.keras.models.load_model(options.resume, custom_objects=ALL_LAYERS)
         else:
+            # a tf format checkpoint only has the variables, restored by train
             model = config_model(ids.num_bands())
-        model, _ = train(model, ids, tc)
+        if options.resume is not None:
+            if restore_cursor(ids, checkpoint or options.resume):
+                print('Continuing dataset from the position saved with %s.' % (checkpoint or options.resume))
+        model, _ = train(model, ids, tc, resume=checkpoint)
 
-        if options.model is not None:
+        if options.model is not None and distributed.is_chief():
             model.save(options.model)
     except KeyboardInterrupt:
         print()
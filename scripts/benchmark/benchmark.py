@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks of the imagery and inference hot paths, using only local files and the CPU.
+
+Generates a synthetic multi-band GeoTIFF and label image, then times:
+
+ * read: reading the image in tiles with `TiffImage.read`.
+ * roi: reading the image in prediction sized blocks with `DeltaImage.roi_generator`.
+ * dataset: chunks per second from `ImageryDataset.dataset`, for each `io.tile_loader`.
+ * train: training steps on a small fully convolutional network, with a batch already in memory.
+ * predict: `LabelPredictor.predict` over the whole image.
+
+Results are written as JSON, to compare between commits:
+
+    benchmark.py --size 4096 4096 --compress lzw --output before.json
+    (change something)
+    benchmark.py --size 4096 4096 --compress lzw --output after.json --compare before.json
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal
+import tensorflow as tf
+
+from delta.config import config
+from delta.imagery import imagery_dataset, rectangle
+from delta.imagery.imagery_config import ImageSet
+from delta.imagery.sources import tiff
+from delta.ml import predict
+import delta.imagery.imagery_config
+import delta.ml.ml_config
+
+BENCHMARKS = ['read', 'roi', 'dataset', 'train', 'predict']
+
+_GDAL_TYPES = {'uint8' : gdal.GDT_Byte, 'uint16' : gdal.GDT_UInt16, 'float32' : gdal.GDT_Float32}
+
+def make_tiff(path, width, height, bands, dtype, tile_size, compress, classes=None): #pylint:disable=too-many-arguments
+    """
+    Writes a synthetic image. The image is smooth with some noise, so it compresses like imagery
+    rather than random data. If `classes` is given, writes labels with that many classes instead.
+    `tile_size` of 0 writes strips.
+    """
+    options = ['BIGTIFF=IF_SAFER', 'INTERLEAVE=BAND']
+    if compress != 'none':
+        options.append('COMPRESS=' + compress.upper())
+    if tile_size:
+        options += ['TILED=YES', 'BLOCKXSIZE=%d' % (tile_size), 'BLOCKYSIZE=%d' % (tile_size)]
+    handle = gdal.GetDriverByName('GTiff').Create(path, width, height, bands, _GDAL_TYPES[dtype], options)
+    if not handle:
+        raise RuntimeError('Failed to create %s.' % (path))
+    rng = np.random.default_rng(0)
+    rows = 256
+    x = np.arange(width, dtype=np.float32)
+    for b in range(bands):
+        band = handle.GetRasterBand(b + 1)
+        for y0 in range(0, height, rows):
+            y = np.arange(y0, min(y0 + rows, height), dtype=np.float32)[:, np.newaxis]
+            # in [0, 1]
+            data = (np.sin(x / (37.0 + b)) * np.cos(y / 53.0) + 1) / 2
+            data = np.clip(data + rng.normal(0, 0.05, data.shape), 0, 1)
+            if classes is not None:
+                data = np.minimum(data * classes, classes - 1)
+            elif dtype != 'float32':
+                data = data * np.iinfo(dtype).max
+            band.WriteArray(data.astype(dtype), 0, y0)
+    handle.FlushCache()
+
+def _best(function, repeat, *args):
+    """Runs `function(*args)` `repeat` times, returning the shortest time and its result."""
+    best = (math.inf, None)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+def _result(seconds, count, unit, **extra):
+    r = {'seconds' : seconds, 'count' : count, 'unit' : unit, 'per_second' : count / seconds}
+    r.update(extra)
+    return r
+
+def bench_read(path, tile_size, repeat):
+    """Reads the whole image in tiles of `tile_size` pixels."""
+    image = tiff.TiffImage(path)
+    bytes_per_pixel = image.num_bands() * image.numpy_type().itemsize
+    def read():
+        pixels = 0
+        for roi in image.tiles(tile_size, tile_size):
+            image.read(roi)
+            pixels += roi.width() * roi.height()
+        return pixels
+    (seconds, pixels) = _best(read, repeat)
+    return _result(seconds, pixels, 'pixels', mb_per_second=pixels * bytes_per_pixel / seconds / 1024 / 1024)
+
+def bench_roi(path, block_size, repeat):
+    """Reads the image in blocks of `block_size` pixels with `roi_generator`, as prediction does."""
+    image = tiff.TiffImage(path)
+    bounds = rectangle.Rectangle(0, 0, width=image.width(), height=image.height())
+    def read():
+        rois = bounds.make_tile_rois(block_size, block_size, include_partials=False)
+        return sum(1 for _ in image.roi_generator(rois))
+    (seconds, count) = _best(read, repeat)
+    return _result(seconds, count, 'rois')
+
+def bench_dataset(images, labels, chunk_size, output_size, repeat): #pylint:disable=too-many-arguments
+    """Chunks per second from `ImageryDataset.dataset`, for each tile loader."""
+    results = {}
+    for loader in ['thread', 'process']:
+        config.load(yaml_str='io:\n  tile_loader: %s\n' % (loader))
+        ds = imagery_dataset.ImageryDataset(images, labels, chunk_size, output_size)
+        def load(ds):
+            return sum(int(x.shape[0]) for (x, _) in ds.dataset().batch(1024))
+        (seconds, chunks) = _best(load, repeat, ds)
+        results[loader] = _result(seconds, chunks, 'chunks')
+    return results
+
+def small_network(chunk_size, output_size, bands, classes):
+    """A fully convolutional network taking `chunk_size` chunks and outputting `output_size` labels."""
+    if (chunk_size - output_size) % 2:
+        raise ValueError('chunk_size - output_size must be even.')
+    layers = [tf.keras.layers.Input((chunk_size, chunk_size, bands))]
+    for _ in range((chunk_size - output_size) // 2):
+        layers.append(tf.keras.layers.Conv2D(16, 3, activation='relu', padding='valid'))
+    layers.append(tf.keras.layers.Conv2D(classes, 1, activation='softmax'))
+    model = tf.keras.Sequential(layers)
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy')
+    return model
+
+def bench_train(model, batch_size, steps, repeat):
+    """Training steps per second on a random batch, so loading data isn't counted."""
+    (_, size, _, bands) = model.input_shape
+    (_, out, _, classes) = model.output_shape
+    rng = np.random.default_rng(0)
+    x = rng.random((batch_size, size, size, bands), dtype=np.float32)
+    y = rng.integers(0, classes, (batch_size, out, out)).astype(np.uint8)
+    model.train_on_batch(x, y) # compile the step first
+    def train():
+        for _ in range(steps):
+            model.train_on_batch(x, y)
+        return steps
+    (seconds, steps) = _best(train, repeat)
+    return _result(seconds, steps * batch_size, 'samples', steps_per_second=steps / seconds)
+
+def bench_predict(model, path, repeat):
+    """Predicts labels for the whole image."""
+    image = tiff.TiffImage(path)
+    def predict_image():
+        predict.LabelPredictor(model).predict(image)
+        return image.width() * image.height()
+    (seconds, pixels) = _best(predict_image, repeat)
+    return _result(seconds, pixels, 'pixels')
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _flatten(results, prefix=''):
+    """Yields (name, result) for each result, with nested results named by their path."""
+    for (name, r) in results.items():
+        if 'per_second' in r:
+            yield (prefix + name, r)
+        else:
+            yield from _flatten(r, prefix + name + '.')
+
+def compare(results, baseline):
+    """Prints the change in throughput of each benchmark from `baseline`."""
+    old = dict(_flatten(baseline['results']))
+    print('%-20s %14s %14s %8s' % ('benchmark', 'baseline/s', 'current/s', 'change'))
+    for (name, r) in _flatten(results['results']):
+        if name not in old:
+            continue
+        change = 100 * (r['per_second'] / old[name]['per_second'] - 1)
+        print('%-20s %14.1f %14.1f %+7.1f%%' % (name, old[name]['per_second'], r['per_second'], change))
+
+def run(options, work_dir):
+    image_path = os.path.join(work_dir, 'image.tiff')
+    label_path = os.path.join(work_dir, 'labels.tiff')
+    (width, height) = options.size
+    make_tiff(image_path, width, height, options.bands, options.dtype, options.tile_size, options.compress)
+    make_tiff(label_path, width, height, 1, 'uint8', options.tile_size, options.compress, classes=options.classes)
+
+    config.reset()
+    config.load(yaml_str='io:\n  threads: %d\n  block_size_mb: %d\n  image_index: %s\n  cache:\n    dir: %s\n' %
+                (options.threads, options.block_size_mb, os.path.join(work_dir, 'index.json'),
+                 os.path.join(work_dir, 'cache')))
+    results = {}
+    if 'read' in options.benchmarks:
+        results['read'] = bench_read(image_path, options.read_size, options.repeat)
+    if 'roi' in options.benchmarks:
+        results['roi'] = bench_roi(image_path, options.read_size, options.repeat)
+    if 'dataset' in options.benchmarks:
+        results['dataset'] = bench_dataset(ImageSet([image_path], 'tiff'), ImageSet([label_path], 'tiff'),
+                                           options.chunk_size, options.output_size, options.repeat)
+    if 'train' in options.benchmarks or 'predict' in options.benchmarks:
+        model = small_network(options.chunk_size, options.output_size, options.bands, options.classes)
+        if 'train' in options.benchmarks:
+            results['train'] = bench_train(model, options.batch_size, options.steps, options.repeat)
+        if 'predict' in options.benchmarks:
+            results['predict'] = bench_predict(model, image_path, options.repeat)
+    return results
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark DELTA on synthetic images.')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='Benchmarks to run, all by default.')
+    parser.add_argument('--size', nargs=2, type=int, default=[2048, 2048], metavar=('width', 'height'),
+                        help='Size of the synthetic image.')
+    parser.add_argument('--bands', type=int, default=4, help='Number of bands in the image.')
+    parser.add_argument('--dtype', choices=sorted(_GDAL_TYPES), default='uint16', help='Data type of the image.')
+    parser.add_argument('--tile-size', dest='tile_size', type=int, default=256,
+                        help='Width and height of the GeoTIFF tiles, or 0 for strips.')
+    parser.add_argument('--compress', choices=['none', 'lzw', 'deflate', 'zstd'], default='none',
+                        help='GeoTIFF compression.')
+    parser.add_argument('--classes', type=int, default=3, help='Number of label classes.')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=16, help='Network input size.')
+    parser.add_argument('--output-size', dest='output_size', type=int, default=8, help='Network output size.')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=256, help='Training batch size.')
+    parser.add_argument('--steps', type=int, default=50, help='Training steps to time.')
+    parser.add_argument('--read-size', dest='read_size', type=int, default=512,
+                        help='Size of the regions to read in the read and roi benchmarks.')
+    parser.add_argument('--threads', type=int, default=4, help='io.threads for the dataset benchmark.')
+    parser.add_argument('--block-size-mb', dest='block_size_mb', type=int, default=8,
+                        help='io.block_size_mb for the dataset and predict benchmarks.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark, the fastest is reported.')
+    parser.add_argument('--work-dir', dest='work_dir', default=None,
+                        help='Directory for the synthetic images, a temporary directory by default.')
+    parser.add_argument('--output', default=None, help='JSON file to write results to, stdout by default.')
+    parser.add_argument('--compare', default=None, help='JSON results from an earlier run to compare to.')
+    options = parser.parse_args(args)
+
+    delta.imagery.imagery_config.register()
+    delta.ml.ml_config.register()
+
+    work_dir = options.work_dir if options.work_dir else tempfile.mkdtemp(prefix='delta_benchmark')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run(options, work_dir)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {'commit' : _commit(),
+              'date' : datetime.datetime.now().isoformat(),
+              'host' : platform.node(),
+              'cpu_count' : os.cpu_count(),
+              'versions' : {'python' : platform.python_version(), 'numpy' : np.__version__,
+                            'tensorflow' : tf.__version__, 'gdal' : gdal.__version__},
+              'options' : {k : v for (k, v) in vars(options).items() if k not in ('output', 'compare', 'work_dir')},
+              'results' : results}
+    text = json.dumps(output, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            compare(output, json.load(f))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
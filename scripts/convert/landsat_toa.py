@@ -23,7 +23,10 @@ Script to apply Top of Atmosphere correction to Landsat 5, 7, and 8 files.
 import sys
 import argparse
 
+from delta.config import config
 from delta.imagery.sources import landsat
+import delta.imagery.imagery_config
+import delta.ml.ml_config
 
 
 #------------------------------------------------------------------------------
@@ -58,9 +61,14 @@ def main(argsIn):
         print(usage)
         return -1
 
-    image = landsat.LandsatImage(options.iamge_path)
+    delta.imagery.imagery_config.register()
+    delta.ml.ml_config.register()
+    config.initialize(None)
+
+    image = landsat.LandsatImage(options.image_path)
     landsat.toa_preprocess(image, options.calc_reflectance)
-    image.save(options.output_file, tile_size=options.tile_size, show_progress=True)
+    image.save(options.output_file, tile_size=options.tile_size, show_progress=True,
+               num_processes=options.num_processes)
 
     print('Landsat TOA conversion is finished.')
     return 0
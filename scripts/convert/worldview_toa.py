@@ -24,7 +24,10 @@ import sys
 import argparse
 import traceback
 
+from delta.config import config
 from delta.imagery.sources import worldview
+import delta.imagery.imagery_config
+import delta.ml.ml_config
 
 #------------------------------------------------------------------------------
 
@@ -45,8 +48,8 @@ def main(argsIn):
                             dest="calc_reflectance", default=False,
                             help="Compute TOA reflectance (and temperature) instead of radiance.")
 
-        #parser.add_argument("--num-processes", dest="num_processes", type=int, default=1,
-        #                    help="Number of parallel processes to use.")
+        parser.add_argument("--num-processes", dest="num_processes", type=int, default=1,
+                            help="Number of parallel processes to use.")
 
         #parser.add_argument("--num-threads", dest="num_threads", type=int, default=1,
         #                    help="Number of threads to use per process.")
@@ -61,10 +64,15 @@ def main(argsIn):
         print(usage)
         return -1
 
+    delta.imagery.imagery_config.register()
+    delta.ml.ml_config.register()
+    config.initialize(None)
+
     try:
         image = worldview.WorldviewImage(options.image_path)
         worldview.toa_preprocess(image, options.calc_reflectance)
-        image.save(options.output_path, tile_size=options.tile_size, show_progress=True)
+        image.save(options.output_path, tile_size=options.tile_size, show_progress=True,
+                   num_processes=options.num_processes)
     except Exception:  #pylint: disable=W0703
         traceback.print_exc()
         sys.stdout.flush()
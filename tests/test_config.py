@@ -17,6 +17,7 @@
 
 import argparse
 import os
+import shutil
 import tempfile
 import pytest
 import yaml
@@ -39,6 +40,7 @@ def test_general():
     io:
       threads: 5
       block_size_mb: 10
+      strip_size_mb: 20
       interleave_images: 3
       tile_ratio: 1.0
       cache:
@@ -50,12 +52,13 @@ def test_general():
     assert config.general.gpus() == 3
     assert config.io.threads() == 5
     assert config.io.block_size_mb() == 10
+    assert config.io.strip_size_mb() == 20
     assert config.io.interleave_images() == 3
     assert config.io.tile_ratio() == 1.0
     cache = config.io.cache.manager()
     assert cache.folder() == 'nonsense'
     assert cache.limit() == 2
-    os.rmdir('nonsense')
+    shutil.rmtree('nonsense')
 
 def test_images_dir():
     config.reset()
@@ -243,9 +246,12 @@ def test_train():
       loss_function: loss
       metrics: [metric]
       optimizer: opt
+      precision: mixed_bfloat16
+      native_input: true
       validation:
         steps: 20
         from_training: true
+        cache: disk
     '''
     config.load(yaml_str=test_str)
     tc = config.train.spec()
@@ -258,6 +264,13 @@ def test_train():
     assert tc.optimizer == 'opt'
     assert tc.validation.steps == 20
     assert tc.validation.from_training
+    assert tc.validation.cache == 'disk'
+    assert tc.precision == 'mixed_bfloat16'
+    assert tc.native_input
+    with pytest.raises(ValueError):
+        config.load(yaml_str='train:\n  validation:\n    cache: gpu\n')
+    with pytest.raises(ValueError):
+        config.load(yaml_str='train:\n  precision: float64\n')
 
 def test_mlflow():
     config.reset()
@@ -272,6 +285,9 @@ def test_mlflow():
       frequency: 5
       checkpoints:
         frequency: 10
+        format: tf
+        keep: 2
+        dir: nonsense
     '''
     config.load(yaml_str=test_str)
 
@@ -280,6 +296,11 @@ def test_mlflow():
     assert config.mlflow.frequency() == 5
     assert config.mlflow.experiment() == 'name'
     assert config.mlflow.checkpoints.frequency() == 10
+    assert config.mlflow.checkpoints.format() == 'tf'
+    assert config.mlflow.checkpoints.keep() == 2
+    assert config.mlflow.checkpoints.dir() == 'nonsense'
+    with pytest.raises(ValueError):
+        config.load(yaml_str='mlflow:\n  checkpoints:\n    format: pickle\n')
 
 def test_tensorboard():
     config.reset()
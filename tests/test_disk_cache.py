@@ -0,0 +1,82 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from delta.imagery import disk_folder_cache
+from delta.imagery.disk_folder_cache import DiskCache
+
+def _write_item(cache, name, size):
+    path = cache.register_item(name)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+def test_lru_size_limit(tmpdir):
+    cache = DiskCache(str(tmpdir), size_limit=250)
+    a = _write_item(cache, 'a', 100)
+    b = _write_item(cache, 'b', 100)
+    cache.register_item('a') # a is now most recently used
+    c = _write_item(cache, 'c', 100)
+    _write_item(cache, 'd', 100) # over the limit, evict least recently used
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert os.path.exists(c)
+    assert cache.num_cached() == 3
+
+    # access times are shared with new cache objects
+    cache2 = DiskCache(str(tmpdir), size_limit=150)
+    cache2.register_item('c')
+    assert os.path.exists(c)
+    assert not os.path.exists(a)
+
+def test_count_limit(tmpdir):
+    cache = DiskCache(str(tmpdir), limit=2)
+    assert cache.limit() == 2
+    a = _write_item(cache, 'a', 10)
+    _write_item(cache, 'b', 10)
+    _write_item(cache, 'c', 10)
+    assert not os.path.exists(a)
+    assert cache.num_cached() == 2
+
+def test_pin(tmpdir):
+    cache = DiskCache(str(tmpdir), limit=1)
+    a = cache.register_item('a', pin=True)
+    with open(a, 'w') as f:
+        f.write('test')
+    assert cache.is_pinned('a')
+    b = _write_item(cache, 'b', 10)
+    assert os.path.exists(a)
+    assert os.path.exists(b)
+    cache.unpin('a')
+    assert not cache.is_pinned('a')
+    _write_item(cache, 'c', 10)
+    assert not os.path.exists(a)
+    assert not os.path.exists(b)
+
+def test_sizes_recorded(tmpdir, monkeypatch):
+    cache = DiskCache(str(tmpdir), size_limit=10000)
+    for name in 'abcde':
+        _write_item(cache, name, 10)
+    measured = []
+    disk_usage = disk_folder_cache._disk_usage #pylint: disable=protected-access
+    monkeypatch.setattr(disk_folder_cache, '_disk_usage', lambda p: measured.append(p) or disk_usage(p))
+    _write_item(cache, 'f', 10)
+    _write_item(cache, 'g', 10)
+    # each item is measured once, at the next registration after it is written
+    assert measured == [os.path.join(str(tmpdir), n) for n in 'ef']
+    assert cache.total_size() == 70
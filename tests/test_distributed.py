@@ -0,0 +1,53 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sys
+
+from delta.ml import distributed
+
+def test_workers(monkeypatch):
+    monkeypatch.delenv('TF_CONFIG', raising=False)
+    assert distributed.num_workers() == 1
+    assert distributed.is_chief()
+    cluster = {'chief': ['a:1'], 'worker': ['b:1', 'c:1']}
+    monkeypatch.setenv('TF_CONFIG', json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': 1}}))
+    assert distributed.num_workers() == 3
+    assert distributed.worker_index() == 2
+    assert not distributed.is_chief()
+    monkeypatch.setenv('TF_CONFIG', json.dumps({'cluster': cluster, 'task': {'type': 'chief', 'index': 0}}))
+    assert distributed.is_chief()
+
+def test_load_cluster(monkeypatch, tmp_path):
+    monkeypatch.delenv('TF_CONFIG', raising=False)
+    path = tmp_path / 'cluster.json'
+    path.write_text(json.dumps({'cluster': {'worker': ['a:1', 'b:1']}, 'task': {'type': 'worker', 'index': 1}}))
+    distributed.load_cluster(str(path))
+    assert distributed.num_workers() == 2
+    assert distributed.worker_index() == 1
+
+def test_launch(tmp_path):
+    script = ('import json, os, sys; c = json.loads(os.environ["TF_CONFIG"]); '
+              'open(os.path.join(sys.argv[1], str(c["task"]["index"])), "w").write(json.dumps(c["cluster"]))')
+    assert distributed.launch(3, [sys.executable, '-c', script, str(tmp_path)]) == 0
+    clusters = [json.loads((tmp_path / str(i)).read_text()) for i in range(3)]
+    assert all(c == clusters[0] for c in clusters)
+    assert len(set(clusters[0]['worker'])) == 3
+    # a failing worker stops the others
+    script = ('import json, os, sys, time; '
+              'sys.exit(3) if json.loads(os.environ["TF_CONFIG"])["task"]["index"] == 0 else time.sleep(60)')
+    assert distributed.launch(2, [sys.executable, '-c', script]) == 3
@@ -0,0 +1,70 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+
+from delta.imagery import image_index
+from delta.imagery.imagery_config import ImageSet
+
+def test_image_index(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / ('image%d.npy' % (i))))
+        np.save(paths[-1], np.zeros((10 + i, 20, 2), dtype=np.uint16))
+    images = ImageSet(paths, 'npy')
+    index = image_index.ImageIndex(str(tmp_path / 'index.json'))
+    info = index.info(images)
+    assert [i.size() for i in info] == [(20, 10), (20, 11), (20, 12)]
+    assert info[0].num_bands() == 2
+    assert info[0].dtype() == 'uint16'
+    assert len(info[0].tiles(10, 5)) == 4
+
+    # read from the index file without opening images
+    np.save(paths[1], np.zeros((5, 5, 3), dtype=np.uint8))
+    os.utime(paths[1], (0, 0))
+    # changed without changing the modification time, so the index is not updated
+    mtime = os.path.getmtime(paths[2])
+    np.save(paths[2], np.zeros((1, 1, 1), dtype=np.uint8))
+    os.utime(paths[2], (mtime, mtime))
+    info = image_index.ImageIndex(index.path()).info(images)
+    assert info[1].size() == (5, 5)
+    assert info[1].num_bands() == 3
+    assert info[2].size() == (20, 12)
+
+def test_concurrent_update(tmp_path, monkeypatch):
+    paths = []
+    for i in range(2):
+        paths.append(str(tmp_path / ('image%d.npy' % (i))))
+        np.save(paths[-1], np.zeros((10, 20, 1), dtype=np.uint8))
+    images = ImageSet(paths, 'npy')
+    path = str(tmp_path / 'index.json')
+    tiles = image_index.ImageIndex(path).info(ImageSet(paths[:1], 'npy'))[0].tiles(10, 10)
+
+    load = image_index.loader.load
+    def load_and_update(filename, image_type):
+        if filename == paths[1]:
+            # another process adds histograms while this one is opening an image
+            image_index.ImageIndex(path).tile_histograms(images, 0, tiles, 2)
+        return load(filename, image_type)
+    monkeypatch.setattr(image_index.loader, 'load', load_and_update)
+    image_index.ImageIndex(path).info(images)
+
+    # the histograms are still in the index, so the labels aren't read again
+    monkeypatch.setattr(image_index.loader, 'load', None)
+    assert image_index.ImageIndex(path).tile_histograms(images, 0, tiles, 2)[:, 0].tolist() == [100, 100]
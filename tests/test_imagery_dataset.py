@@ -22,12 +22,14 @@ import pytest
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
+import yaml
 
 from delta.config import config
-from delta.imagery import imagery_dataset
+from delta.imagery import autotune, imagery_dataset, shards
+from delta.imagery.imagery_config import ImageSet
 from delta.imagery.sources import npy
 from delta.ml import train, predict
-from delta.ml.ml_config import TrainingSpec
+from delta.ml.ml_config import TrainingSpec, ValidationSet
 
 import conftest
 
@@ -74,6 +76,23 @@ def dataset(all_sources, request):
 def dataset_block_label(all_sources):
     return load_dataset(all_sources[0], 3)
 
+@pytest.fixture(scope="function")
+def npy_dataset(tmp_path):
+    """
+    Returns a function that makes a dataset of a 1200x1200 npy image of ones and `labels` (zeros by default),
+    with the `io` config overrides, and with the other arguments passed to `ImageryDataset`.
+    """
+    def make(io=None, labels=None, **kwargs):
+        config.reset()
+        settings = {'cache' : {'dir' : str(tmp_path)}, 'image_index' : str(tmp_path / 'index.json')}
+        settings.update(io or {})
+        config.load(yaml_str=yaml.safe_dump({'io' : settings}))
+        np.save(str(tmp_path / 'image.npy'), np.ones((1200, 1200, 1), dtype=np.float32))
+        np.save(str(tmp_path / 'labels.npy'), np.zeros((1200, 1200, 1), dtype=np.uint8) if labels is None else labels)
+        return imagery_dataset.ImageryDataset(ImageSet([str(tmp_path / 'image.npy')], 'npy'),
+                                              ImageSet([str(tmp_path / 'labels.npy')], 'npy'), 3, 1, **kwargs)
+    return make
+
 def test_block_label(dataset_block_label): #pylint: disable=redefined-outer-name
     """
     Same as previous test but with dataset that gives labels as 3x3 blocks.
@@ -116,6 +135,189 @@ def test_block_label(dataset_block_label): #pylint: disable=redefined-outer-name
         if v6 or v7 or v8:
             assert label[1, 1] == 0
 
+def test_shards(dataset, tmp_path): #pylint: disable=redefined-outer-name
+    count = shards.write_shards(dataset, str(tmp_path), num_shards=3, shuffle_buffer=10)
+    sd = shards.ShardDataset(str(tmp_path))
+    assert len(sd) == count
+    assert sd.num_bands() == dataset.num_bands()
+    assert sd.output_shape() == dataset.output_shape()
+    original = sorted((x.numpy().tobytes(), y.numpy().tobytes()) for (x, y) in dataset.dataset())
+    saved = sorted((x.numpy().tobytes(), y.numpy().tobytes()) for (x, y) in sd.dataset())
+    assert original == saved
+
+def test_class_samples(npy_dataset):
+    labels = np.zeros((1200, 1200, 1), dtype=np.uint8)
+    labels[::7, ::5] = 1
+    def dataset(class_samples):
+        return npy_dataset(labels=labels, class_balance=[0.5, 0.5], class_samples=class_samples)
+    every = list(dataset(1.0)._tile_generator()) #pylint: disable=protected-access
+    # only the sampled tiles are read
+    ds = dataset(0.25)
+    first = list(ds._tile_generator()) #pylint: disable=protected-access
+    assert len(first) == round(len(every) / 4) < len(every)
+    assert len(list(dataset(2)._tile_generator())) == 2 #pylint: disable=protected-access
+
+    # each epoch samples different tiles, and the cursor continues in the same epoch
+    tiles = ds._tiles() #pylint: disable=protected-access
+    assert list(tiles()) == first
+    second = list(tiles())
+    assert [t[:5] for t in second] != [t[:5] for t in first]
+    assert all(t[5] >> 48 == 1 for t in second)
+    ds.set_cursor({'seed': 0, 'epoch': 1, 'image': 0, 'tile': 2})
+    assert list(ds._tiles()()) == second[2:] #pylint: disable=protected-access
+
+def test_split_validation(npy_dataset):
+    ds = npy_dataset(io={'block_size_mb' : 1, 'strip_size_mb' : 1})
+    every = list(ds._tile_generator()) #pylint: disable=protected-access
+    assert len(every) > 2
+    validation = ds.split_validation(1000)
+    held_out = list(validation._tiles()()) #pylint: disable=protected-access
+    training = list(ds._tiles()()) #pylint: disable=protected-access
+    # the first tile has enough chunks, and training never loads it
+    assert held_out == every[:1]
+    assert training == every[1:]
+
+def test_cursor(dataset): #pylint: disable=redefined-outer-name
+    tiles = list(dataset._tile_generator()) #pylint: disable=protected-access
+    for (i, t) in enumerate(tiles):
+        start = (t[5] >> 32, t[5] & 0xFFFFFFFF)
+        assert list(dataset._tile_generator(start)) == tiles[i:] #pylint: disable=protected-access
+
+    assert dataset.cursor() is None
+    full = [x.numpy() for (x, _) in dataset.batches(10)]
+    batches = iter(dataset.batches(10))
+    for _ in range(3):
+        next(batches)
+    cursor = dataset.cursor()
+    assert cursor['seed'] == 0
+    dataset.set_cursor(cursor)
+    resumed = np.concatenate([x.numpy() for (x, _) in dataset.batches(10)])
+    full = np.concatenate(full)
+    # continues from the start of the tile of the last batch taken
+    assert 0 < len(resumed) <= len(full)
+    assert np.array_equal(full[len(full) - len(resumed):], resumed)
+    # later epochs start from the beginning
+    assert sum(len(x) for (x, _) in dataset.batches(10).repeat(2)) == len(resumed) + len(full)
+
+def test_validation_cache(dataset): #pylint: disable=redefined-outer-name
+    loads = []
+    load = dataset._load_tensor_imagery #pylint: disable=protected-access
+    def counted_load(*args):
+        loads.append(args)
+        return load(*args)
+    dataset._load_tensor_imagery = counted_load #pylint: disable=protected-access
+    tc = TrainingSpec(10, 1, 'sparse_categorical_crossentropy', [],
+                      validation=ValidationSet(from_training=True, steps=2))
+    (_, validation) = train._prep_datasets(dataset, tc, 3, 1) #pylint: disable=protected-access
+    first = [x.numpy() for (x, _) in validation]
+    assert len(first) == 2
+    num_loads = len(loads)
+    assert num_loads > 0
+    second = [x.numpy() for (x, _) in validation]
+    assert len(loads) == num_loads
+    assert all(np.array_equal(a, b) for (a, b) in zip(first, second))
+
+def test_shard(dataset): #pylint: disable=redefined-outer-name
+    full = np.concatenate([x.numpy() for (x, _) in dataset.batches(10)])
+    parts = []
+    for i in range(3):
+        dataset.shard(i, 3)
+        parts.extend(x.numpy() for (x, _) in dataset.batches(10))
+    dataset.shard(0, 1)
+    parts = np.concatenate(parts)
+    # every chunk is loaded by exactly one worker
+    assert len(parts) == len(full)
+    assert np.array_equal(np.sort(parts.reshape(len(parts), -1), axis=0), np.sort(full.reshape(len(full), -1), axis=0))
+    with pytest.raises(ValueError):
+        dataset.shard(3, 3)
+
+def test_strips(dataset): #pylint: disable=redefined-outer-name
+    (tile_width, _) = dataset._tile_shape() #pylint: disable=protected-access
+    width = 2 * tile_width + 5
+    tiles = dataset._strip_tiles(width) #pylint: disable=protected-access
+    assert tiles[0] == (0, tile_width)
+    # neighboring tiles overlap by a chunk, and cover the strip
+    for (a, b) in zip(tiles[:-1], tiles[1:]):
+        assert b[0] == a[0] + a[1] - (dataset.chunk_size() - 1)
+    assert tiles[-1][0] + tiles[-1][1] == width
+    assert all(w >= dataset.chunk_size() for (_, w) in tiles)
+
+    strip = np.arange(4 * width, dtype=np.float32).reshape((4, width, 1))
+    # images like NumpyImage read x along the columns
+    ds = tf.data.Dataset.from_tensors((strip, np.int32(1), np.int64(7)))
+    split = [(x.numpy(), int(c)) for (x, c) in dataset._split_strips(ds)] #pylint: disable=protected-access
+    assert len(split) == len(tiles)
+    for ((x, c), (start, w)) in zip(split, tiles):
+        assert np.array_equal(x, strip[:, start:start + w])
+        assert c == 7
+    assert dataset.read_overhead() >= 0
+
+def test_strip_rows(npy_dataset):
+    ds = npy_dataset(io={'block_size_mb' : 1})
+    (tile_width, _) = ds._tile_shape() #pylint: disable=protected-access
+    width = 2 * tile_width + 5
+    tiles = ds._strip_tiles(width) #pylint: disable=protected-access
+    # images like TiffImage read x along the rows
+    strip = np.arange(4 * width, dtype=np.float32).reshape((width, 4, 1))
+    split = tf.data.Dataset.from_tensors((strip, np.int32(0), np.int64(7)))
+    split = [x.numpy() for (x, _) in ds._split_strips(split)] #pylint: disable=protected-access
+    assert len(split) == len(tiles)
+    for (x, (start, w)) in zip(split, tiles):
+        assert np.array_equal(x, strip[start:start + w])
+    # square strips are split along the axis of their image type too
+    square = np.arange(width * width, dtype=np.float32).reshape((width, width, 1))
+    for axis in (0, 1):
+        split = tf.data.Dataset.from_tensors((square, np.int32(axis), np.int64(7)))
+        first = next(iter(ds._split_strips(split)))[0].numpy() #pylint: disable=protected-access
+        assert np.array_equal(first, square[:tiles[0][1]] if axis == 0 else square[:, :tiles[0][1]])
+
+    labels = np.zeros((width, 4, 1), np.uint8)
+    ds._load_tile_pair = lambda *args: (strip, labels, np.int32(0), np.int64(7)) #pylint: disable=protected-access
+    chunks = [c for (c, _, _) in ds._chunk_tile(0, 0, 0, width, 4, 7)] #pylint: disable=protected-access
+    # each tile is split along x, and no chunk is lost
+    assert len(chunks) == len(tiles)
+    assert all(len(c) == (w - 2) * 2 for (c, (_, w)) in zip(chunks, tiles))
+    assert np.array_equal(chunks[0][0, :, :, 0], strip[:3, :3, 0])
+
+def test_autotune(all_sources, tmp_path):
+    ds = load_dataset(all_sources[0], 1)
+    make_dataset = autotune.training_dataset(ds.image_set(), ds.label_set(), 3, 1)
+    results = autotune.autotune(make_dataset, 10, block_sizes=[1, 2], tile_ratios=[1.0], threads=[1, 2],
+                                batches=3, log=lambda _: None)
+    assert len(results) == 4
+    assert results[0]['chunks_per_second'] == max(r['chunks_per_second'] for r in results)
+    # the config is left with the fastest settings
+    assert config.io.block_size_mb() == results[0]['block_size_mb']
+    assert config.io.threads() == results[0]['threads']
+
+    filename = str(tmp_path / 'io.yaml')
+    with open(filename, 'w') as f:
+        f.write('io:\n  interleave_images: 3\n')
+    autotune.write_config(filename, results[0])
+    config.reset()
+    config.load(filename)
+    assert config.io.interleave_images() == 3
+    assert config.io.block_size_mb() == results[0]['block_size_mb']
+    assert config.io.tile_ratio() == 1.0
+    assert config.io.threads() == results[0]['threads']
+
+def test_autotune_failed():
+    class Dataset: #pylint: disable=too-few-public-methods
+        def batches(self, batch_size): #pylint: disable=no-self-use
+            if config.io.threads() > 1:
+                raise tf.errors.ResourceExhaustedError(None, None, 'out of memory')
+            return tf.data.Dataset.from_tensors((tf.zeros((batch_size, 3, 3, 1)), tf.zeros(batch_size))).repeat()
+    config.reset()
+    log = []
+    results = autotune.autotune(Dataset, 10, block_sizes=[1], tile_ratios=[1.0], threads=[2, 1],
+                                batches=3, log=log.append)
+    # the failed setting is recorded last, and not used
+    assert [r['threads'] for r in results] == [1, 2]
+    assert 'failed' not in results[0]
+    assert results[1]['failed'] == 'out of memory'
+    assert 'failed: out of memory' in log[0]
+    assert config.io.threads() == 1
+
 def test_train(dataset): #pylint: disable=redefined-outer-name
     def model_fn():
         kerasinput = keras.layers.Input((3, 3, 1))
@@ -136,6 +338,21 @@ def test_train(dataset): #pylint: disable=redefined-outer-name
     predictor.predict(npy.NumpyImage(test_image))
     assert sum(sum(np.logical_xor(output_image.buffer(), test_label))) < 200 # very easy test since we don't train much
 
+def test_train_shards(dataset, tmp_path): #pylint: disable=redefined-outer-name
+    shards.write_shards(dataset, str(tmp_path), num_shards=3, shuffle_buffer=10)
+    sd = shards.ShardDataset(str(tmp_path))
+    assert sd.data_type() == dataset.data_type()
+    assert sd.input_transform() is None
+    def model_fn():
+        kerasinput = keras.layers.Input((3, 3, 1))
+        flat = keras.layers.Flatten()(kerasinput)
+        dense = keras.layers.Dense(2, activation=tf.nn.softmax)(flat)
+        reshape = keras.layers.Reshape((1, 1, 2))(dense)
+        return keras.Model(inputs=kerasinput, outputs=reshape)
+    model, _ = train.train(model_fn, sd, TrainingSpec(100, 2, 'sparse_categorical_crossentropy', ['accuracy']))
+    ret = model.evaluate(x=sd.batches(100))
+    assert ret[1] > 0.70
+
 @pytest.fixture(scope="function")
 def autoencoder(all_sources):
     source = all_sources[0]
@@ -0,0 +1,94 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+
+import numpy as np
+import pytest
+
+from delta.imagery import preprocess
+
+def test_gain_offset():
+    data = np.array([[[0, 1, 2], [3, 4, 5]]], dtype=np.uint16)
+    out = preprocess.apply_gain_offset(data, [0, 1, 2], [1.0, 2.0, 3.0], [0.5, 0.5, 0.5])
+    assert out.dtype == np.float32
+    assert np.allclose(out, [[[0.0, 2.5, 6.5], [3.5, 8.5, 15.5]]])
+
+def test_gain_offset_subset():
+    # bands are selected from the per-band values, not by position in data
+    data = np.ones((2, 2, 2), dtype=np.float32)
+    out = preprocess.apply_gain_offset(data, [1, 3], [1.0, 2.0, 3.0, 4.0])
+    assert out is data # float32 data is modified in place
+    assert np.allclose(out[:, :, 0], 2.0)
+    assert np.allclose(out[:, :, 1], 4.0)
+
+    single = preprocess.apply_gain_offset(np.ones((2, 2), dtype=np.uint8), 2, [1.0, 2.0, 3.0])
+    assert single.shape == (2, 2)
+    assert np.allclose(single, 3.0)
+
+def test_brightness_temperature():
+    data = np.full((1, 1, 2), 10.0, dtype=np.float32)
+    out = preprocess.apply_brightness_temperature(data, [0, 1], [None, 100.0], [None, 1000.0])
+    assert out[0, 0, 0] == 10.0
+    assert out[0, 0, 1] == pytest.approx(1000.0 / np.log(100.0 / 10.0 + 1.0))
+
+class _ToaImage: #pylint:disable=too-few-public-methods
+    def toa_parameters(self, calc_reflectance): #pylint:disable=no-self-use
+        assert not calc_reflectance
+        return {'gain' : [2.0, 4.0], 'offset' : [1.0, 1.0], 'k1' : None, 'k2' : None}
+
+def test_pipeline():
+    p = preprocess.Pipeline([{'toa' : {'reflectance' : False}}, {'scale' : 10.0}, {'offset' : [0.0, -0.5]},
+                             {'clip' : [0.0, 0.8]}])
+    with pytest.raises(ValueError):
+        p(np.ones((1, 1, 2), dtype=np.uint16), None, [0, 1])
+    bound = p.bind(_ToaImage())
+    # the linear stages are combined into one operation
+    assert [op[0] for op in bound._ops] == ['affine', 'clip'] #pylint:disable=protected-access
+
+    data = np.array([[[0, 1], [1, 2]]], dtype=np.uint16)
+    out = bound(data, None, [0, 1])
+    assert out.dtype == np.float32
+    assert np.allclose(out, [[[0.0, 0.0], [0.3, 0.4]]])
+    out = bound(np.array([[2]], dtype=np.uint16), None, 1)
+    assert np.allclose(out, [[0.4]])
+
+    assert pickle.loads(pickle.dumps(bound)) == p
+    assert p.key() == preprocess.Pipeline(p._stages).key() #pylint:disable=protected-access
+    with pytest.raises(ValueError):
+        preprocess.Pipeline([{'unknown' : 1}])
+
+class _NoOffsetImage: #pylint:disable=too-few-public-methods
+    def toa_parameters(self, calc_reflectance): #pylint:disable=no-self-use,unused-argument
+        return {'gain' : [2.0], 'offset' : None, 'k1' : None, 'k2' : None}
+
+def test_pipeline_no_offset():
+    bound = preprocess.Pipeline([{'toa' : {'reflectance' : False}}], nodata=-1.0).bind(_NoOffsetImage())
+    out = bound(np.array([[[0], [3]]], dtype=np.uint16), None, [0])
+    assert np.allclose(out, [[[-1.0], [6.0]]])
+
+def test_affine():
+    (gain, offset) = preprocess.Pipeline([{'scale' : 4.0}, {'offset' : [1.0, 2.0]}]).affine()
+    assert np.allclose(gain, 0.25)
+    assert np.allclose(offset, [1.0, 2.0])
+    assert preprocess.Pipeline([]).affine() == (1.0, 0.0)
+    assert preprocess.Pipeline([{'scale' : 4.0}, {'clip' : [0.0, 1.0]}]).affine() is None
+    # a clip with no bounds does nothing
+    (gain, offset) = preprocess.Pipeline([{'scale' : 4.0}, {'clip' : [None, None]}, {'offset' : 1.0}]).affine()
+    assert np.allclose(gain, 0.25)
+    assert np.allclose(offset, 1.0)
+    assert preprocess.Pipeline([{'toa' : {}}]).affine() is None
@@ -0,0 +1,68 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#pylint: disable=protected-access
+import multiprocessing
+import time
+
+from delta.imagery import profiling
+from delta.ml import profiler
+
+def _work(_):
+    with profiling.timed('read'):
+        time.sleep(0.01)
+
+def test_stage_times():
+    profiling.disable()
+    with profiling.timed('read'):
+        pass
+    assert not profiling.enabled()
+    assert profiling.times() == {}
+
+    profiling.enable()
+    try:
+        assert list(profiling.timed_generator('tiles', range(5))) == list(range(5))
+        # stages timed in forked processes are counted too
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            pool.map(_work, range(4))
+        times = profiling.times()
+        assert times['tiles'][1] == 5
+        assert times['read'][1] == 4
+        assert times['read'][0] >= 0.04
+        assert 'chunk' not in times
+    finally:
+        profiling.disable()
+
+def test_report():
+    profiling.enable()
+    try:
+        profiling.add('read', 1.0, 10)
+        profiling.add('chunk', 0.1, 10)
+        callback = profiler.ProfileCallback(8, threads=2)
+        (callback._step, callback._step_time) = (10, 1.0)
+        # waiting most of the time, and reading takes longer than a step even split between threads
+        callback._wait = 0.8
+        report = callback._report(2.0)
+        assert report['samples_per_second'] == 40
+        assert abs(report['stall_percent'] - 80) < 1e-6
+        assert report['stage_ms'] == {'read' : 100.0, 'chunk' : 10.0}
+        assert report['bottleneck'] == 'read'
+        assert profiler.report_metrics(report)['profile_read_ms'] == 100.0
+        callback._wait = 0.05
+        assert callback._report(2.0)['bottleneck'] == 'train step'
+    finally:
+        profiling.disable()
@@ -0,0 +1,60 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from delta.imagery import rectangle
+from delta.imagery.rectangle import Rectangle
+
+def test_tiles():
+    bounds = Rectangle(2, 3, width=25, height=12)
+    tiles = bounds.make_tile_rois(10, 5, overlap_amount=2)
+    array = bounds.tile_array(10, 5, overlap_amount=2)
+    assert array.shape == (len(tiles), 4)
+    assert np.array_equal(rectangle.to_array(tiles), array)
+    # in order of columns, then rows, cropped to the bounds
+    assert tiles[0].get_bounds() == (2, 12, 3, 8)
+    assert tiles[1].get_bounds() == (2, 12, 6, 11)
+    assert tiles[-1].get_bounds() == (26, 27, 12, 15)
+    assert all(isinstance(v, int) for t in tiles for v in t.get_bounds())
+    assert all(bounds.contains_rect(t) for t in tiles)
+
+    full = bounds.make_tile_rois(10, 5, min_width=10, min_height=5, overlap_amount=2)
+    assert all(t.width() == 10 and t.height() == 5 for t in full)
+    assert [t.get_bounds() for t in bounds.make_tile_rois(10, 5, include_partials=False, overlap_amount=2)] == \
+           [t.get_bounds() for t in full]
+    assert rectangle.areas(array).sum() == sum(t.area() for t in tiles)
+
+    with pytest.raises(AttributeError):
+        tiles[0].other = 1
+
+def test_intersect():
+    array = np.array([[0, 0, 10, 10], [5, 5, 20, 20], [30, 30, 40, 40]])
+    result = rectangle.intersect(array, Rectangle(2, 2, 15, 15))
+    for (r, a) in zip(rectangle.rectangles(result), rectangle.rectangles(array)):
+        assert r.get_bounds() == a.get_intersection(Rectangle(2, 2, 15, 15)).get_bounds()
+    assert rectangle.areas(result).tolist() == [64, 100, 0]
+
+def test_group_by():
+    rois = np.array([[0, 0, 5, 5], [10, 0, 12, 3], [3, 3, 8, 8], [6, 6, 10, 10], [1, 1, 2, 2]])
+    blocks = rectangle.block_ranges(rois, 8, 8)
+    assert blocks.tolist() == [[0, 0, 1, 1], [1, 0, 2, 1], [0, 0, 1, 1], [0, 0, 2, 2], [0, 0, 1, 1]]
+    groups = rectangle.group_by(blocks)
+    assert [(b, g.tolist()) for (b, g) in groups] == [((0, 0, 1, 1), [0, 2, 4]), ((1, 0, 2, 1), [1]),
+                                                      ((0, 0, 2, 2), [3])]
+    assert rectangle.group_by(np.zeros((0, 4), int)) == []
@@ -0,0 +1,72 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from delta.imagery import image_index, sampling
+from delta.imagery.imagery_config import ImageSet
+from delta.imagery.sources import npy
+
+def test_tile_histograms():
+    data = np.zeros((4, 4, 1), dtype=np.uint8)
+    data[0:2, 0:2] = 1
+    data[3, 3] = 255 # nodata
+    image = npy.NumpyImage(data)
+    tiles = image.tiles(2, 2)
+    hist = sampling.tile_histograms(image, tiles, 2)
+    assert hist.shape == (4, 2)
+    assert hist.sum() == 15
+    assert sorted(hist[:, 1].tolist()) == [0, 0, 0, 4]
+
+def test_balance():
+    # one tile mostly of the rare class, many of the common class
+    hist = np.array([[90, 10]] + [[100, 0]] * 9 + [[0, 0]])
+    weights = sampling.balance_weights(hist, [0.5, 0.5])
+    assert weights[-1] == 0.0
+    expected = weights @ hist
+    assert expected[1] / expected.sum() > 0.09 # best possible is only sampling the first tile
+
+    hist = np.array([[80, 20], [20, 80], [100, 0]])
+    weights = sampling.balance_weights(hist, [0.5, 0.5])
+    expected = weights @ hist
+    assert expected[0] / expected.sum() == pytest.approx(0.5, abs=0.01)
+
+    samples = sampling.sample_tiles(weights, 1000)
+    assert np.array_equal(samples, sampling.sample_tiles(weights, 1000))
+    assert np.count_nonzero(samples == 1) > np.count_nonzero(samples == 2)
+
+    with pytest.raises(ValueError):
+        sampling.balance_weights(hist, [1.0, 1.0, 1.0])
+
+def test_sample_count():
+    weights = np.array([0.5, 0.0, 0.25, 0.25])
+    assert sampling.sample_count(weights, 1.0) == 3
+    assert sampling.sample_count(weights, 0.5) == 2
+    assert sampling.sample_count(weights, 0.01) == 1
+    assert sampling.sample_count(weights, 10) == 10
+
+def test_histogram_index(tmp_path):
+    path = str(tmp_path / 'labels.npy')
+    np.save(path, np.ones((4, 4, 1), dtype=np.uint8))
+    labels = ImageSet([path], 'npy')
+    index = image_index.ImageIndex(str(tmp_path / 'index.json'))
+    tiles = index.info(labels)[0].tiles(2, 2)
+    hist = index.tile_histograms(labels, 0, tiles, 2)
+    assert hist[:, 1].tolist() == [4, 4, 4, 4]
+    other = image_index.ImageIndex(index.path()).tile_histograms(labels, 0, tiles, 2)
+    assert np.array_equal(hist, other)
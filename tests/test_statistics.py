@@ -0,0 +1,78 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+import pytest
+
+from delta.imagery import preprocess, statistics
+from delta.imagery.sources import npy
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_compute(dtype):
+    rng = np.random.default_rng(0)
+    data = (rng.random((50, 40, 2)) * 1000).astype(dtype)
+    data[0, 0, 0] = 0
+    image = npy.NumpyImage(data)
+    stats = statistics.compute_statistics(image, bins=16, nodata=0, block_pixels=100)
+    valid = [data[:, :, b][data[:, :, b] != 0].astype(np.float64) for b in range(2)]
+    assert np.array_equal(stats.count(), [v.size for v in valid])
+    assert np.allclose(stats.minimum(), [v.min() for v in valid])
+    assert np.allclose(stats.maximum(), [v.max() for v in valid])
+    assert np.allclose(stats.mean(), [v.mean() for v in valid])
+    assert np.allclose(stats.std(), [v.std() for v in valid])
+    for b in range(2):
+        expected = np.histogram(valid[b], 16, range=(valid[b].min(), valid[b].max()))[0]
+        assert np.array_equal(stats.histogram()[b], expected)
+    assert abs(stats.percentile(50)[0] - np.median(valid[0])) < (valid[0].max() - valid[0].min()) / 16
+
+    copy = statistics.ImageStatistics.from_dict(stats.to_dict())
+    assert np.array_equal(copy.histogram(), stats.histogram())
+    assert np.allclose(copy.std(), stats.std())
+
+def test_index(tmp_path):
+    path = str(tmp_path / 'image.npy')
+    np.save(path, np.arange(100, dtype=np.uint8).reshape((10, 10, 1)))
+    index = statistics.StatisticsIndex(str(tmp_path / 'stats.json'), bins=10)
+    stats = index.statistics(npy.NumpyImage(path=path))
+    assert stats.maximum()[0] == 99
+    assert os.path.exists(index.path())
+
+    # loaded from the index file by a new index
+    other = statistics.StatisticsIndex(index.path(), bins=10)
+    assert np.array_equal(other.statistics(npy.NumpyImage(path=path)).histogram(), stats.histogram())
+
+    # modifying the image invalidates the statistics
+    np.save(path, np.full((10, 10, 1), 7, dtype=np.uint8))
+    os.utime(path, (0, 0))
+    stats = statistics.StatisticsIndex(index.path(), bins=10).statistics(npy.NumpyImage(path=path))
+    assert stats.maximum()[0] == 7
+
+def test_normalize():
+    data = np.array([[[1, 10], [3, 30]]], dtype=np.uint16)
+    image = npy.NumpyImage(data)
+    p = preprocess.Pipeline([{'normalize' : {'method' : 'standard'}}, {'offset' : 1.0}])
+    with pytest.raises(ValueError):
+        p(data, None, [0, 1])
+    out = p.bind(image)(data, None, [0, 1])
+    assert np.allclose(out, [[[0.0, 0.0], [2.0, 2.0]]])
+    out = preprocess.Pipeline([{'normalize' : {'method' : 'minmax'}}]).bind(image)(data[:, :, 1:], None, [1])
+    assert np.allclose(out, [[[0.0], [1.0]]])
+
+    with pytest.raises(ValueError):
+        preprocess.Pipeline([{'scale' : 2.0}, {'normalize' : None}]).bind(image)
@@ -129,3 +129,25 @@ def test_geotiff_write(tmpdir):
 
     assert numpy_image.shape == data.shape
     assert np.allclose(numpy_image, data)
+
+def test_roi_generator():
+    '''
+    Tests reading ROIs grouped by the blocks they are in.
+    '''
+    file_path = os.path.join(os.path.dirname(__file__), 'data', 'landsat.tiff')
+    image = TiffImage(file_path)
+    bounds = rectangle.Rectangle(0, 0, width=image.width(), height=image.height())
+    for (size, overlap) in [(3, 0), (5, 2)]:
+        rois = bounds.make_tile_rois(size, size, include_partials=True, overlap_amount=overlap)
+        aligned = image.block_aligned_rois(rectangle.to_array(rois))
+        assert [tuple(a) for a in aligned.tolist()] == \
+               [tuple(rectangle.to_array([image.block_aligned_roi(r)])[0]) for r in rois]
+        for merge in [0, 1024]:
+            results = list(image.roi_generator(rois, merge))
+            assert len(results) == len(rois)
+            assert sorted(id(r) for (r, _, _) in results) == sorted(id(r) for r in rois)
+            assert [i for (_, _, (i, _)) in results] == list(range(1, len(rois) + 1))
+            for (roi, data, _) in results:
+                assert np.array_equal(data, image.read(roi))
+    with pytest.raises(Exception):
+        list(image.roi_generator([rectangle.Rectangle(0, 0, width=image.width() + 1, height=1)]))
@@ -0,0 +1,83 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from delta.imagery import tile_producer
+
+def _load(i):
+    return (np.full((i % 5 + 1, 3), i, dtype=np.float32), np.array([i], dtype=np.uint8), np.array(i))
+
+def _fail(i):
+    if i == 7:
+        raise ValueError('Failed to load.')
+    return (np.zeros(1),)
+
+def test_producer():
+    producer = tile_producer.TileProducer(_load, lambda: [(i,) for i in range(50)], 4, 200)
+    for _ in range(2): # can be iterated more than once
+        out = list(producer())
+        assert len(out) == 50
+        for (i, (a, b, c)) in enumerate(out):
+            assert a.shape == (i % 5 + 1, 3)
+            assert np.all(a == i)
+            assert b.dtype == np.uint8 and b[0] == i
+            assert c.shape == () and c == i
+
+    # stop early
+    it = iter(tile_producer.TileProducer(_load, lambda: ((i,) for i in range(1000)), 2, 200))
+    assert next(it)[1][0] == 0
+    it.close()
+
+def test_producer_errors():
+    with pytest.raises(RuntimeError):
+        list(tile_producer.TileProducer(_fail, lambda: [(i,) for i in range(10)], 2, 8)())
+    # result larger than buffers
+    with pytest.raises(RuntimeError):
+        list(tile_producer.TileProducer(lambda i: (np.zeros(1000),), lambda: [(0,)], 1, 8)())
+
+def _load_items(i):
+    n = i % 7 + 1
+    return (np.full((n, 2, 2), i, dtype=np.float32), np.full((n,), i, dtype=np.uint8))
+
+def test_batch_producer():
+    producer = tile_producer.BatchProducer(_load_items, lambda: [(i,) for i in range(40)], 3, 5,
+                                           [((2, 2), np.float32), ((), np.uint8)])
+    orders = []
+    for _ in range(2):
+        labels = []
+        for (a, b) in producer():
+            assert a.shape[0] == b.shape[0] <= 5
+            assert a.shape[1:] == (2, 2)
+            assert np.all(a[:, 0, 0] == b)
+            labels.extend(b.tolist())
+        assert len(labels) == sum(i % 7 + 1 for i in range(40))
+        assert set(labels) == set(range(40))
+        orders.append(labels)
+    assert orders[0] == orders[1]
+
+def test_batch_producer_keep():
+    # batches stay valid when kept after their shared memory is reused and freed
+    producer = tile_producer.BatchProducer(_load_items, lambda: [(i,) for i in range(40)], 2, 5,
+                                           [((2, 2), np.float32), ((), np.uint8)], slots_per_process=1)
+    batches = list(producer())
+    labels = []
+    for (a, b) in batches:
+        assert np.all(a[:, 0, 0] == b)
+        labels.extend(b.tolist())
+    assert sorted(labels) == sorted(i for i in range(40) for _ in range(i % 7 + 1))
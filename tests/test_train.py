@@ -0,0 +1,82 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#pylint: disable=protected-access
+import os
+
+import mlflow
+import numpy as np
+import tensorflow as tf
+
+from delta.config import config
+from delta.ml import distributed, train
+
+def test_mlflow_logger(tmp_path):
+    mlflow.set_tracking_uri('sqlite:///%s' % (tmp_path / 'mlflow.db'))
+    mlflow.set_experiment(experiment_id=mlflow.create_experiment('test', (tmp_path / 'artifacts').as_uri()))
+    with mlflow.start_run() as run:
+        logger = train._MLFlowLogger(run.info.run_id)
+        # more than one log_batch call
+        for i in range(1200):
+            logger.log_metrics({'loss' : 1.0 / (i + 1), 'accuracy' : 0.5}, step=i)
+        filename = str(tmp_path / 'checkpoint.h5')
+        with open(filename, 'w') as f:
+            f.write('checkpoint')
+        logger.log_artifact(filename, 'checkpoints')
+        logger.close()
+    client = mlflow.tracking.MlflowClient()
+    assert len(client.get_metric_history(run.info.run_id, 'loss')) == 1200
+    assert [a.path for a in client.list_artifacts(run.info.run_id, 'checkpoints')] == ['checkpoints/checkpoint.h5']
+    # uploaded files are removed
+    assert not os.path.exists(filename)
+
+def test_checkpoint(tmp_path):
+    model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    model.compile(optimizer='adam', loss='mse')
+    model.fit(np.ones((4, 3)), np.ones((4, 2)), verbose=0)
+    manager = tf.train.CheckpointManager(train._checkpoint(model, model.optimizer), str(tmp_path), 2)
+    for step in (1, 2, 3):
+        manager.save(checkpoint_number=step)
+    assert train.find_checkpoint(str(tmp_path)) == str(tmp_path / 'ckpt-3')
+    assert train.find_checkpoint(str(tmp_path / 'ckpt-2')) == str(tmp_path / 'ckpt-2')
+    assert train.find_checkpoint(str(tmp_path / 'ckpt-1')) is None
+
+    restored = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    restored.compile(optimizer='adam', loss='mse')
+    train._checkpoint(restored, restored.optimizer).restore(str(tmp_path / 'ckpt-3')).expect_partial()
+    assert all(np.array_equal(a, b) for (a, b) in zip(model.get_weights(), restored.get_weights()))
+
+def test_worker_checkpoints(tmp_path, monkeypatch):
+    config.reset()
+    config.load(yaml_str='mlflow:\n  checkpoints:\n    frequency: 1\n    format: tf\n    dir: %s\n' % (tmp_path))
+    monkeypatch.setattr(distributed, 'is_chief', lambda: False)
+    # write checkpoints synchronously, so they are there to check
+    monkeypatch.setattr(train, '_checkpoint_options', lambda: None)
+    model = tf.keras.Sequential([tf.keras.layers.Dense(2, input_shape=(3,))])
+    model.compile(optimizer='adam', loss='mse')
+    model.fit(np.ones((4, 3)), np.ones((4, 2)), verbose=0)
+    # other workers save checkpoints and models in a temporary directory, without an MLFlow run
+    mcb = train._mlflow_train_setup(model, None, None)
+    model.fit(np.ones((4, 3)), np.ones((4, 2)), batch_size=2, verbose=0, callbacks=[mcb])
+    assert mlflow.active_run() is None
+    assert os.path.dirname(mcb.checkpoint_dir) == mcb.temp_dir
+    assert train.find_checkpoint(mcb.checkpoint_dir) == os.path.join(mcb.checkpoint_dir, 'ckpt-2')
+    train._save_model(mcb, model, 'final_model.h5', 'Finished', 'Completed')
+    assert not os.path.exists(os.path.join(mcb.temp_dir, 'final_model.h5'))
+    train._end_mlflow(mcb, 'FINISHED')
+    assert not os.path.exists(mcb.temp_dir)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,57 @@
+# Copyright © 2020, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The DELTA (Deep Earth Learning, Tools, and Analysis) platform is
+# licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import concurrent.futures
+import os
+import zipfile
+
+from delta.imagery import utilities
+
+def _make_zip(path, files):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for (name, data) in files.items():
+            zf.writestr(name, data)
+
+def test_concurrent_extract(tmpdir):
+    files = {'a.txt' : b'a' * 100000, 'sub/b.txt' : b'b' * 100000}
+    archive = os.path.join(str(tmpdir), 'test.zip')
+    _make_zip(archive, files)
+
+    members = os.path.join(str(tmpdir), 'members')
+    whole = os.path.join(str(tmpdir), 'whole')
+    with concurrent.futures.ThreadPoolExecutor(8) as exe:
+        jobs = [exe.submit(utilities.unpack_to_folder, archive, members, lambda n: True, 2) for _ in range(4)]
+        jobs += [exe.submit(utilities.unpack_to_folder, archive, whole) for _ in range(4)]
+        for j in jobs:
+            j.result()
+    for folder in [members, whole]:
+        for (name, data) in files.items():
+            with open(os.path.join(folder, name), 'rb') as f:
+                assert f.read() == data
+        assert sorted(os.listdir(folder)) == ['a.txt', 'sub']
+        assert os.listdir(os.path.join(folder, 'sub')) == ['b.txt']
+    # no partial files or working folders left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['members', 'test.zip', 'whole']
+
+def test_locked_json(tmpdir):
+    path = os.path.join(str(tmpdir), 'sub', 'index.json')
+    index = utilities.LockedJSON(path, 'items')
+    with index.lock():
+        assert index.load() == {}
+        index.save({'a' : 1})
+    with index.lock():
+        assert utilities.LockedJSON(path, 'items').load() == {'a' : 1}
+    assert utilities.LockedJSON(path, 'other').load() == {}
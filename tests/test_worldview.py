@@ -19,6 +19,7 @@
 """
 Test for worldview class.
 """
+import numpy as np
 import pytest
 
 from delta.imagery.sources import worldview
@@ -34,3 +35,11 @@ def test_wv_image(wv_image):
     assert buf.shape == (64, 32, 1)
     assert len(wv_image.scale()) == 1
     assert len(wv_image.bandwidth()) == 1
+
+def test_wv_toa(wv_image):
+    raw = wv_image.read()
+    worldview.toa_preprocess(wv_image)
+    out = wv_image.read()
+    gain = wv_image.scale()[0] / wv_image.bandwidth()[0]
+    assert out.dtype == np.float32
+    assert np.allclose(out, np.where(raw > 0, raw * gain, worldview.OUTPUT_NODATA))